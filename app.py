@@ -1,5 +1,12 @@
 import os
+import contextvars
+import bisect
 import json
+import random
+import re
+import threading
+import time
+from collections import OrderedDict, deque
 from fastapi import FastAPI, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi.middleware.cors import CORSMiddleware
@@ -9,14 +16,18 @@ from sqlalchemy.ext.declarative import declarative_base
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from datetime import datetime, timedelta
-from typing import List, Optional
+from typing import Callable, List, Optional
 from pydantic import BaseModel
+from google.api_core import exceptions as google_exceptions
 
 # --- LangChain Imports ---
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_core.output_parsers import StrOutputParser
-from langchain_core.runnables import RunnableParallel, RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnableParallel, RunnablePassthrough
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
 
 # --- Configuration ---
 # Load environment variables ASAP so reads below get correct values
@@ -25,7 +36,7 @@ try:
     load_dotenv()
 except Exception:
     pass
-DATABASE_URL = "sqlite:///./storycrafter.db"
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./storycrafter.db")
 # Make sure to set your GEMINI_API_KEY in your .env file. For local dev, fall back to a placeholder.
 GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
 SECRET_KEY = os.getenv("SECRET_KEY", "a_very_secret_key_for_dev_only")
@@ -152,127 +163,6 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     if user is None: raise credentials_exception
     return user
 
-# --- LangChain Orchestration ---
-# Provider-agnostic LLM factory so each artifact can use a different model
-def get_chat_llm(provider: str | None = None, model: str | None = None):
-    provider = (provider or "gemini").lower()
-    # Default models per provider
-    default_models = {
-        "gemini": "gemini-1.5-flash",
-    }
-    selected_model = model or default_models.get(provider)
-    if provider == "gemini":
-        if not GEMINI_API_KEY:
-            raise RuntimeError("GEMINI_API_KEY is required for Gemini provider")
-        return ChatGoogleGenerativeAI(model=selected_model, google_api_key=GEMINI_API_KEY)
-
-    # Fallback: raise for unsupported providers until wired in
-    raise ValueError(f"Unsupported LLM provider: {provider}")
-
-def build_chains(llm_config: dict | None = None):
-    llm_config = llm_config or {}
-    story_cfg = (llm_config.get("story") or {})
-    tests_cfg = (llm_config.get("test_cases") or {})
-    desc_cfg = (llm_config.get("description") or {})
-
-    story_llm = get_chat_llm(story_cfg.get("provider"), story_cfg.get("model"))
-    tests_llm = get_chat_llm(tests_cfg.get("provider"), tests_cfg.get("model"))
-    desc_llm = get_chat_llm(desc_cfg.get("provider"), desc_cfg.get("model"))
-
-    story_chain_local = prompt_story | story_llm | StrOutputParser()
-    tests_chain_local = prompt_tests | tests_llm | StrOutputParser()
-    description_chain_local = prompt_desc | desc_llm | StrOutputParser()
-
-    final_chain_local = RunnablePassthrough.assign(
-        story=story_chain_local,
-        description=description_chain_local,
-    ).assign(
-        test_cases=lambda x: {"user_story": x["story"]} | tests_chain_local
-    )
-
-    return {
-        "story_chain": story_chain_local,
-        "tests_chain": tests_chain_local,
-        "description_chain": description_chain_local,
-        "final_chain": final_chain_local,
-    }
-
-# Strict, industry-standard templates
-prompt_story = ChatPromptTemplate.from_template(
-    """
-You are an expert Technical Product Manager. Based on the following requirement, create a formal User Story with Acceptance Criteria.
-
-The output MUST follow this exact format and keywords. Do not add any extra headings or prose:
-
-User Story: As a [type of user], I want to [task], so that I can [objective].
-
-ACCEPTANCE CRITERIA:
-GIVEN [initial context], WHEN [action performed], THEN [expected outcome].
-
-ACCEPTANCE CRITERIA:
-GIVEN [another initial context], WHEN [another action or negative/edge case], THEN [expected outcome] AND [additional outcome if applicable].
-
-Notes:
-- Provide 2–5 ACCEPTANCE CRITERIA blocks, each starting with the header exactly as shown: "ACCEPTANCE CRITERIA:".
-- Use clear, observable system behavior; avoid implementation details.
-
-Requirement: {requirement}
-    """
-)
-
-prompt_desc = ChatPromptTemplate.from_template(
-    """
-You are an expert Product Manager. Produce a concise Feature Brief for non-technical stakeholders based on the requirement.
-
-The output MUST follow this exact template and headings (Markdown bold labels included):
-
-**Feature:** [Feature Name]
-
-**Summary:** [A one-sentence summary of what this feature does.]
-
-**Problem:** [A brief description of the user problem this feature solves.]
-
-**Solution:** [A high-level overview of how this feature solves the problem.]
-
-**Scope:**
-* [Key capability or component 1]
-* [Key capability or component 2]
-* [Add more bullet points if needed]
-
-Requirement: {requirement}
-    """
-)
-
-prompt_tests = ChatPromptTemplate.from_template(
-    """
-You are a Senior QA Engineer. Create comprehensive Gherkin test cases for the feature, including happy paths, edge cases, and failure modes.
-
-The output MUST follow this exact Gherkin-style structure and keywords:
-
-Feature: [Feature Name]
-
-  Scenario: [Happy path scenario title]
-    Given [precondition]
-    When [user action]
-    And [optional additional action]
-    Then [expected outcome]
-
-  Scenario Outline: [Negative or edge case scenario]
-    Given [precondition]
-    When the user enters "<value1>" and "<value2>"
-    And [optional additional action]
-    Then [expected outcome / error]
-
-    Examples:
-      | value1 | value2 |
-      | ...    | ...    |
-
-Base Requirement (or user story input if provided): {user_story}
-    """
-)
-
-# Chains are now built per-request via build_chains(llm_config)
-
 # --- FastAPI App ---
 app = FastAPI()
 app.add_middleware(
@@ -360,21 +250,35 @@ def get_messages(chat_id: int, current_user: User = Depends(get_current_user), d
     if not chat: raise HTTPException(status_code=404, detail="Chat not found")
     return db.query(ChatMessage).filter(ChatMessage.chat_id == chat_id).order_by(ChatMessage.created_at).all()
 
-from fastapi import FastAPI, HTTPException, Depends, status
+from fastapi import FastAPI, HTTPException, Depends, Query, Request, Response, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel, EmailStr
-from sqlalchemy import create_engine, Column, Integer, String, Boolean, ForeignKey, Text, DateTime
+from sqlalchemy import create_engine, event, inspect, Column, Index, Integer, String, Boolean, ForeignKey, LargeBinary, Text, DateTime, and_, or_, func, select, text
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy.orm import sessionmaker, Session, relationship
+from sqlalchemy.orm import sessionmaker, Session, deferred, relationship, selectinload, undefer
 from passlib.context import CryptContext
 from jose import JWTError, jwt
 from datetime import datetime, timedelta
 import os
+import asyncio
+import base64
+import hashlib
+import hmac
 import logging
+import functools
+import sys
+import threading
+import uuid
+import zlib
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager
+import anyio
 import google.generativeai as genai
 from dotenv import load_dotenv
-from typing import Optional
+from typing import Callable, NamedTuple, Optional
 import re
 
 # Configure logging
@@ -385,11 +289,40 @@ logger = logging.getLogger(__name__)
 load_dotenv()
 
 # Database setup
-SQLALCHEMY_DATABASE_URL = "sqlite:///./storycrafter.db"
-engine = create_engine(SQLALCHEMY_DATABASE_URL, connect_args={"check_same_thread": False})
+SQLALCHEMY_DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./storycrafter.db")
+# Maximum number of worker threads running database work at once (see run_db)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "16"))
+engine = create_engine(
+    SQLALCHEMY_DATABASE_URL,
+    connect_args={"check_same_thread": False},
+    pool_size=DB_POOL_SIZE,
+    max_overflow=8,
+)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 Base = declarative_base()
 
+# SQLite tuning, applied to every pooled connection. WAL lets readers run alongside the single
+# writer; busy_timeout makes a writer wait for the lock instead of failing with "database is locked".
+# pysqlite only opens a transaction right before the first write, so a writer never holds a read
+# snapshot it would need to upgrade, and waiting on busy_timeout is always safe.
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "5000"))
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "65536"))
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024)))
+
+@event.listens_for(engine, "connect")
+def _configure_sqlite_connection(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute("PRAGMA synchronous=NORMAL")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        # Negative cache_size is in KiB
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    finally:
+        cursor.close()
+
 # Database Models
 class UserModel(Base):
     __tablename__ = "users"
@@ -414,6 +347,10 @@ class Project(Base):
     user = relationship("UserModel", back_populates="projects")
     chats = relationship("Chat", back_populates="project", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_projects_user_id_created_at", "user_id", "created_at", "id"),
+    )
+
 class Chat(Base):
     __tablename__ = "chats"
     id = Column(Integer, primary_key=True, index=True)
@@ -427,21 +364,121 @@ class Chat(Base):
     project = relationship("Project", back_populates="chats")
     messages = relationship("ChatMessage", back_populates="chat", order_by="ChatMessage.created_at", cascade="all, delete-orphan")
 
+    __table_args__ = (
+        Index("ix_chats_created_at", "created_at", "id"),
+        Index("ix_chats_project_id_created_at", "project_id", "created_at", "id"),
+        Index("ix_chats_user_id", "user_id"),
+    )
+
 class ChatMessage(Base):
     __tablename__ = "chat_messages"
     id = Column(Integer, primary_key=True, index=True)
     chat_id = Column(Integer, ForeignKey("chats.id"))
     user_id = Column(Integer, ForeignKey("users.id"))
-    message = Column(Text)
+    # NULL for AI replies whose sections live in message_artifacts; read through .message
+    _message = Column("message", Text)
     is_user = Column(Boolean, default=True)
     created_at = Column(DateTime, default=datetime.utcnow)
+    # LLM usage for AI messages; token_usage holds the per-section breakdown as JSON
+    input_tokens = Column(Integer, nullable=True)
+    output_tokens = Column(Integer, nullable=True)
+    token_usage = Column(Text, nullable=True)
 
     user = relationship("UserModel")
     chat = relationship("Chat", back_populates="messages")
+    artifacts = relationship("MessageArtifact", back_populates="chat_message", order_by="MessageArtifact.id", cascade="all, delete-orphan")
+
+    __table_args__ = (
+        Index("ix_chat_messages_chat_id_created_at", "chat_id", "created_at", "id"),
+    )
+
+    @property
+    def message(self) -> str:
+        """The stored text or, for AI replies, the sections as the JSON object clients have always received."""
+        if self._message is not None or self.is_user:
+            return self._message
+        return json.dumps(artifacts_to_dict(self.artifacts))
+
+    @message.setter
+    def message(self, value: str) -> None:
+        self._message = value
+
+class MessageArtifact(Base):
+    """One section of an AI reply. body is deferred, so listing sections does not read the text."""
+    __tablename__ = "message_artifacts"
+    id = Column(Integer, primary_key=True, index=True)
+    message_id = Column(Integer, ForeignKey("chat_messages.id"), nullable=False)
+    section = Column(String, nullable=False)
+    content_hash = Column(String(64), nullable=True)  # sha256 of the text; NULL for a failed section
+    encoding = Column(String, default="plain")  # plain or zlib
+    size = Column(Integer, default=0)  # UTF-8 bytes before compression
+    stored_size = Column(Integer, default=0)
+    body = deferred(Column(LargeBinary, nullable=True))
+    valid = Column(Boolean, nullable=True)
+    validation_codes = Column(Text, nullable=True)  # JSON list of ValidationResult codes
+    error = Column(Text, nullable=True)  # why the section failed to generate
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    chat_message = relationship("ChatMessage", back_populates="artifacts")
+
+    __table_args__ = (
+        Index("ux_message_artifacts_message_id_section", "message_id", "section", unique=True),
+    )
+
+    @property
+    def content(self) -> Optional[str]:
+        return decode_artifact_body(self.encoding, self.body)
+
+class GenerationJob(Base):
+    __tablename__ = "generation_jobs"
+    id = Column(String, primary_key=True)
+    chat_id = Column(Integer, ForeignKey("chats.id"), index=True)
+    request = Column(Text)  # StoryRequest as JSON
+    status = Column(String, default="queued")  # queued, running, section_done, failed, complete
+    artifacts = Column(Text)  # JSON of the sections finished so far
+    errors = Column(Text, nullable=True)
+    message_id = Column(Integer, ForeignKey("chat_messages.id"), nullable=True)
+    attempts = Column(Integer, default=0)
+    worker_id = Column(String, nullable=True)
+    lease_expires_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_generation_jobs_status_created_at", "status", "created_at"),
+    )
+
+class GenerationCacheEntry(Base):
+    __tablename__ = "generation_cache"
+    key = Column(String, primary_key=True)
+    value = Column(Text)
+    size = Column(Integer, default=0)
+    created_at = Column(DateTime, default=datetime.utcnow)
+    last_accessed = Column(DateTime, default=datetime.utcnow, index=True)
+    expires_at = Column(DateTime, index=True)
+
+def apply_sqlite_migrations(bind) -> None:
+    """
+    Bring an existing database up to the current models. Idempotent: adds columns that older
+    schemas lack (as nullable columns) and creates any missing indexes, including the composite ones.
+    """
+    inspector = inspect(bind)
+    with bind.begin() as conn:
+        for table in Base.metadata.sorted_tables:
+            existing = {column["name"] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    column_type = column.type.compile(dialect=bind.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN "{column.name}" {column_type}')
+                    logger.info(f"Added missing column {table.name}.{column.name}")
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(bind=bind, checkfirst=True)
 
 # Create all tables
 try:
     Base.metadata.create_all(bind=engine)
+    apply_sqlite_migrations(engine)
     logger.info("Database tables created successfully")
 except Exception as e:
     logger.error(f"Error creating database tables: {str(e)}")
@@ -451,8 +488,11 @@ except Exception as e:
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-here")  # Change in production
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# bcrypt cost factor (each step doubles hashing time); hashes made with another cost are
+# rehashed on the user's next successful login
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
 # Pydantic Models
@@ -478,12 +518,39 @@ class TokenData(BaseModel):
 class StoryRequest(BaseModel):
     prompt: str
     chat_id: int
-    mode: Optional[str] = "all"  # one of: all, description, story, test_cases
-    llm_config: Optional[dict] = None  # { "story": {provider, model}, "test_cases": {...}, "description": {...} }
+    mode: Optional[str] = "all"  # one of: all, single_shot, description, story, test_cases
+    llm_config: Optional[dict] = None  # { "story": {provider, model} or [candidates...], "test_cases": ..., "description": ... }
+    use_cache: bool = True  # set to False to bypass the generation cache for this request
+    background: bool = False  # queue as a job and return its id instead of waiting for the result
 
 class StoryResponse(BaseModel):
     story: str
 
+class GenerationJobResponse(BaseModel):
+    id: str
+    chat_id: int
+    status: str
+    artifacts: dict = {}
+    errors: Optional[dict] = None
+    message_id: Optional[int] = None
+    attempts: int = 0
+    created_at: datetime
+    updated_at: datetime
+
+    @classmethod
+    def from_job(cls, job: "GenerationJob") -> "GenerationJobResponse":
+        return cls(
+            id=job.id,
+            chat_id=job.chat_id,
+            status=job.status,
+            artifacts=json.loads(job.artifacts or "{}"),
+            errors=json.loads(job.errors) if job.errors else None,
+            message_id=job.message_id,
+            attempts=job.attempts or 0,
+            created_at=job.created_at,
+            updated_at=job.updated_at,
+        )
+
 class ProjectBase(BaseModel):
     name: str
     overview: str
@@ -525,15 +592,77 @@ class ChatMessageBase(BaseModel):
 class ChatMessageCreate(ChatMessageBase):
     chat_id: int
 
+class MessageArtifactSummary(BaseModel):
+    section: str
+    content_hash: Optional[str] = None
+    encoding: str = "plain"
+    size: int = 0
+    stored_size: int = 0
+    valid: Optional[bool] = None
+    validation_codes: list[str] = []
+    error: Optional[str] = None
+
+    @classmethod
+    def from_artifact(cls, artifact: "MessageArtifact", **extra) -> "MessageArtifactSummary":
+        return cls(
+            section=artifact.section,
+            content_hash=artifact.content_hash,
+            encoding=artifact.encoding or "plain",
+            size=artifact.size or 0,
+            stored_size=artifact.stored_size or 0,
+            valid=artifact.valid,
+            validation_codes=json.loads(artifact.validation_codes or "[]"),
+            error=artifact.error,
+            **extra,
+        )
+
+class MessageArtifactResponse(MessageArtifactSummary):
+    content: Optional[str] = None
+
 class ChatMessageResponse(ChatMessageBase):
     id: int
     user_id: Optional[int] = None
     chat_id: int
     created_at: datetime
+    input_tokens: Optional[int] = None
+    output_tokens: Optional[int] = None
+    # Set instead of the JSON body when a list is requested with include_artifacts=false
+    sections: Optional[list[MessageArtifactSummary]] = None
 
     class Config:
         from_attributes = True
 
+    @classmethod
+    def from_message(cls, message: "ChatMessage", include_artifacts: bool = True) -> "ChatMessageResponse":
+        if include_artifacts or message._message is not None:
+            return cls.model_validate(message)
+        # AI reply without its bodies: the sections can be fetched one at a time from the artifacts endpoints
+        return cls(
+            id=message.id,
+            user_id=message.user_id,
+            chat_id=message.chat_id,
+            created_at=message.created_at,
+            input_tokens=message.input_tokens,
+            output_tokens=message.output_tokens,
+            message="",
+            is_user=message.is_user,
+            sections=[MessageArtifactSummary.from_artifact(artifact) for artifact in message.artifacts],
+        )
+
+class SearchResult(BaseModel):
+    message_id: int
+    chat_id: int
+    chat_title: Optional[str] = None
+    project_id: Optional[int] = None
+    kind: str  # prompt, reply, description, story or test_cases
+    title: str = ""
+    snippet: str  # matches wrapped in <mark></mark>
+    score: float  # bm25; lower is a better match
+    created_at: datetime
+
+class ChatWithMessagesResponse(ChatResponse):
+    messages: list[ChatMessageResponse] = []
+
 # Security Functions
 def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
@@ -541,6 +670,10 @@ def get_password_hash(password: str) -> str:
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     return pwd_context.verify(plain_password, hashed_password)
 
+def verify_and_update_password(plain_password: str, hashed_password: str) -> tuple[bool, str | None]:
+    """Verify a password; also returns a new hash when the stored one uses outdated settings (e.g. BCRYPT_ROUNDS)."""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
 def create_access_token(data: dict, expires_delta: timedelta | None = None) -> str:
     to_encode = data.copy()
     if expires_delta:
@@ -562,35 +695,279 @@ def get_db():
 def get_user(db: Session, email: str):
     return db.query(UserModel).filter(UserModel.email == email).first()
 
-def create_user(db: Session, user: UserCreate):
-    hashed_password = get_password_hash(user.password)
+def store_password_hash(db: Session, user: "UserModel", hashed_password: str) -> None:
+    # Through the ORM so the change also drops the user from auth_user_cache
+    user.hashed_password = hashed_password
+    db.commit()
+
+def create_user(db: Session, user: UserCreate, hashed_password: str | None = None):
+    hashed_password = hashed_password or get_password_hash(user.password)
     db_user = UserModel(email=user.email, hashed_password=hashed_password)
     db.add(db_user)
     db.commit()
     db.refresh(db_user)
     return db_user
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+# --- Authenticated User Cache ---
+# get_current_user resolves the token subject to a user once and then serves it from memory, so an
+# authenticated request on a hit runs no SQL for auth. An entry lives at most AUTH_USER_CACHE_TTL_SECONDS
+# and never past the exp of the token that loaded it. Updating a user's email or password hash or
+# deleting the user through the ORM drops the entry once the change commits; a rolled back change
+# leaves it. A direct SQL change is picked up when the TTL runs out.
+AUTH_USER_CACHE_TTL_SECONDS = int(os.getenv("AUTH_USER_CACHE_TTL_SECONDS", "60"))
+AUTH_USER_CACHE_MAX_ENTRIES = int(os.getenv("AUTH_USER_CACHE_MAX_ENTRIES", "10000"))
+
+class AuthUserCache:
+    """LRU of users detached from their session, keyed by token subject (email)."""
+
+    def __init__(self, ttl_seconds: int, max_entries: int):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, tuple[float, "UserModel"]] = OrderedDict()
+        # Bumped by every invalidation; a load that started before one is not stored
+        self.generation = 0
+        self.counters = dict.fromkeys(("hits", "misses", "expirations", "evictions", "invalidations"), 0)
+
+    def get(self, subject: str) -> Optional["UserModel"]:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(subject)
+            if entry is not None and entry[0] <= now:
+                del self._entries[subject]
+                self.counters["expirations"] += 1
+                entry = None
+            if entry is None:
+                self.counters["misses"] += 1
+                return None
+            self._entries.move_to_end(subject)
+            self.counters["hits"] += 1
+            return entry[1]
+
+    def put(self, subject: str, user: "UserModel", token_exp: Optional[float], generation: int) -> None:
+        if self.max_entries <= 0:
+            return
+        expires_at = time.time() + self.ttl_seconds
+        if token_exp is not None:
+            expires_at = min(expires_at, token_exp)
+        with self._lock:
+            if generation != self.generation:
+                return
+            self._entries[subject] = (expires_at, user)
+            self._entries.move_to_end(subject)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def invalidate(self, *subjects: str) -> None:
+        with self._lock:
+            self.generation += 1
+            for subject in subjects:
+                if self._entries.pop(subject, None) is not None:
+                    self.counters["invalidations"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["entries"] = len(self._entries)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_ratio"] = round(stats["hits"] / lookups, 4) if lookups else 0.0
+        return stats
+
+auth_user_cache = AuthUserCache(AUTH_USER_CACHE_TTL_SECONDS, AUTH_USER_CACHE_MAX_ENTRIES)
+
+def _auth_subjects(user: "UserModel") -> set[str]:
+    """The user's current email plus, if it is being changed, the previous one."""
+    history = inspect(user).attrs.email.history
+    return {email for email in (user.email, *history.deleted) if email}
+
+@event.listens_for(SessionLocal, "after_flush")
+def _collect_auth_invalidations(session: Session, flush_context) -> None:
+    subjects = set()
+    for user in session.deleted:
+        if isinstance(user, UserModel):
+            subjects |= _auth_subjects(user)
+    for user in session.dirty:
+        if isinstance(user, UserModel) and (
+            inspect(user).attrs.email.history.has_changes() or inspect(user).attrs.hashed_password.history.has_changes()
+        ):
+            subjects |= _auth_subjects(user)
+    if subjects:
+        # Dropped at commit: the generation bump there also stops a request that read the old row
+        # before the commit from caching it afterwards
+        session.info.setdefault("auth_invalidations", set()).update(subjects)
+
+@event.listens_for(SessionLocal, "after_commit")
+def _apply_auth_invalidations(session: Session) -> None:
+    subjects = session.info.pop("auth_invalidations", None)
+    if subjects:
+        auth_user_cache.invalidate(*subjects)
+
+@event.listens_for(SessionLocal, "after_rollback")
+def _discard_auth_invalidations(session: Session) -> None:
+    session.info.pop("auth_invalidations", None)
+
+def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)):
+    """
+    The user the bearer token belongs to. Served from auth_user_cache when possible; the returned
+    user is detached from any session, so use its columns (e.g. .id) rather than its relationships.
+    """
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
-    try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
-        email: str = payload.get("sub")
-        if email is None:
+    with trace_span("auth") as span:
+        try:
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+            email: str = payload.get("sub")
+            if email is None:
+                raise credentials_exception
+            token_data = TokenData(email=email)
+        except JWTError:
             raise credentials_exception
-        token_data = TokenData(email=email)
-    except JWTError:
-        raise credentials_exception
-    user = get_user(db, email=token_data.email)
-    if user is None:
-        raise credentials_exception
-    return user
+        user = auth_user_cache.get(token_data.email)
+        span.set(cached=user is not None)
+        if user is not None:
+            return user
+        generation = auth_user_cache.generation
+        user = get_user(db, email=token_data.email)
+        if user is None:
+            raise credentials_exception
+        db.expunge(user)
+        auth_user_cache.put(token_data.email, user, payload.get("exp"), generation)
+        return user
+
+# --- Pagination ---
+# List endpoints page with a keyset on (created_at, id): each page is an index range scan no matter
+# how deep the client has paged. The cursor for the next page is returned in the X-Next-Cursor header.
+# Projects and chats page newest first, so the first page holds the latest rows; message history
+# pages oldest first, the order a transcript is read in. order= flips either. The cursor records
+# the order it was issued for, and reusing it with the other order is rejected.
+PAGE_SIZE_DEFAULT = int(os.getenv("PAGE_SIZE_DEFAULT", "50"))
+PAGE_SIZE_MAX = int(os.getenv("PAGE_SIZE_MAX", "200"))
+
+def encode_cursor(created_at: datetime, row_id: int, order: str) -> str:
+    raw = json.dumps([created_at.isoformat(), row_id, order]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_cursor(cursor: str, order: str) -> tuple[datetime, int]:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        created_at, row_id, cursor_order = json.loads(raw)
+        created_at, row_id = datetime.fromisoformat(created_at), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if cursor_order != order:
+        raise HTTPException(status_code=400, detail=f"Cursor was issued for order={cursor_order}")
+    return created_at, row_id
+
+def paginate(query, model, cursor: Optional[str], limit: Optional[int], response: Response, order: str = "desc") -> list:
+    """One page of query in (created_at, id) order; limit=None returns every row from the cursor on."""
+    if cursor:
+        created_at, row_id = decode_cursor(cursor, order)
+        if order == "desc":
+            query = query.filter(or_(
+                model.created_at < created_at,
+                and_(model.created_at == created_at, model.id < row_id),
+            ))
+        else:
+            query = query.filter(or_(
+                model.created_at > created_at,
+                and_(model.created_at == created_at, model.id > row_id),
+            ))
+    ordering = (model.created_at.desc(), model.id.desc()) if order == "desc" else (model.created_at, model.id)
+    query = query.order_by(*ordering)
+    if limit is None:
+        return query.all()
+    # One extra row tells us whether another page exists without a COUNT query
+    rows = query.limit(limit + 1).all()
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_cursor(rows[-1].created_at, rows[-1].id, order)
+    return rows
+
+# --- Concurrency ---
+# Blocking work never runs on the event loop. LLM calls and password hashing get their own
+# bounded thread pools; database work (sync endpoints, sync dependencies and run_db) shares
+# AnyIO's worker pool, which is capped at DB_POOL_SIZE on startup.
+# bcrypt releases the GIL, so hash threads run on separate cores; the pool defaults to half of them
+# so a burst of logins leaves CPU for the event loop and everything else.
+LLM_POOL_SIZE = int(os.getenv("LLM_POOL_SIZE", "64"))
+HASH_POOL_SIZE = int(os.getenv("HASH_POOL_SIZE", str(max(1, (os.cpu_count() or 2) // 2))))
+# Password checks admitted per client IP at a time, and in total (running or queued for the hash pool)
+LOGIN_MAX_CONCURRENT_PER_IP = int(os.getenv("LOGIN_MAX_CONCURRENT_PER_IP", "2"))
+LOGIN_MAX_PENDING = int(os.getenv("LOGIN_MAX_PENDING", str(HASH_POOL_SIZE * 8)))
+
+llm_executor = ThreadPoolExecutor(max_workers=LLM_POOL_SIZE, thread_name_prefix="llm")
+hash_executor = ThreadPoolExecutor(max_workers=HASH_POOL_SIZE, thread_name_prefix="hash")
+
+async def run_llm(fn, *args, **kwargs):
+    # Carry context variables (llm_usage, llm_section) into the worker thread, as asyncio.to_thread does
+    context = contextvars.copy_context()
+    return await asyncio.get_running_loop().run_in_executor(llm_executor, functools.partial(context.run, fn, *args, **kwargs))
+
+async def run_hash(fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(hash_executor, functools.partial(fn, *args, **kwargs))
+
+async def run_db(fn, *args, **kwargs):
+    return await anyio.to_thread.run_sync(functools.partial(fn, *args, **kwargs))
+
+class HashGate:
+    """
+    Admission control for endpoints that hash passwords. Rejects with 429 instead of queueing once a
+    client already has LOGIN_MAX_CONCURRENT_PER_IP attempts in flight or LOGIN_MAX_PENDING are waiting
+    overall. Used only from the event loop, so it needs no lock.
+    """
+
+    def __init__(self, per_client: int, max_pending: int):
+        self.per_client = per_client
+        self.max_pending = max_pending
+        self._active: dict[str, int] = {}
+        self._pending = 0
+        self.counters = dict.fromkeys(("admitted", "rejected_per_ip", "rejected_overloaded"), 0)
+
+    @asynccontextmanager
+    async def slot(self, client: str):
+        if self._active.get(client, 0) >= self.per_client:
+            self.counters["rejected_per_ip"] += 1
+            raise HTTPException(status_code=429, detail="Too many concurrent login attempts", headers={"Retry-After": "1"})
+        if self._pending >= self.max_pending:
+            self.counters["rejected_overloaded"] += 1
+            raise HTTPException(status_code=429, detail="Too many login attempts in progress; try again shortly", headers={"Retry-After": "1"})
+        self._active[client] = self._active.get(client, 0) + 1
+        self._pending += 1
+        self.counters["admitted"] += 1
+        try:
+            yield
+        finally:
+            self._pending -= 1
+            self._active[client] -= 1
+            if not self._active[client]:
+                del self._active[client]
+
+    def stats(self) -> dict:
+        return {**self.counters, "pending": self._pending, "clients": len(self._active)}
+
+hash_gate = HashGate(LOGIN_MAX_CONCURRENT_PER_IP, LOGIN_MAX_PENDING)
+
+def client_ip(request: Request) -> str:
+    return request.client.host if request.client else "unknown"
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    anyio.to_thread.current_default_thread_limiter().total_tokens = DB_POOL_SIZE
+    await on_startup()
+    start_job_workers()
+    yield
+    await stop_job_workers()
+    await anyio.to_thread.run_sync(context_cache.close)
+    llm_executor.shutdown(wait=False, cancel_futures=True)
+    hash_executor.shutdown(wait=False, cancel_futures=True)
+    trace_writer.shutdown(wait=True)
 
 # Initialize FastAPI app
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 
 # Configure CORS
 app.add_middleware(
@@ -599,62 +976,1217 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],  # Allow all methods
     allow_headers=["*"],  # Allow all headers
-    expose_headers=["*"],  # Expose all headers
+    # A wildcard is not honoured for credentialed requests, so headers clients read are listed by name
+    expose_headers=["X-Next-Cursor", "X-Trace-ID", "X-Profile-File"],
     max_age=3600,  # Cache preflight requests for 1 hour
 )
 
-# Configure Gemini AI (do not hard-fail if missing; allow server to start in guest mode)
-GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
-logger.info("Configuring Gemini AI...")
-if not GEMINI_API_KEY:
-    logger.warning("GEMINI_API_KEY is not set. Generation endpoints will return an error until it is configured.")
+# --- Metrics ---
+# In-process metrics rendered in the Prometheus text format at /metrics (no client library needed).
+# Recording is lock-free on the hot path: every labelled series keeps one value array per thread and
+# a thread only ever writes its own, so a sample costs a thread-local lookup and an add. A scrape
+# sums the arrays. Gauges, and counters the limiter, caches and hedging already keep, are read from
+# their stats() through collectors at scrape time, so they cost nothing between scrapes.
+LLM_LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 15, 30, 60, 120)
+DB_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1)
+HTTP_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+DB_QUERIES_PER_REQUEST_BUCKETS = (0, 1, 2, 4, 8, 16, 32, 64, 128)
+
+class _Series:
+    """Per-thread value arrays for one label set: writers never share an array, readers sum them."""
+    __slots__ = ("size", "_local", "_arrays", "_lock")
+
+    def __init__(self, size: int):
+        self.size = size
+        self._local = threading.local()
+        self._arrays: list[list] = []
+        self._lock = threading.Lock()
+
+    def values(self) -> list:
+        """This thread's array; the lock is only taken the first time a thread records."""
+        try:
+            return self._local.values
+        except AttributeError:
+            values = self._local.values = [0] * self.size
+            with self._lock:
+                self._arrays.append(values)
+            return values
+
+    def total(self) -> list:
+        with self._lock:
+            arrays = list(self._arrays)
+        return [sum(column) for column in zip(*arrays)] if arrays else [0] * self.size
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), size: int = 1):
+        self.name = name
+        self.help = help
+        self.labelnames = labelnames
+        self._size = size
+        self._series: dict[tuple, _Series] = {}
+        self._lock = threading.Lock()
+
+    def _values(self, labels: tuple) -> list:
+        series = self._series.get(labels)
+        if series is None:
+            with self._lock:
+                series = self._series.setdefault(labels, _Series(self._size))
+        return series.values()
+
+    def samples(self) -> list[tuple[str, tuple, tuple, float]]:
+        """(suffix, label names, label values, value) rows for the exposition."""
+        with self._lock:
+            series = list(self._series.items())
+        return [("", self.labelnames, labels, s.total()[0]) for labels, s in sorted(series)]
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, *labels: str) -> None:
+        self._values(labels)[0] += amount
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = HTTP_LATENCY_BUCKETS):
+        # One count per bucket (non-cumulative, the last is +Inf) followed by the running sum
+        super().__init__(name, help, labelnames, size=len(buckets) + 2)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, *labels: str) -> None:
+        values = self._values(labels)
+        values[bisect.bisect_left(self.buckets, value)] += 1
+        values[-1] += value
+
+    def samples(self) -> list[tuple[str, tuple, tuple, float]]:
+        with self._lock:
+            series = list(self._series.items())
+        rows = []
+        names = self.labelnames + ("le",)
+        for labels, s in sorted(series):
+            total = s.total()
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), total):
+                cumulative += count
+                rows.append(("_bucket", names, labels + (_format_bound(bound),), cumulative))
+            rows.append(("_sum", self.labelnames, labels, total[-1]))
+            rows.append(("_count", self.labelnames, labels, cumulative))
+        return rows
+
+class Collector(Metric):
+    """A gauge or counter whose values come from collect() -> [(label values, value)] at scrape time."""
+
+    def __init__(self, name: str, help: str, kind: str, labelnames: tuple, collect: Callable):
+        super().__init__(name, help, labelnames)
+        self.kind = kind
+        self.collect = collect
+
+    def samples(self) -> list[tuple[str, tuple, tuple, float]]:
+        return [("", self.labelnames, tuple(labels), value) for labels, value in self.collect()]
+
+def _format_bound(bound) -> str:
+    return bound if isinstance(bound, str) else repr(float(bound))
+
+def _escape_label(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_value(value) -> str:
+    if value is None:
+        return "NaN"
+    if isinstance(value, bool):
+        return "1" if value else "0"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class MetricsRegistry:
+    def __init__(self, namespace: str):
+        self.namespace = namespace
+        self._metrics: list[Metric] = []
+
+    def _register(self, metric: Metric) -> Metric:
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: tuple = ()) -> Counter:
+        return self._register(Counter(f"{self.namespace}_{name}", help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: tuple = (), buckets: tuple = HTTP_LATENCY_BUCKETS) -> Histogram:
+        return self._register(Histogram(f"{self.namespace}_{name}", help, labelnames, buckets))
+
+    def collector(self, name: str, help: str, kind: str, labelnames: tuple, collect: Callable) -> Collector:
+        return self._register(Collector(f"{self.namespace}_{name}", help, kind, labelnames, collect))
+
+    def render(self) -> str:
+        """Prometheus text exposition format, version 0.0.4."""
+        lines = []
+        for metric in self._metrics:
+            try:
+                samples = metric.samples()
+            except Exception as e:
+                # One broken collector must not take the whole scrape down
+                logger.warning(f"Metric {metric.name} failed to collect: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for suffix, names, labels, value in samples:
+                label_text = ",".join(f'{name}="{_escape_label(label)}"' for name, label in zip(names, labels))
+                lines.append(f"{metric.name}{suffix}{{{label_text}}} {_format_value(value)}" if label_text
+                             else f"{metric.name}{suffix} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+metrics = MetricsRegistry("storycrafter")
+llm_request_seconds = metrics.histogram(
+    "llm_request_duration_seconds", "LLM provider call latency, excluding time queued in the limiter.",
+    ("provider", "section", "outcome"), LLM_LATENCY_BUCKETS,
+)
+llm_tokens_total = metrics.counter("llm_tokens_total", "LLM tokens by direction and artifact section.", ("direction", "section"))
+llm_candidate_failures_total = metrics.counter(
+    "llm_candidate_failures_total", "Routed LLM calls that failed on a candidate; the router falls over to the next one.", ("provider",),
+)
 
-# Define system prompt
-SYSTEM_PROMPT = """
-You are **StoryCrafter Pro**, an elite AI assistant acting as a Principal Technical Product Manager. Your primary directive is to transform a single, high-level product requirement into a comprehensive and structured set of three distinct, backlog-ready artifacts: a **Feature Description**, a **User Story with Acceptance Criteria**, and **formal Test Cases**.
+# --- Request Metrics ---
+# Latency per route, and the SQL each request runs. The engine hooks add every statement's duration
+# to the request's RequestQueries, which a context variable carries into run_db and threadpool
+# workers; statements run outside a request (job workers, startup) are reported as "background".
+http_request_seconds = metrics.histogram(
+    "http_request_duration_seconds", "HTTP request latency by route template.", ("method", "endpoint", "status"),
+)
+db_query_seconds = metrics.histogram("db_query_duration_seconds", "SQL statement latency.", (), DB_LATENCY_BUCKETS)
+db_queries_total = metrics.counter("db_queries_total", "SQL statements by endpoint.", ("endpoint",))
+db_query_seconds_total = metrics.counter("db_query_seconds_total", "Time spent in SQL statements by endpoint.", ("endpoint",))
+db_queries_per_request = metrics.histogram(
+    "db_queries_per_request", "SQL statements per HTTP request.", ("endpoint",), DB_QUERIES_PER_REQUEST_BUCKETS,
+)
 
-You must meticulously follow a three-step process to ensure clarity for all stakeholders, from business executives to QA engineers.
+class RequestQueries:
+    """SQL statements run on behalf of one request; a request's run_db calls may overlap."""
+    __slots__ = ("count", "seconds", "_lock")
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def add(self, seconds: float) -> None:
+        with self._lock:
+            self.count += 1
+            self.seconds += seconds
+
+request_queries: contextvars.ContextVar = contextvars.ContextVar("request_queries", default=None)
+
+@event.listens_for(engine, "before_cursor_execute")
+def _start_query_timer(conn, cursor, statement, parameters, context, executemany):
+    context._metrics_started = time.perf_counter()
+
+@event.listens_for(engine, "after_cursor_execute")
+def _record_query(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - context._metrics_started
+    db_query_seconds.observe(elapsed)
+    queries = request_queries.get()
+    if queries is not None:
+        queries.add(elapsed)
+    else:
+        db_queries_total.inc(1, "background")
+        db_query_seconds_total.inc(elapsed, "background")
+
+class RequestMetricsMiddleware:
+    """Plain ASGI middleware, so streamed responses are timed until their last chunk is sent."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        queries = RequestQueries()
+        token = request_queries.set(queries)
+        started = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            request_queries.reset(token)
+            # The route template rather than the raw path keeps label cardinality bounded
+            endpoint = getattr(scope.get("route"), "path", None) or "unmatched"
+            http_request_seconds.observe(time.perf_counter() - started, scope["method"], endpoint, str(status_code))
+            db_queries_per_request.observe(queries.count, endpoint)
+            if queries.count:
+                db_queries_total.inc(queries.count, endpoint)
+                db_query_seconds_total.inc(queries.seconds, endpoint)
+
+app.add_middleware(RequestMetricsMiddleware)
+
+# --- Request Tracing ---
+# Nested spans for one request: auth, chat lookup, the user-message commit, each section and LLM
+# call, validation, retries and the final commit. A request is traced when it is sampled
+# (TRACE_SAMPLE_RATE) or when an admin sends X-Debug-Trace: 1; each finished trace is appended to
+# TRACE_FILE as one JSON line, and admin-requested ones also get their spans back in a Server-Timing
+# header (for streamed responses, only spans that ended before the first byte). An admin can also
+# send X-Debug-Profile: 1 to sample every thread's stack while the request runs; the profile is
+# saved under PROFILE_DIR in collapsed-stack format, which flamegraph.pl and speedscope read.
+# "Admin" means the request carries X-Debug-Token equal to DEBUG_ADMIN_TOKEN; while that is unset
+# the debug headers are ignored. An untraced request pays one context variable lookup per span.
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "0"))
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+DEBUG_ADMIN_TOKEN = os.getenv("DEBUG_ADMIN_TOKEN", "")
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_MAX_SECONDS = float(os.getenv("PROFILE_MAX_SECONDS", "300"))
+
+class Trace:
+    def __init__(self):
+        self.trace_id = uuid.uuid4().hex
+        self.started = time.perf_counter()
+        self.spans: list[dict] = []
+        self._lock = threading.Lock()
+        self._last_id = 0
+
+    def next_id(self) -> int:
+        with self._lock:
+            self._last_id += 1
+            return self._last_id
+
+    def add(self, span: dict) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def sorted_spans(self) -> list[dict]:
+        with self._lock:
+            return sorted(self.spans, key=lambda span: span["start_ms"])
+
+    def server_timing(self) -> str:
+        entries = []
+        for span in self.sorted_spans():
+            desc = span.get("section") or span.get("provider")
+            entries.append(f'{span["name"]};desc="{desc}";dur={span["duration_ms"]}' if desc
+                           else f'{span["name"]};dur={span["duration_ms"]}')
+        return ", ".join(entries)
+
+class Span:
+    __slots__ = ("trace", "name", "attrs", "span_id", "parent_id", "started", "_token")
+
+    def __init__(self, trace: Trace, name: str, attrs: dict):
+        self.trace = trace
+        self.name = name
+        self.attrs = attrs
+
+    def set(self, **attrs) -> None:
+        self.attrs.update(attrs)
+
+    def __enter__(self) -> "Span":
+        self.span_id = self.trace.next_id()
+        self.parent_id = current_span_id.get()
+        self._token = current_span_id.set(self.span_id)
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        ended = time.perf_counter()
+        current_span_id.reset(self._token)
+        record = {
+            "id": self.span_id,
+            "parent": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.started - self.trace.started) * 1000, 3),
+            "duration_ms": round((ended - self.started) * 1000, 3),
+            "thread": threading.current_thread().name,
+            **self.attrs,
+        }
+        if exc is not None:
+            record["error"] = f"{exc_type.__name__}: {_describe_error(exc)}"
+        self.trace.add(record)
+        return False
+
+class _NoopSpan:
+    def set(self, **attrs) -> None:
+        pass
+
+    def __enter__(self) -> "_NoopSpan":
+        return self
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+_NOOP_SPAN = _NoopSpan()
+
+# Context variables, so spans opened in run_db/run_llm threads and in tasks nest under their caller
+current_trace: contextvars.ContextVar = contextvars.ContextVar("current_trace", default=None)
+current_span_id: contextvars.ContextVar = contextvars.ContextVar("current_span_id", default=None)
+
+def trace_span(name: str, **attrs):
+    """A span for `with`; a shared no-op unless the current request is traced."""
+    trace = current_trace.get()
+    if trace is None:
+        return _NOOP_SPAN
+    return Span(trace, name, attrs)
+
+class StackSampler:
+    """Wall-clock sampler: counts each thread's Python stack every interval, in collapsed-stack form."""
+
+    def __init__(self, interval: float, max_seconds: float):
+        self.interval = interval
+        self.max_seconds = max_seconds
+        self.samples = 0
+        self.counts: dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self) -> None:
+        self._thread.start()
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        deadline = time.monotonic() + self.max_seconds
+        while not self._stop.wait(self.interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{os.path.basename(code.co_filename)}:{getattr(code, 'co_qualname', code.co_name)}")
+                    frame = frame.f_back
+                # The thread is the root frame so pool threads and the event loop separate in the graph
+                stack.append(names.get(ident, str(ident)).replace(" ", "_"))
+                key = ";".join(reversed(stack)).replace(" ", "_")
+                self.counts[key] = self.counts.get(key, 0) + 1
+            self.samples += 1
+
+    def stop(self) -> str:
+        """Stop sampling and return the profile, one 'frame;frame;... count' line per distinct stack."""
+        self._stop.set()
+        self._thread.join()
+        return "".join(f"{stack} {count}\n" for stack, count in sorted(self.counts.items()))
+
+# One profile at a time; trace files and profiles are written off the event loop, in order
+_profile_lock = threading.Lock()
+trace_writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="trace-writer")
+
+def _debug_flags(scope) -> set[str]:
+    headers = dict(scope["headers"])
+    token = headers.get(b"x-debug-token", b"")
+    if not token or not hmac.compare_digest(token, DEBUG_ADMIN_TOKEN.encode()):
+        return set()
+    return {flag for flag in ("trace", "profile") if headers.get(f"x-debug-{flag}".encode()) in (b"1", b"true")}
+
+def _finish_trace(record: dict, sampler: Optional[StackSampler], profile_path: Optional[str]) -> None:
+    try:
+        if sampler is not None:
+            try:
+                folded = sampler.stop()
+            finally:
+                _profile_lock.release()
+            os.makedirs(PROFILE_DIR, exist_ok=True)
+            with open(profile_path, "w", encoding="utf-8") as f:
+                f.write(folded)
+            record["profile"] = {"file": profile_path, "samples": sampler.samples}
+        with open(TRACE_FILE, "a", encoding="utf-8") as f:
+            f.write(json.dumps(record, default=str) + "\n")
+    except Exception as e:
+        logger.warning(f"Failed to write trace {record['trace_id']}: {e}")
+
+class RequestTracingMiddleware:
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        debug = _debug_flags(scope) if DEBUG_ADMIN_TOKEN else set()
+        if not debug and not (TRACE_SAMPLE_RATE > 0 and random.random() < TRACE_SAMPLE_RATE):
+            await self.app(scope, receive, send)
+            return
+
+        trace = Trace()
+        token = current_trace.set(trace)
+        sampler = profile_path = None
+        if "profile" in debug and _profile_lock.acquire(blocking=False):
+            sampler = StackSampler(PROFILE_INTERVAL_MS / 1000, PROFILE_MAX_SECONDS)
+            profile_path = os.path.join(PROFILE_DIR, f"{trace.trace_id}.folded")
+            sampler.start()
+        status_code = 500
+
+        async def send_traced(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                headers = list(message.get("headers", []))
+                headers.append((b"x-trace-id", trace.trace_id.encode()))
+                if "trace" in debug:
+                    headers.append((b"server-timing", trace.server_timing().encode("latin-1", "replace")))
+                if profile_path is not None:
+                    headers.append((b"x-profile-file", profile_path.encode("latin-1", "replace")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_traced)
+        finally:
+            current_trace.reset(token)
+            record = {
+                "trace_id": trace.trace_id,
+                "method": scope["method"],
+                "path": scope["path"],
+                "route": getattr(scope.get("route"), "path", None),
+                "status": status_code,
+                "duration_ms": round((time.perf_counter() - trace.started) * 1000, 3),
+                "requested": "debug" if debug else "sampled",
+                "spans": trace.sorted_spans(),
+            }
+            # Submitted rather than awaited so a cancelled request still stops its sampler
+            trace_writer.submit(_finish_trace, record, sampler, profile_path)
+
+app.add_middleware(RequestTracingMiddleware)
+
+# --- LLM Rate Limiting ---
+# Every LLM call (direct Gemini calls, their retries and the LangChain chains) goes through one
+# shared limiter: token buckets for requests and tokens per minute, plus an AIMD concurrency limit
+# that halves on 429s, shrinks on latency spikes and grows by ~1 per round trip otherwise. Callers
+# queue FIFO until LLM_QUEUE_TIMEOUT_SECONDS instead of failing straight away; 429s are retried
+# with backoff inside the same deadline.
+LLM_RPM = int(os.getenv("LLM_RPM", "0"))  # 0 disables the requests-per-minute bucket
+LLM_TPM = int(os.getenv("LLM_TPM", "0"))  # 0 disables the tokens-per-minute bucket
+LLM_CONCURRENCY_INITIAL = int(os.getenv("LLM_CONCURRENCY_INITIAL", "8"))
+LLM_CONCURRENCY_MIN = int(os.getenv("LLM_CONCURRENCY_MIN", "1"))
+LLM_CONCURRENCY_MAX = int(os.getenv("LLM_CONCURRENCY_MAX", "32"))
+LLM_QUEUE_TIMEOUT_SECONDS = float(os.getenv("LLM_QUEUE_TIMEOUT_SECONDS", "60"))
+LLM_RATE_LIMIT_RETRIES = int(os.getenv("LLM_RATE_LIMIT_RETRIES", "3"))
+LLM_LATENCY_SPIKE_FACTOR = float(os.getenv("LLM_LATENCY_SPIKE_FACTOR", "3.0"))
+LLM_OUTPUT_TOKENS_ESTIMATE = int(os.getenv("LLM_OUTPUT_TOKENS_ESTIMATE", "1024"))
+
+class LLMUsage:
+    """LLM calls and input/output tokens spent on one generation, in total and per section."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.sections: dict[str, dict] = {}
+
+    def _section(self, section: Optional[str]) -> dict:
+        return self.sections.setdefault(section or "other", {"calls": 0, "input_tokens": 0, "output_tokens": 0})
+
+    def add_call(self, section: Optional[str]) -> None:
+        with self._lock:
+            self.calls += 1
+            self._section(section)["calls"] += 1
+
+    def add_tokens(self, section: Optional[str], input_tokens: int, output_tokens: int) -> None:
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            bucket = self._section(section)
+            bucket["input_tokens"] += input_tokens
+            bucket["output_tokens"] += output_tokens
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "input_tokens": self.input_tokens,
+                "output_tokens": self.output_tokens,
+                "sections": {name: dict(bucket) for name, bucket in self.sections.items()},
+            }
+
+# The generation (LLMUsage) and artifact section the current task is working for; run_llm carries
+# both into worker threads so every call site can attribute its calls and tokens
+llm_usage: contextvars.ContextVar = contextvars.ContextVar("llm_usage", default=None)
+llm_section: contextvars.ContextVar = contextvars.ContextVar("llm_section", default=None)
+
+def time_llm_call(provider: str, fn):
+    """Run one provider call (fn) and record its latency by provider, section and outcome."""
+    started = time.perf_counter()
+    outcome = "error"
+    try:
+        with trace_span("llm_call", provider=provider, section=llm_section.get()):
+            result = fn()
+        outcome = "ok"
+        return result
+    finally:
+        llm_request_seconds.observe(time.perf_counter() - started, provider, llm_section.get() or "other", outcome)
+
+def count_llm_call() -> None:
+    usage = llm_usage.get()
+    if usage is not None:
+        usage.add_call(llm_section.get())
+
+def record_llm_tokens(input_tokens: int, output_tokens: int) -> None:
+    section = llm_section.get()
+    llm_tokens_total.inc(input_tokens, "input", section or "other")
+    llm_tokens_total.inc(output_tokens, "output", section or "other")
+    usage = llm_usage.get()
+    if usage is not None:
+        usage.add_tokens(section, input_tokens, output_tokens)
+
+def estimate_tokens(text: str) -> int:
+    """Rough prompt + completion size for the TPM bucket (~4 characters per token)."""
+    return len(text) // 4 + LLM_OUTPUT_TOKENS_ESTIMATE
+
+RATE_LIMIT_ERRORS = (google_exceptions.ResourceExhausted, google_exceptions.TooManyRequests)
+
+def is_rate_limit_error(exc: BaseException) -> bool:
+    """True for a quota/429 error, including one wrapped by LangChain as the cause or context."""
+    seen = set()
+    while exc is not None and id(exc) not in seen:
+        seen.add(id(exc))
+        if isinstance(exc, RATE_LIMIT_ERRORS):
+            return True
+        for attr in ("code", "status_code"):
+            value = getattr(exc, attr, None)
+            if isinstance(value, int) and not isinstance(value, bool) and value == 429:
+                return True
+        exc = exc.__cause__ or exc.__context__
+    return False
+
+class TokenBucket:
+    def __init__(self, per_minute: int):
+        self.capacity = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        self._refill(now)
+        amount = min(amount, self.capacity)
+        return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def take(self, amount: float) -> None:
+        self.tokens -= min(amount, self.capacity)
+
+    def drain(self) -> None:
+        self.tokens = min(self.tokens, 0.0)
+
+class AdaptiveLimiter:
+    """Thread-safe limiter shared by all LLM call sites; see the section comment above."""
+
+    def __init__(self, rpm: int, tpm: int, initial: int, minimum: int, maximum: int, spike_factor: float):
+        self._cond = threading.Condition()
+        self._queue: deque = deque()
+        self._rpm = TokenBucket(rpm) if rpm > 0 else None
+        self._tpm = TokenBucket(tpm) if tpm > 0 else None
+        self.minimum = minimum
+        self.maximum = maximum
+        self.limit = float(max(minimum, min(initial, maximum)))
+        self.spike_factor = spike_factor
+        self.in_flight = 0
+        self._latency_ewma: Optional[float] = None
+        self.counters = {"calls": 0, "rate_limited": 0, "retries": 0, "latency_backoffs": 0, "queue_timeouts": 0}
+
+    def _bucket_wait(self, tokens: int, now: float) -> float:
+        waits = [0.0]
+        if self._rpm is not None:
+            waits.append(self._rpm.wait_time(1, now))
+        if self._tpm is not None:
+            waits.append(self._tpm.wait_time(tokens, now))
+        return max(waits)
+
+    def acquire(self, tokens: int, deadline: float) -> None:
+        ticket = object()
+        with self._cond:
+            self._queue.append(ticket)
+            try:
+                while True:
+                    now = time.monotonic()
+                    wait = None
+                    if self._queue[0] is ticket and self.in_flight < int(self.limit):
+                        wait = self._bucket_wait(tokens, now)
+                        if wait == 0:
+                            if self._rpm is not None:
+                                self._rpm.take(1)
+                            if self._tpm is not None:
+                                self._tpm.take(tokens)
+                            self.in_flight += 1
+                            self.counters["calls"] += 1
+                            return
+                    remaining = deadline - now
+                    if remaining <= 0:
+                        self.counters["queue_timeouts"] += 1
+                        raise HTTPException(
+                            status_code=429,
+                            detail="LLM capacity is exhausted; try again shortly",
+                            headers={"Retry-After": str(max(1, int(wait or 1)))},
+                        )
+                    self._cond.wait(min(remaining, wait) if wait else remaining)
+            finally:
+                self._queue.remove(ticket)
+                self._cond.notify_all()
+
+    def release(self, latency: Optional[float], rate_limited: bool = False) -> None:
+        with self._cond:
+            self.in_flight -= 1
+            if rate_limited:
+                self.counters["rate_limited"] += 1
+                self.limit = max(self.minimum, self.limit / 2)
+                # Pause everyone until the quota window refills
+                for bucket in (self._rpm, self._tpm):
+                    if bucket is not None:
+                        bucket.drain()
+            elif latency is not None:
+                if self._latency_ewma is not None and latency > self.spike_factor * self._latency_ewma:
+                    self.counters["latency_backoffs"] += 1
+                    self.limit = max(self.minimum, self.limit * 0.9)
+                else:
+                    self.limit = min(self.maximum, self.limit + 1 / self.limit)
+                self._latency_ewma = latency if self._latency_ewma is None else 0.9 * self._latency_ewma + 0.1 * latency
+            self._cond.notify_all()
+
+    def call(self, fn, tokens: int, timeout: Optional[float] = None):
+        """Run fn() under the limiter, retrying 429s with jittered backoff until the deadline."""
+        deadline = time.monotonic() + (timeout if timeout is not None else LLM_QUEUE_TIMEOUT_SECONDS)
+        attempt = 0
+        while True:
+            self.acquire(tokens, deadline)
+            started = time.monotonic()
+            try:
+                result = fn()
+            except Exception as exc:
+                if not is_rate_limit_error(exc):
+                    self.release(None)
+                    raise
+                self.release(None, rate_limited=True)
+                attempt += 1
+                backoff = min(2 ** attempt, 30) * (0.5 + random.random() / 2)
+                if attempt > LLM_RATE_LIMIT_RETRIES or time.monotonic() + backoff >= deadline:
+                    raise HTTPException(
+                        status_code=429,
+                        detail="LLM provider rate limit reached; try again shortly",
+                        headers={"Retry-After": str(int(backoff) + 1)},
+                    ) from exc
+                with self._cond:
+                    self.counters["retries"] += 1
+                logger.info(f"LLM call rate limited, retrying in {backoff:.1f}s (attempt {attempt})")
+                time.sleep(backoff)
+                continue
+            self.release(time.monotonic() - started)
+            return result
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                **self.counters,
+                "limit": round(self.limit, 2),
+                "in_flight": self.in_flight,
+                "queued": len(self._queue),
+                "latency_ewma_seconds": round(self._latency_ewma, 3) if self._latency_ewma is not None else None,
+            }
+
+llm_limiter = AdaptiveLimiter(
+    LLM_RPM, LLM_TPM, LLM_CONCURRENCY_INITIAL, LLM_CONCURRENCY_MIN, LLM_CONCURRENCY_MAX, LLM_LATENCY_SPIKE_FACTOR,
+)
 
-**### PROCESS ###**
+# --- LangChain Orchestration ---
+# LLM clients and composed chains are built lazily once per configuration and reused across
+# requests, so every request shares the same clients (and their keep-alive connections). Both
+# registries are small LRUs, since configurations come from request bodies.
+LLM_REGISTRY_MAX_ENTRIES = int(os.getenv("LLM_REGISTRY_MAX_ENTRIES", "32"))
+_chat_llm_registry: OrderedDict = OrderedDict()
+_chains_registry: OrderedDict = OrderedDict()
+_registry_lock = threading.Lock()
+
+def _registry_key(*parts) -> str:
+    return json.dumps(parts, sort_keys=True, default=str)
+
+def _registry_get(registry: OrderedDict, key: str):
+    with _registry_lock:
+        value = registry.get(key)
+        if value is not None:
+            registry.move_to_end(key)
+        return value
+
+def _registry_put(registry: OrderedDict, key: str, value):
+    """Store value unless another thread got there first; returns the stored value."""
+    with _registry_lock:
+        value = registry.setdefault(key, value)
+        registry.move_to_end(key)
+        while len(registry) > LLM_REGISTRY_MAX_ENTRIES:
+            registry.popitem(last=False)
+        return value
+
+class UnsupportedProviderError(ValueError):
+    """An llm_config or candidate names a provider that is not registered."""
+
+# The only client parameters a request's llm_config may set: name -> (type, minimum, maximum), plus
+# any a provider declares in its "params". Anything else (base_url, transport, client options, ...)
+# would let a caller redirect the server's API key and traffic, so it is rejected.
+LLM_TUNABLE_PARAMS = {
+    "temperature": (float, 0.0, 2.0),
+    "top_p": (float, 0.0, 1.0),
+    "top_k": (int, 1, 100),
+    "max_output_tokens": (int, 1, 8192),
+}
+LLM_CONFIG_SECTIONS = ("story", "description", "test_cases")
+
+def _validate_llm_params(provider: str, params: dict) -> dict:
+    """The params of one candidate, checked against the allowed names, types and ranges; ValueError otherwise."""
+    allowed = {**LLM_TUNABLE_PARAMS, **LLM_PROVIDERS[provider].get("params", {})}
+    checked = {}
+    for name, value in params.items():
+        if name not in allowed:
+            raise ValueError(f"Unsupported LLM parameter: {name}")
+        kind, minimum, maximum = allowed[name]
+        if kind is bool:
+            if not isinstance(value, bool):
+                raise ValueError(f"LLM parameter {name} must be a bool")
+            checked[name] = value
+            continue
+        if isinstance(value, bool) or not isinstance(value, (int, float)) or (kind is int and not isinstance(value, int)):
+            raise ValueError(f"LLM parameter {name} must be a {kind.__name__}")
+        if not minimum <= value <= maximum:
+            raise ValueError(f"LLM parameter {name} must be between {minimum} and {maximum}")
+        checked[name] = kind(value)
+    return checked
+
+def _validate_candidate(cfg) -> None:
+    if not isinstance(cfg, dict):
+        raise ValueError("Each LLM candidate must be an object")
+    provider = cfg.get("provider") or "gemini"
+    if not isinstance(provider, str) or provider.lower() not in LLM_PROVIDERS:
+        raise UnsupportedProviderError(f"Unsupported LLM provider: {provider}")
+    model_name = cfg.get("model")
+    if model_name is not None and (not isinstance(model_name, str) or not re.fullmatch(r"[\w.\-/]{1,100}", model_name)):
+        raise ValueError("Invalid LLM model name")
+    _validate_llm_params(provider.lower(), {k: v for k, v in cfg.items() if k not in ("provider", "model")})
+
+def validate_llm_config(llm_config) -> None:
+    """Reject (400) an llm_config with unknown sections, providers or client parameters."""
+    if not llm_config:
+        return
+    try:
+        if not isinstance(llm_config, dict):
+            raise ValueError("llm_config must be an object keyed by section")
+        for section, cfg in llm_config.items():
+            if section not in LLM_CONFIG_SECTIONS:
+                raise ValueError(f"Unknown llm_config section: {section}")
+            for candidate in (cfg if isinstance(cfg, list) else [cfg]):
+                _validate_candidate(candidate)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+class StubChatModel(BaseChatModel):
+    """
+    Deterministic offline provider ("stub"). Returns template-shaped output derived from the prompt,
+    after an optional fixed latency, so routing and chains can be exercised without an API key.
+    """
+    latency: float = 0.0
+    fail: bool = False
+
+    @property
+    def _llm_type(self) -> str:
+        return "stub"
+
+    def _generate(self, messages, stop=None, run_manager=None, **kwargs) -> ChatResult:
+        if self.latency:
+            time.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError("stub provider configured to fail")
+        prompt = "\n".join(str(message.content) for message in messages)
+        subject = prompt.strip().splitlines()[-1].split(":", 1)[-1].strip()[:80] or "the feature"
+        if "Gherkin" in prompt:
+            text = (
+                f"Feature: {subject}\n\n  Scenario: Happy path\n    Given the feature is available\n"
+                f"    When the user uses it\n    Then it succeeds\n\n  Scenario Outline: Invalid input\n"
+                f"    Given the feature is available\n    When the user enters \"<value>\"\n    Then an error is shown\n\n"
+                f"    Examples:\n      | value |\n      | bad   |"
+            )
+        elif "Feature Brief" in prompt:
+            text = (
+                f"**Feature:** {subject}\n\n**Summary:** Delivers {subject}.\n\n**Problem:** Users cannot do this today.\n\n"
+                f"**Solution:** Provide {subject}.\n\n**Scope:**\n* Core flow\n* Error handling"
+            )
+        else:
+            text = (
+                f"User Story: As a user, I want to use {subject}, so that I can finish my work faster.\n\n"
+                "ACCEPTANCE CRITERIA:\nGIVEN a user, WHEN they start, THEN it works.\n\n"
+                "ACCEPTANCE CRITERIA:\nGIVEN bad input, WHEN they submit, THEN an error is shown."
+            )
+        return ChatResult(generations=[ChatGeneration(message=AIMessage(content=text))])
+
+def _create_gemini_llm(selected_model: str | None, params: dict):
+    if not GEMINI_API_KEY:
+        raise RuntimeError("GEMINI_API_KEY is required for Gemini provider")
+    # Retries are left to llm_limiter so it sees every 429
+    params.setdefault("max_retries", 1)
+    return ChatGoogleGenerativeAI(model=selected_model, google_api_key=GEMINI_API_KEY, **params)
+
+def _create_stub_llm(selected_model: str | None, params: dict):
+    return StubChatModel(**params)
+
+# Provider registry: name -> factory(model, params), default model, whether calls count against the
+# shared Gemini quota (llm_limiter), and any provider-specific llm_config params
+LLM_PROVIDERS = {
+    "gemini": {"factory": _create_gemini_llm, "default_model": "gemini-1.5-flash", "rate_limited": True},
+}
+# The offline stub returns fake (if well-formed) artifacts, so it is only selectable in tests and local dev
+LLM_STUB_ENABLED = os.getenv("LLM_STUB_ENABLED", "false").lower() in ("1", "true", "yes")
+
+def register_provider(name: str, factory, default_model: str | None = None, rate_limited: bool = False,
+                      params: dict | None = None) -> None:
+    """params: extra llm_config parameters the provider accepts, name -> (type, minimum, maximum)."""
+    LLM_PROVIDERS[name.lower()] = {
+        "factory": factory, "default_model": default_model, "rate_limited": rate_limited, "params": params or {},
+    }
 
-1.  **Analyze & Deconstruct:** First, deeply analyze the user's requirement to identify the core user, their goal, the problem being solved, and any implied business rules or technical constraints.
-2.  **Think Technically, Write Strategically:** Use your analysis to think through the system's behavior, potential edge cases, and success/failure states.
-3.  **Generate Artifacts:** Use this deep understanding to populate the three mandatory output templates below. Adhere to the specified format for each artifact without deviation.
+if LLM_STUB_ENABLED:
+    register_provider("stub", _create_stub_llm, "stub", params={"latency": (float, 0.0, 60.0), "fail": (bool, None, None)})
 
-**### OUTPUT TEMPLATES ###**
+# Provider-agnostic LLM factory so each artifact can use a different model
+def get_chat_llm(provider: str | None = None, model: str | None = None, **params):
+    provider = (provider or "gemini").lower()
+    spec = LLM_PROVIDERS.get(provider)
+    if spec is None:
+        raise UnsupportedProviderError(f"Unsupported LLM provider: {provider}")
+    selected_model = model or spec["default_model"]
+    params = _validate_llm_params(provider, params)
+    key = _registry_key(provider, selected_model, params)
+    llm = _registry_get(_chat_llm_registry, key)
+    if llm is None:
+        llm = _registry_put(_chat_llm_registry, key, spec["factory"](selected_model, dict(params)))
+    return llm
+
+def _llm_from_config(cfg: dict):
+    params = {k: v for k, v in cfg.items() if k not in ("provider", "model")}
+    return get_chat_llm(cfg.get("provider"), cfg.get("model"), **params)
+
+# --- Provider Routing ---
+# Each artifact has an ordered list of candidate {provider, model, ...} configs. The router keeps a
+# rolling latency and error rate per candidate and sends each call to the fastest healthy one;
+# candidates with no recent samples are tried first so a recovered or new backend gets measured.
+# A circuit breaker takes a candidate out of rotation after repeated failures and lets one probe
+# through after the cooldown. A failed call falls over to the next candidate in the ranking.
+ROUTER_BREAKER_FAILURES = int(os.getenv("ROUTER_BREAKER_FAILURES", "3"))
+ROUTER_BREAKER_ERROR_RATE = float(os.getenv("ROUTER_BREAKER_ERROR_RATE", "0.5"))
+ROUTER_BREAKER_COOLDOWN_SECONDS = float(os.getenv("ROUTER_BREAKER_COOLDOWN_SECONDS", "30"))
+ROUTER_RESAMPLE_SECONDS = float(os.getenv("ROUTER_RESAMPLE_SECONDS", "120"))
+ROUTER_MIN_SAMPLES = 5
+# Default candidates per artifact when llm_config does not name any, e.g.
+# LLM_CANDIDATES='{"story": [{"provider": "gemini", "model": "gemini-2.5-flash"}, {"provider": "gemini", "model": "gemini-2.0-flash"}]}'
+LLM_CANDIDATES = json.loads(os.getenv("LLM_CANDIDATES", "{}") or "{}")
+
+class CandidateHealth:
+    def __init__(self):
+        self.latency: Optional[float] = None  # EWMA of successful call latency, seconds
+        self.error_rate = 0.0                 # EWMA of failures (1) and successes (0)
+        self.samples = 0
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self.probing = False
+        self.last_used = 0.0
+
+class ProviderRouter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._health: dict[str, CandidateHealth] = {}
+
+    def _get(self, key: str) -> CandidateHealth:
+        health = self._health.get(key)
+        if health is None:
+            health = self._health[key] = CandidateHealth()
+        return health
+
+    def _available(self, health: CandidateHealth, now: float) -> bool:
+        if health.opened_at is None:
+            return True
+        # Half-open: one probe at a time once the cooldown has passed
+        return not health.probing and now - health.opened_at >= ROUTER_BREAKER_COOLDOWN_SECONDS
+
+    def rank(self, candidates: list[dict]) -> list[dict]:
+        """Candidates in the order to try them: available ones fastest first, then the rest in list order."""
+        now = time.monotonic()
+        with self._lock:
+            scored = []
+            for index, cfg in enumerate(candidates):
+                health = self._get(_registry_key(cfg))
+                stale = health.latency is None or now - health.last_used > ROUTER_RESAMPLE_SECONDS
+                available = self._available(health, now)
+                scored.append((not available, 0.0 if stale else health.latency, index, cfg))
+            scored.sort(key=lambda item: item[:3])
+            first = _registry_key(scored[0][3])
+            health = self._get(first)
+            if health.opened_at is not None and self._available(health, now):
+                health.probing = True
+        return [item[3] for item in scored]
+
+    def release(self, cfg: dict) -> None:
+        """End a half-open probe that produced neither a success nor a backend failure."""
+        with self._lock:
+            self._get(_registry_key(cfg)).probing = False
+
+    def record(self, cfg: dict, latency: Optional[float], ok: bool) -> None:
+        with self._lock:
+            health = self._get(_registry_key(cfg))
+            health.last_used = time.monotonic()
+            health.samples += 1
+            health.error_rate = 0.8 * health.error_rate + 0.2 * (0.0 if ok else 1.0)
+            health.probing = False
+            if ok:
+                health.consecutive_failures = 0
+                health.opened_at = None
+                health.latency = latency if health.latency is None else 0.8 * health.latency + 0.2 * latency
+                return
+            health.consecutive_failures += 1
+            degraded = health.samples >= ROUTER_MIN_SAMPLES and health.error_rate >= ROUTER_BREAKER_ERROR_RATE
+            if health.opened_at is not None or health.consecutive_failures >= ROUTER_BREAKER_FAILURES or degraded:
+                if health.opened_at is None:
+                    logger.info(f"Circuit opened for LLM candidate {_registry_key(cfg)}")
+                health.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        now = time.monotonic()
+        with self._lock:
+            return {
+                key: {
+                    "latency_seconds": round(health.latency, 3) if health.latency is not None else None,
+                    "error_rate": round(health.error_rate, 3),
+                    "samples": health.samples,
+                    "circuit": "closed" if health.opened_at is None else ("half_open" if self._available(health, now) else "open"),
+                }
+                for key, health in self._health.items()
+            }
+
+provider_router = ProviderRouter()
+
+def _candidates(artifact: str, cfg) -> list[dict]:
+    if isinstance(cfg, dict) and cfg:
+        return [cfg]
+    if isinstance(cfg, list) and cfg:
+        return cfg
+    return LLM_CANDIDATES.get(artifact) or [{"provider": "gemini"}]
+
+def _invoke_candidate(cfg: dict, prompt_value):
+    count_llm_call()
+    llm = _llm_from_config(cfg)
+    text = prompt_value.to_string() if hasattr(prompt_value, "to_string") else str(prompt_value)
+    provider = (cfg.get("provider") or "gemini").lower()
+    invoke = lambda: time_llm_call(provider, lambda: llm.invoke(prompt_value))
+    if LLM_PROVIDERS.get(provider, {}).get("rate_limited"):
+        result = llm_limiter.call(invoke, estimate_tokens(text))
+    else:
+        result = invoke()
+    # Providers that do not report usage are estimated at ~4 characters per token
+    usage = getattr(result, "usage_metadata", None) or {}
+    record_llm_tokens(
+        usage.get("input_tokens") or len(text) // 4,
+        usage.get("output_tokens") or len(str(getattr(result, "content", ""))) // 4,
+    )
+    return result
+
+def routed_llm(candidates: list[dict]):
+    """A runnable that sends each call to the best candidate and fails over down the ranking."""
+    for cfg in candidates:
+        # Build clients up front so unsupported providers fail at configuration time
+        try:
+            _llm_from_config(cfg)
+        except RuntimeError as exc:
+            logger.warning(f"LLM candidate {_registry_key(cfg)} unavailable: {exc}")
+
+    def invoke(prompt_value):
+        last_error: Optional[Exception] = None
+        for cfg in provider_router.rank(candidates):
+            started = time.monotonic()
+            settled = False
+            try:
+                result = _invoke_candidate(cfg, prompt_value)
+                provider_router.record(cfg, time.monotonic() - started, ok=True)
+                settled = True
+                return result
+            except UnsupportedProviderError:
+                raise  # a configuration error, not a backend failure
+            except Exception as exc:
+                provider_router.record(cfg, None, ok=False)
+                settled = True
+                llm_candidate_failures_total.inc(1, (cfg.get("provider") or "gemini").lower())
+                logger.info(f"LLM candidate {_registry_key(cfg)} failed: {exc}")
+                last_error = exc
+            finally:
+                if not settled:
+                    # A configuration error (or cancellation) must not leave a half-open probe claimed
+                    provider_router.release(cfg)
+        raise last_error
+    return RunnableLambda(invoke)
 
-You **MUST** structure your entire response using the following three templates, in this exact order.
+def build_chains(llm_config: dict | None = None):
+    llm_config = llm_config or {}
+    key = _registry_key(llm_config)
+    chains = _registry_get(_chains_registry, key)
+    if chains is None:
+        chains = _registry_put(_chains_registry, key, _compose_chains(llm_config))
+    return chains
 
-**#### 1. Feature Description ####**
-*(This section is for stakeholders and leadership. It must be clear, concise, and non-technical.)*
+def build_artifact_chain(artifact: str, cfg=None):
+    """
+    The chain that produces one artifact with its configured backend: prompt | routed LLM | parser.
+    cfg may be one {provider, model, ...} dict or an ordered list of them.
+    """
+    key = _registry_key("artifact", artifact, cfg)
+    chain = _registry_get(_chains_registry, key)
+    if chain is None:
+        prompt = {"story": prompt_story, "description": prompt_desc, "test_cases": prompt_tests}[artifact]
+        chain = _registry_put(_chains_registry, key, prompt | routed_llm(_candidates(artifact, cfg)) | StrOutputParser())
+    return chain
+
+def _compose_chains(llm_config: dict):
+    story_chain_local = build_artifact_chain("story", llm_config.get("story"))
+    tests_chain_local = build_artifact_chain("test_cases", llm_config.get("test_cases"))
+    description_chain_local = build_artifact_chain("description", llm_config.get("description"))
 
-**Feature:** (A clear, descriptive name for the feature)
+    final_chain_local = RunnablePassthrough.assign(
+        story=story_chain_local,
+        description=description_chain_local,
+    ).assign(
+        test_cases=(lambda x: {"user_story": x["story"]}) | tests_chain_local
+    )
 
-**Summary:** (A one-sentence executive summary of what this feature does.)
+    return {
+        "story_chain": story_chain_local,
+        "tests_chain": tests_chain_local,
+        "description_chain": description_chain_local,
+        "final_chain": final_chain_local,
+    }
 
-**Problem:** (A brief, 1-2 sentence description of the user problem or business need this feature solves.)
+# Strict, industry-standard templates
+prompt_story = ChatPromptTemplate.from_template(
+    """
+You are an expert Technical Product Manager. Based on the following requirement, create a formal User Story with Acceptance Criteria.
 
-**Solution:** (A high-level overview of how this feature solves the problem. Focus on value, not implementation.)
+The output MUST follow this exact format and keywords. Do not add any extra headings or prose:
 
-**Scope:**
-* (A bulleted list of the primary capabilities included in this feature.)
-* (Another key capability.)
+User Story: As a [type of user], I want to [task], so that I can [objective].
 
-**#### 2. User Story & Acceptance Criteria ####**
-*(This section is for the development team. It defines the work to be done.)*
+ACCEPTANCE CRITERIA:
+GIVEN [initial context], WHEN [action performed], THEN [expected outcome].
 
-**User Story:** As a [type of user], I want to [perform some task], so that I can [achieve some objective].
+ACCEPTANCE CRITERIA:
+GIVEN [another initial context], WHEN [another action or negative/edge case], THEN [expected outcome] AND [additional outcome if applicable].
 
-**Acceptance Criteria:**
-* **GIVEN** [initial context], **WHEN** [action is performed], **THEN** [expected successful outcome].
-* **GIVEN** [initial context], **WHEN** [an error condition occurs], **THEN** [a specific error outcome is observed].
-* **GIVEN** [an edge case context], **WHEN** [action is performed], **THEN** [the expected edge case outcome is observed].
+Notes:
+- Provide 2–5 ACCEPTANCE CRITERIA blocks, each starting with the header exactly as shown: "ACCEPTANCE CRITERIA:".
+- Use clear, observable system behavior; avoid implementation details.
 
-**#### 3. Test Cases ####**
-*(This section is for the QA team. It provides a detailed, formal script for validation using Gherkin syntax.)*
+Requirement: {requirement}
+    """
+)
 
-```gherkin
-Feature: (The name of the feature being tested)
+prompt_desc = ChatPromptTemplate.from_template(
+    """
+You are an expert Product Manager. Produce a concise Feature Brief for non-technical stakeholders based on the requirement.
+
+The output MUST follow this exact template and headings (Markdown bold labels included):
+
+**Feature:** [Feature Name]
+
+**Summary:** [A one-sentence summary of what this feature does.]
+
+**Problem:** [A brief description of the user problem this feature solves.]
+
+**Solution:** [A high-level overview of how this feature solves the problem.]
+
+**Scope:**
+* [Key capability or component 1]
+* [Key capability or component 2]
+* [Add more bullet points if needed]
+
+Requirement: {requirement}
+    """
+)
+
+prompt_tests = ChatPromptTemplate.from_template(
+    """
+You are a Senior QA Engineer. Create comprehensive Gherkin test cases for the feature, including happy paths, edge cases, and failure modes.
+
+The output MUST follow this exact Gherkin-style structure and keywords:
+
+Feature: [Feature Name]
+
+  Scenario: [Happy path scenario title]
+    Given [precondition]
+    When [user action]
+    And [optional additional action]
+    Then [expected outcome]
+
+  Scenario Outline: [Negative or edge case scenario]
+    Given [precondition]
+    When the user enters "<value1>" and "<value2>"
+    And [optional additional action]
+    Then [expected outcome / error]
+
+    Examples:
+      | value1 | value2 |
+      | ...    | ...    |
+
+Base Requirement (or user story input if provided): {user_story}
+    """
+)
+
+# Chains are built on first use per llm_config via build_chains(llm_config) and then reused
+
+# Configure Gemini AI (do not hard-fail if missing; allow server to start in guest mode)
+GEMINI_API_KEY = os.getenv("GEMINI_API_KEY")
+logger.info("Configuring Gemini AI...")
+if not GEMINI_API_KEY:
+    logger.warning("GEMINI_API_KEY is not set. Generation endpoints will return an error until it is configured.")
+
+# Define system prompt
+SYSTEM_PROMPT = """
+You are **StoryCrafter Pro**, an elite AI assistant acting as a Principal Technical Product Manager. Your primary directive is to transform a single, high-level product requirement into a comprehensive and structured set of three distinct, backlog-ready artifacts: a **Feature Description**, a **User Story with Acceptance Criteria**, and **formal Test Cases**.
+
+You must meticulously follow a three-step process to ensure clarity for all stakeholders, from business executives to QA engineers.
+
+**### PROCESS ###**
+
+1.  **Analyze & Deconstruct:** First, deeply analyze the user's requirement to identify the core user, their goal, the problem being solved, and any implied business rules or technical constraints.
+2.  **Think Technically, Write Strategically:** Use your analysis to think through the system's behavior, potential edge cases, and success/failure states.
+3.  **Generate Artifacts:** Use this deep understanding to populate the three mandatory output templates below. Adhere to the specified format for each artifact without deviation.
+
+**### OUTPUT TEMPLATES ###**
+
+You **MUST** structure your entire response using the following three templates, in this exact order.
+
+**#### 1. Feature Description ####**
+*(This section is for stakeholders and leadership. It must be clear, concise, and non-technical.)*
+
+**Feature:** (A clear, descriptive name for the feature)
+
+**Summary:** (A one-sentence executive summary of what this feature does.)
+
+**Problem:** (A brief, 1-2 sentence description of the user problem or business need this feature solves.)
+
+**Solution:** (A high-level overview of how this feature solves the problem. Focus on value, not implementation.)
+
+**Scope:**
+* (A bulleted list of the primary capabilities included in this feature.)
+* (Another key capability.)
+
+**#### 2. User Story & Acceptance Criteria ####**
+*(This section is for the development team. It defines the work to be done.)*
+
+**User Story:** As a [type of user], I want to [perform some task], so that I can [achieve some objective].
+
+**Acceptance Criteria:**
+* **GIVEN** [initial context], **WHEN** [action is performed], **THEN** [expected successful outcome].
+* **GIVEN** [initial context], **WHEN** [an error condition occurs], **THEN** [a specific error outcome is observed].
+* **GIVEN** [an edge case context], **WHEN** [action is performed], **THEN** [the expected edge case outcome is observed].
+
+**#### 3. Test Cases ####**
+*(This section is for the QA team. It provides a detailed, formal script for validation using Gherkin syntax.)*
+
+```gherkin
+Feature: (The name of the feature being tested)
 
   Scenario: (A descriptive name for the primary success scenario, or "happy path")
     Given [the initial context or precondition]
@@ -684,260 +2216,2056 @@ Declination Message: When declining, you must respond with this exact, verbatim
 Now, apply this entire process to the user's provided requirement.
 """
 
+# --- Prompt Assembly ---
+# SYSTEM_PROMPT stays the source of truth (single-shot generation sends all of it). Per-section calls
+# send only the shared preamble, that section's template and the guardrails, cut out of it here,
+# unless SYSTEM_PROMPT is held in the provider's context cache (see Context Caching below).
+_TEMPLATES_HEADING = "**### OUTPUT TEMPLATES ###**"
+_GUARDRAILS_HEADING = "### GUARDRAILS ###"
+_TEMPLATE_HEADINGS = {
+    "description": "**#### 1. Feature Description ####**",
+    "story": "**#### 2. User Story & Acceptance Criteria ####**",
+    "test_cases": "**#### 3. Test Cases ####**",
+}
+
+def _slice_system_prompt() -> tuple[str, dict[str, str], str]:
+    preamble = SYSTEM_PROMPT[:SYSTEM_PROMPT.index(_TEMPLATES_HEADING)].strip()
+    guardrails_at = SYSTEM_PROMPT.index(_GUARDRAILS_HEADING)
+    guardrails = SYSTEM_PROMPT[guardrails_at:SYSTEM_PROMPT.index("Now, apply this entire process")].strip()
+    starts = sorted((SYSTEM_PROMPT.index(heading), section) for section, heading in _TEMPLATE_HEADINGS.items())
+    templates = {}
+    for (start, section), end in zip(starts, [s for s, _ in starts[1:]] + [guardrails_at]):
+        templates[section] = SYSTEM_PROMPT[start:end].strip()
+    return preamble, templates, guardrails
+
+PROMPT_PREAMBLE, SECTION_TEMPLATES, PROMPT_GUARDRAILS = _slice_system_prompt()
+
+def section_prompt(section: str, prompt: str, instruction: str | None = None) -> str:
+    """The prompt for one section: shared preamble, that section's template, guardrails, instruction and requirement."""
+    instruction = instruction or f"Now, apply the process to the user's requirement. {SECTION_INSTRUCTIONS[section]}"
+    return (
+        f"{PROMPT_PREAMBLE}\n\n**### OUTPUT TEMPLATE ###**\n\n"
+        f"For this request produce only the following artifact.\n\n{SECTION_TEMPLATES[section]}\n\n"
+        f"{PROMPT_GUARDRAILS}\n\n{instruction}\n\nUser Requirement:\n{prompt}"
+    )
+
+class LLMPrompt(NamedTuple):
+    """A prompt that is valid inline as text, or as suffix sent against a cached static_prefix."""
+    text: str
+    static_prefix: Optional[str] = None
+    suffix: Optional[str] = None
+
+def cacheable_section_prompt(section: str, prompt: str, instruction: str | None = None) -> LLMPrompt:
+    instruction = instruction or f"Now, apply the process to the user's requirement. {SECTION_INSTRUCTIONS[section]}"
+    return LLMPrompt(
+        text=section_prompt(section, prompt, instruction),
+        static_prefix=SYSTEM_PROMPT,
+        suffix=f"{instruction}\n\nUser Requirement:\n{prompt}",
+    )
+
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-2.5-flash")
+
+# Direct genai models are shared per model name so their underlying client connection is reused
+_generative_models: dict = {}
+
+def get_generative_model(model_name: str = GEMINI_MODEL_NAME):
+    with _registry_lock:
+        generative_model = _generative_models.get(model_name)
+        if generative_model is None:
+            generative_model = genai.GenerativeModel(model_name)
+            _generative_models[model_name] = generative_model
+    return generative_model
+
 model = None
 try:
     if GEMINI_API_KEY:
         genai.configure(api_key=GEMINI_API_KEY)
-        model = genai.GenerativeModel("gemini-2.5-flash")
+        model = get_generative_model(GEMINI_MODEL_NAME)
         logger.info("Gemini AI configured successfully")
     else:
         logger.info("Skipping Gemini AI configuration due to missing GEMINI_API_KEY")
 except Exception as e:
     logger.error(f"Error configuring Gemini AI: {e}")
 
+# --- Context Caching ---
+# SYSTEM_PROMPT is registered once as provider-side cached content; calls then send only their
+# instruction and requirement against the handle, so the prefix is neither re-uploaded nor re-prefilled
+# and its tokens bill at the cached rate. The handle's TTL is extended on use once it is within
+# CONTEXT_CACHE_REFRESH_SECONDS of expiring. Whenever no handle is available (caching disabled or
+# unsupported, the prefix rejected e.g. as too small, or the handle gone) the inline prompt is sent.
+# Only the direct genai path (_call_model/_generate_content) uses the cache. Requests with an
+# llm_config run through the LangChain chains (get_chat_llm/LLM_PROVIDERS), which send the whole
+# prompt inline on every call.
+CONTEXT_CACHE_ENABLED = os.getenv("CONTEXT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+CONTEXT_CACHE_TTL_SECONDS = int(os.getenv("CONTEXT_CACHE_TTL_SECONDS", "3600"))
+CONTEXT_CACHE_REFRESH_SECONDS = int(os.getenv("CONTEXT_CACHE_REFRESH_SECONDS", "300"))
+# How long a prefix the provider refused to cache is sent inline before creation is tried again
+CONTEXT_CACHE_RETRY_SECONDS = int(os.getenv("CONTEXT_CACHE_RETRY_SECONDS", "600"))
+
+class GeminiContextCacheBackend:
+    """Cached-content adapter for google.generativeai; any object with these four methods can replace it."""
+
+    def create(self, model_name: str, system_instruction: str, ttl_seconds: int):
+        if not model_name.startswith("models/"):
+            model_name = f"models/{model_name}"
+        return genai.caching.CachedContent.create(
+            model=model_name,
+            display_name="storycrafter-system-prompt",
+            system_instruction=system_instruction,
+            ttl=timedelta(seconds=ttl_seconds),
+        )
+
+    def refresh(self, handle, ttl_seconds: int) -> None:
+        handle.update(ttl=timedelta(seconds=ttl_seconds))
+
+    def bind(self, handle):
+        return genai.GenerativeModel.from_cached_content(cached_content=handle)
+
+    def delete(self, handle) -> None:
+        handle.delete()
+
+class ContextCache:
+    """One provider cache handle per static prefix, created lazily and refreshed before it expires."""
+
+    def __init__(self, backend, model_name: str, ttl_seconds: int, refresh_seconds: int, retry_seconds: int):
+        self.backend = backend
+        self.model_name = model_name
+        self.ttl_seconds = ttl_seconds
+        self.refresh_seconds = refresh_seconds
+        self.retry_seconds = retry_seconds
+        self._lock = threading.Lock()
+        # prefix key -> {"handle", "model", "expires_at"}
+        self._entries: dict[str, dict] = {}
+        self._unavailable_until: dict[str, float] = {}
+        # Keys whose create/refresh is in progress; other callers keep using the current handle or go inline
+        self._busy: set[str] = set()
+        self.counters = dict.fromkeys(
+            ("hits", "creates", "refreshes", "fallbacks", "errors", "invalidations", "cached_tokens"), 0
+        )
+
+    def _key(self, static_prefix: str) -> str:
+        return hashlib.sha256(f"{self.model_name}\n{static_prefix}".encode("utf-8")).hexdigest()
+
+    def model_for(self, static_prefix: str):
+        """A model bound to the cached static_prefix, or None if the prompt must be sent inline."""
+        if self.backend is None:
+            return None
+        key = self._key(static_prefix)
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            valid = entry is not None and entry["expires_at"] > now
+            due = not valid or entry["expires_at"] - now <= self.refresh_seconds
+            if not due or key in self._busy or self._unavailable_until.get(key, 0) > now:
+                if valid:
+                    self.counters["hits"] += 1
+                    return entry["model"]
+                self.counters["fallbacks"] += 1
+                return None
+            self._busy.add(key)
+        try:
+            if valid:
+                self.backend.refresh(entry["handle"], self.ttl_seconds)
+                entry = {**entry, "expires_at": now + self.ttl_seconds}
+                counter = "refreshes"
+            else:
+                handle = self.backend.create(self.model_name, static_prefix, self.ttl_seconds)
+                entry = {"handle": handle, "model": self.backend.bind(handle), "expires_at": now + self.ttl_seconds}
+                counter = "creates"
+                logger.info(f"Context cache created for {self.model_name} ({len(static_prefix)} chars, ttl {self.ttl_seconds}s)")
+        except Exception as e:
+            logger.warning(f"Context cache unavailable, sending prompts inline: {e}")
+            with self._lock:
+                self._busy.discard(key)
+                self._unavailable_until[key] = now + self.retry_seconds
+                self.counters["errors"] += 1
+                if valid:
+                    # Refresh failed but the handle has not expired yet; keep using it until it does
+                    self.counters["hits"] += 1
+                    return entry["model"]
+                self._entries.pop(key, None)
+                self.counters["fallbacks"] += 1
+            return None
+        with self._lock:
+            self._busy.discard(key)
+            self._entries[key] = entry
+            self.counters[counter] += 1
+        return entry["model"]
+
+    def invalidate(self, static_prefix: str, reason: Exception) -> None:
+        """Forget a handle the provider no longer accepts; the next call creates a new one."""
+        logger.warning(f"Context cache handle rejected, falling back to the inline prompt: {reason}")
+        with self._lock:
+            self._entries.pop(self._key(static_prefix), None)
+            self.counters["invalidations"] += 1
+            self.counters["fallbacks"] += 1
+
+    def record_cached_tokens(self, tokens: int) -> None:
+        if tokens:
+            with self._lock:
+                self.counters["cached_tokens"] += tokens
+
+    def close(self) -> None:
+        """Delete the handles this process created instead of leaving them to expire."""
+        with self._lock:
+            entries = list(self._entries.values())
+            self._entries.clear()
+        for entry in entries:
+            try:
+                self.backend.delete(entry["handle"])
+            except Exception as e:
+                logger.warning(f"Failed to delete context cache handle: {e}")
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["enabled"] = self.backend is not None
+            stats["handles"] = len(self._entries)
+        return stats
+
+context_cache = ContextCache(
+    GeminiContextCacheBackend() if CONTEXT_CACHE_ENABLED and model is not None else None,
+    GEMINI_MODEL_NAME,
+    CONTEXT_CACHE_TTL_SECONDS,
+    CONTEXT_CACHE_REFRESH_SECONDS,
+    CONTEXT_CACHE_RETRY_SECONDS,
+)
+
+# --- Artifact Generation ---
+ARTIFACT_SECTIONS = ("description", "story", "test_cases")
+
+# --- Validation ---
+# Rules are compiled once per template into named markers (literal needles). Each marker is searched
+# once per output with str.find/str.count, which use CPython's fast substring search, and searches
+# stop as soon as a rule's threshold is reached. Markers are only searched when a rule asks for them,
+# and presence-only rules are first confirmed together in one containment pass, so a passing output
+# costs little more than the plain substring checks it replaced. A regex alternation covering all
+# markers would be a single scan, but re is an order of magnitude slower than these searches on long
+# outputs (twentyfold with IGNORECASE, which is why ignore-case markers search a lowered copy).
+
+class Marker(NamedTuple):
+    needles: tuple[str, ...]
+    ignore_case: bool = False
+    limit: Optional[int] = 1      # stop counting once this many occurrences are found; None counts all
+    after: Optional[str] = None   # only count occurrences after the first match of this (single-needle) marker
+
+class ValidationResult(NamedTuple):
+    ok: bool
+    codes: list[str]
+    reasons: list[str]
+
+def _count_needles(text: str, needles: tuple[str, ...], limit: Optional[int], start: int) -> tuple[int, int]:
+    """Return (occurrences, position of the first needle found) for needles in text[start:]."""
+    total = 0
+    first = -1
+    for needle in needles:
+        if limit is None:
+            total += text.count(needle, start)
+            continue
+        pos = text.find(needle, start)
+        if first == -1:
+            first = pos
+        while pos != -1:
+            total += 1
+            if total >= limit:
+                return total, first
+            pos = text.find(needle, pos + len(needle))
+    return total, first
+
+class _MarkerCounts(dict):
+    """Marker counts for one output, each searched on first access so passing rules skip the rest."""
+    __slots__ = ("validator", "text", "lowered", "first")
+
+    def __init__(self, validator: "SectionValidator", text: str):
+        self.validator = validator
+        self.text = text
+        self.lowered: Optional[str] = None
+        self.first: dict[str, int] = {}
+
+    def __missing__(self, name: str) -> int:
+        marker = self.validator.markers[name]
+        start = 0
+        if marker.after is not None:
+            self[marker.after]
+            start = self.first.get(marker.after, -1)
+            if start == -1:
+                self[name] = 0
+                return 0
+        if marker.ignore_case:
+            if self.lowered is None:
+                self.lowered = self.text.lower()
+            haystack = self.lowered
+        else:
+            haystack = self.text
+        if marker.limit == 1 and not start and name not in self.validator.anchors:
+            # Presence only: the in operator is cheaper than find when no position is needed
+            found = 1 if any(needle in haystack for needle in marker.needles) else 0
+            self[name] = found
+            return found
+        self[name], self.first[name] = _count_needles(haystack, marker.needles, marker.limit, start)
+        return self[name]
+
+class SectionValidator:
+    """
+    Compiled validation rules for one artifact section. Stateless after construction, so a single
+    instance can be shared by request handlers, streaming consumers and batch jobs.
+    rules is a list of (code, reason, check). check is either a tuple of marker names that must all
+    be found, or check(counts, text) returning True when satisfied.
+    """
+
+    def __init__(self, section: str, markers: dict[str, Marker], rules: list[tuple[str, str, Callable | tuple[str, ...]]]):
+        self.section = section
+        self.markers = markers
+        self.rules = rules
+        self.anchors = {marker.after for marker in markers.values() if marker.after is not None}
+        # Presence rules over case-sensitive markers are confirmed together by one containment pass
+        # on each marker's first needle; when that passes (the usual case) only the other rules run
+        fast = [
+            rule for rule in rules
+            if isinstance(rule[2], tuple)
+            and all(not markers[name].ignore_case and markers[name].after is None for name in rule[2])
+        ]
+        self._fast_needles = tuple(dict.fromkeys(markers[name].needles[0] for rule in fast for name in rule[2]))
+        self._slow_rules = [rule for rule in rules if rule not in fast]
+
+    def count_markers(self, text: str) -> dict[str, int]:
+        counts = _MarkerCounts(self, text)
+        return {name: counts[name] for name in self.markers}
+
+    def __call__(self, output_text: str) -> ValidationResult:
+        text = (output_text or "").strip()
+        rules = self._slow_rules if all(map(text.__contains__, self._fast_needles)) else self.rules
+        counts = _MarkerCounts(self, text)
+        codes: list[str] = []
+        reasons: list[str] = []
+        for code, reason, check in rules:
+            if isinstance(check, tuple):
+                for name in check:
+                    if not counts[name]:
+                        break
+                else:
+                    continue
+            elif check(counts, text):
+                continue
+            codes.append(code)
+            reasons.append(reason)
+        return ValidationResult(not codes, codes, reasons)
+
+STORY_VALIDATOR = SectionValidator(
+    "story",
+    markers={
+        "label": Marker(("User Story:",)),
+        "as_a": Marker(("as a",), ignore_case=True),
+        "i_want_to": Marker(("i want to",), ignore_case=True),
+        "so_that": Marker(("so that i can",), ignore_case=True),
+        "given": Marker(("GIVEN ", "Given "), limit=3),
+        "when": Marker((" WHEN ", " When ", "\nWhen ")),
+        "then": Marker((" THEN ", " Then ", "\nThen ")),
+        "placeholder": Marker(("achieve my goal", "objective"), ignore_case=True),
+    },
+    rules=[
+        ("missing_user_story_label", "Missing 'User Story:' label",
+         ("label",)),
+        ("story_phrasing", "User Story sentence must use 'As a ... I want to ... so that I can ...'",
+         ("as_a", "i_want_to", "so_that")),
+        ("too_few_acceptance_criteria", "At least three acceptance criteria (GIVEN/WHEN/THEN) are required",
+         lambda c, t: c["given"] >= 3),
+        ("missing_when", "Acceptance criteria must include WHEN",
+         ("when",)),
+        ("missing_then", "Acceptance criteria must include THEN",
+         ("then",)),
+        ("placeholder_text", "Avoid placeholders like 'achieve my goal' or 'objective'; be specific",
+         lambda c, t: c["placeholder"] == 0),
+    ],
+)
+
+DESCRIPTION_LABELS = {
+    "feature": "**Feature:**",
+    "summary": "**Summary:**",
+    "problem": "**Problem:**",
+    "solution": "**Solution:**",
+    "scope": "**Scope:",
+}
+
+DESCRIPTION_VALIDATOR = SectionValidator(
+    "description",
+    markers={
+        **{name: Marker((label,)) for name, label in DESCRIPTION_LABELS.items()},
+        "scope_bullet": Marker(("\n*",), after="scope"),
+    },
+    rules=[
+        *((f"missing_{name}_label", f"Missing '{label}' label", (name,))
+          for name, label in DESCRIPTION_LABELS.items()),
+        # The '**Scope:' line itself starts with '*', so one further "\n*" line makes two bullets
+        ("too_few_scope_bullets", "Scope should include at least two bullet points",
+         lambda c, t: c["scope"] == 0 or c["scope_bullet"] >= 1),
+    ],
+)
+
+TESTCASES_VALIDATOR = SectionValidator(
+    "test_cases",
+    markers={
+        "feature": Marker(("Feature:",)),
+        "scenario": Marker(("Scenario:",)),
+        "outline": Marker(("Scenario Outline:",)),
+        "examples": Marker(("Examples:",)),
+        "table": Marker(("|",)),
+        "given": Marker((" Given ", "\nGiven ")),
+        "when": Marker((" When ", "\nWhen ")),
+        "then": Marker((" Then ", "\nThen ")),
+    },
+    rules=[
+        ("missing_gherkin_fence", "Test cases must be wrapped in a fenced code block starting with ```gherkin and ending with ```",
+         lambda c, t: t.startswith("```gherkin") and t.endswith("```")),
+        ("missing_feature", "Missing 'Feature:' header",
+         ("feature",)),
+        ("missing_scenario", "Missing 'Scenario:' block",
+         ("scenario",)),
+        ("missing_scenario_outline", "Missing 'Scenario Outline:' block",
+         ("outline",)),
+        ("missing_examples", "Missing 'Examples' table for the Scenario Outline",
+         ("examples", "table")),
+        ("missing_given", "At least one 'Given' is required",
+         ("given",)),
+        ("missing_when", "At least one 'When' is required",
+         ("when",)),
+        ("missing_then", "At least one 'Then' is required",
+         ("then",)),
+    ],
+)
+
+SECTION_VALIDATORS = {
+    "description": DESCRIPTION_VALIDATOR,
+    "story": STORY_VALIDATOR,
+    "test_cases": TESTCASES_VALIDATOR,
+}
+
+SECTION_INSTRUCTIONS = {
+    "description": (
+        "Output ONLY the 'Feature Description' section exactly as defined in the template, "
+        "including the labeled fields and the 'Scope' bullet list. Do not include any other sections."
+    ),
+    "story": (
+        "Output ONLY the 'User Story & Acceptance Criteria' section exactly as defined in the template. "
+        "Ensure the 'User Story' sentence uses the specified phrasing and include at least three acceptance criteria "
+        "using GIVEN/WHEN/THEN lines. Do not include other sections."
+    ),
+    "test_cases": (
+        "Output ONLY the 'Test Cases' section exactly as defined in the template and wrap the body in a fenced "
+        "code block starting with ```gherkin and ending with ```. Do not include other sections."
+    ),
+}
+
+# Template requirements appended to the failed checks when a section goes back to the model
+SECTION_FIX_NOTES = {
+    "description": "The section must strictly satisfy the template: include all bold labels exactly (**Feature:**, **Summary:**, **Problem:**, **Solution:**, **Scope:**) and ensure Scope has at least two bullet points. Output only this section.",
+    "story": "The section must strictly satisfy the template: include 'User Story:' heading, use the exact phrasing 'As a ... I want to ... so that I can ...' with specific objective (no placeholders), and include at least three acceptance criteria with GIVEN/WHEN/THEN. Output only this section.",
+    "test_cases": "The section must strictly satisfy the template: wrap in ```gherkin fenced block, include 'Feature:', at least one 'Scenario:' and one 'Scenario Outline:' with an 'Examples' table, and use Given/When/Then lines. Output only this section.",
+}
+
+# --- Local Repair ---
+# Mechanical template problems (a missing fence, a label without its colon, lowercase keywords) are
+# fixed in place before anything goes back to the model. Each repair is keyed by the failure codes it
+# can fix and only runs when one of them was reported.
+
+class GenerationStats:
+    """Thread-safe counters for the generation pipeline, exposed at /api/generation/stats."""
+
+    def __init__(self, *names: str):
+        self._lock = threading.Lock()
+        self.counters = dict.fromkeys(names, 0)
+
+    def incr(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.counters)
+
+generation_stats = GenerationStats(
+    "validation_failures", "repairs_applied", "retries_avoided", "patch_retries", "full_retries",
+    "hedges_started", "hedges_skipped", "hedge_wins", "hedge_losers_cancelled",
+    "coalesced_requests", "llm_calls_saved",
+)
+validation_failures_total = metrics.counter(
+    "validation_failures_total", "Failed validation checks by section, failure code and attempt.", ("section", "code", "attempt"),
+)
+section_retries_total = metrics.counter("section_retries_total", "Sections sent back to the model, by kind of retry.", ("section", "kind"))
+
+def validate_section(section: str, content: str, attempt: int) -> ValidationResult:
+    with trace_span("validation", section=section, attempt=attempt) as span:
+        result = SECTION_VALIDATORS[section](content)
+        span.set(ok=result.ok, codes=result.codes)
+    return result
+
+def record_validation_failures(section: str, result: ValidationResult, attempt: int) -> None:
+    for code in result.codes:
+        validation_failures_total.inc(1, section, code, str(attempt))
+
+_FENCED_BLOCK_RE = re.compile(r"```[\w-]*[ \t]*\n(.*?)(?:```|\Z)", re.S)
+_GHERKIN_HEADER_RE = re.compile(
+    r"^([ \t]*)(?:\*\*)?(feature|scenario outline|scenario template|scenario|examples)\b(?:\*\*)?[ \t]*:?(?:\*\*)?",
+    re.I | re.M,
+)
+_GHERKIN_STEP_RE = re.compile(r"^([ \t]*)(?:\*\*)?(given|when|then|and|but)\b(?:\*\*)?(?=[ \t])", re.I | re.M)
+_GHERKIN_KEYWORDS = {
+    "feature": "Feature:", "scenario outline": "Scenario Outline:", "scenario template": "Scenario Outline:",
+    "scenario": "Scenario:", "examples": "Examples:",
+    "given": "Given", "when": "When", "then": "Then", "and": "And", "but": "But",
+}
+_SCOPE_BULLET_RE = re.compile(r"^[ \t]*(?:[-•+*]|\d+[.)])[ \t]+", re.M)
+_CRITERIA_HEADING_RE = re.compile(r"acceptance criteria", re.I)
+# Criteria keywords are only rewritten where they start a clause: at the start of a line (after an
+# optional bullet or number), in bold markup, or after a comma on a line that starts with one.
+# Anywhere else "given", "when" and "then" are prose ("a given coupon", "then shows a receipt").
+_CRITERION_LINE_RE = re.compile(
+    r"^([ \t]*(?:(?:[-•+*]|\d+[.)])[ \t]+)?)(?:[*_]{1,2})?(given|when|then)\b(?:[*_]{1,2})?[ \t]*[,:]?[ \t]*(.*)$",
+    re.I | re.M,
+)
+_CRITERION_CLAUSE_RE = re.compile(r"([,;][ \t]*)(?:[*_]{1,2})?(when|then)\b(?:[*_]{1,2})?[ \t]*:?[ \t]*", re.I)
+_BOLD_CRITERIA_KEYWORD_RE = re.compile(r"(?:\*\*|__)(given|when|then)[ \t]*:?(?:\*\*|__)[ \t]*[,:]?[ \t]*", re.I)
+_SO_I_CAN_RE = re.compile(r"\bso I can\b", re.I)
+
+def _label_pattern(label: str) -> re.Pattern:
+    return re.compile(
+        rf"^[ \t]*(?:#+[ \t]*)?(?:[*_]{{1,2}})?[ \t]*{label}(?![ \t]*&)[ \t]*(?:[*_]{{1,2}})?[ \t]*:?[ \t]*(?:[*_]{{1,2}})?(?=[ \t]|$)",
+        re.I | re.M,
+    )
+
+def _relabel(pattern: re.Pattern, canonical: str, text: str) -> str:
+    # A bare word at the start of a line is prose, not a label; only rewrite marked-up headings
+    return pattern.sub(lambda m: canonical if any(ch in m.group(0) for ch in ":*_#") else m.group(0), text)
+
+_DESCRIPTION_LABEL_PATTERNS = {name: _label_pattern(name) for name in DESCRIPTION_LABELS}
+_USER_STORY_LABEL_RE = _label_pattern(r"user[ \t]+story")
+
+def _repair_description_labels(text: str) -> str:
+    for name, pattern in _DESCRIPTION_LABEL_PATTERNS.items():
+        text = _relabel(pattern, f"**{name.capitalize()}:**", text)
+    return text
+
+def _repair_scope_bullets(text: str) -> str:
+    scope_index = text.find("**Scope:")
+    if scope_index == -1:
+        return text
+    head, scope = text[:scope_index], text[scope_index:]
+    first_line, sep, rest = scope.partition("\n")
+    return head + first_line + sep + _SCOPE_BULLET_RE.sub("* ", rest)
+
+def _repair_story_label(text: str) -> str:
+    return _relabel(_USER_STORY_LABEL_RE, "**User Story:**", text)
+
+def _repair_story_phrasing(text: str) -> str:
+    return _SO_I_CAN_RE.sub("so that I can", text)
+
+def _repair_criteria_keywords(text: str) -> str:
+    heading = _CRITERIA_HEADING_RE.search(text)
+    if heading is None:
+        return text
+    head, criteria = text[:heading.end()], text[heading.end():]
+    criteria = _BOLD_CRITERIA_KEYWORD_RE.sub(lambda m: m.group(1).upper() + " ", criteria)
+    return head + _CRITERION_LINE_RE.sub(_uppercase_criterion, criteria)
+
+def _uppercase_criterion(match: re.Match) -> str:
+    clauses = _CRITERION_CLAUSE_RE.sub(lambda m: m.group(1) + m.group(2).upper() + " ", match.group(3))
+    return match.group(1) + match.group(2).upper() + " " + clauses
+
+def _repair_gherkin_keywords(text: str) -> str:
+    text = _GHERKIN_HEADER_RE.sub(lambda m: m.group(1) + _GHERKIN_KEYWORDS[m.group(2).lower()], text)
+    return _GHERKIN_STEP_RE.sub(lambda m: m.group(1) + _GHERKIN_KEYWORDS[m.group(2).lower()], text)
+
+def _repair_gherkin_fence(text: str) -> str:
+    blocks = [match.group(1).strip() for match in _FENCED_BLOCK_RE.finditer(text)]
+    body = "\n\n".join(blocks) if blocks else text.strip()
+    return f"```gherkin\n{body}\n```"
+
+SECTION_REPAIRS = {
+    "description": [
+        ({f"missing_{name}_label" for name in DESCRIPTION_LABELS}, _repair_description_labels),
+        ({"missing_scope_label", "too_few_scope_bullets"}, _repair_scope_bullets),
+    ],
+    "story": [
+        ({"missing_user_story_label"}, _repair_story_label),
+        ({"story_phrasing"}, _repair_story_phrasing),
+        ({"too_few_acceptance_criteria", "missing_when", "missing_then"}, _repair_criteria_keywords),
+    ],
+    "test_cases": [
+        ({"missing_feature", "missing_scenario", "missing_scenario_outline", "missing_examples",
+          "missing_given", "missing_when", "missing_then"}, _repair_gherkin_keywords),
+        ({"missing_gherkin_fence"}, _repair_gherkin_fence),
+    ],
+}
+
+def repair_section(section: str, content: str, codes: list[str]) -> str:
+    """Apply every local repair that targets one of the reported failure codes."""
+    failed = set(codes)
+    for fixes, repair in SECTION_REPAIRS.get(section, ()):
+        if fixes & failed:
+            content = repair(content)
+    return content.strip()
+
+# --- Generation Cache ---
+# Results are cached per section (and per llm_config chain run) so resubmitted requirements
+# skip the LLM entirely. Entries live in an in-process LRU backed by the generation_cache table.
+GENERATION_CACHE_TTL_SECONDS = int(os.getenv("GENERATION_CACHE_TTL_SECONDS", str(7 * 24 * 3600)))
+GENERATION_CACHE_MEMORY_ENTRIES = int(os.getenv("GENERATION_CACHE_MEMORY_ENTRIES", "256"))
+GENERATION_CACHE_MAX_ROWS = int(os.getenv("GENERATION_CACHE_MAX_ROWS", "5000"))
+
+def _template_text(template) -> str:
+    return "".join(message.prompt.template for message in template.messages)
+
+# Any edit to the prompts or templates changes this hash and therefore invalidates old entries
+PROMPT_TEMPLATES_HASH = hashlib.sha256(
+    json.dumps(
+        [
+            SYSTEM_PROMPT,
+            SECTION_INSTRUCTIONS,
+            SECTION_FIX_NOTES,
+            [_template_text(t) for t in (prompt_story, prompt_desc, prompt_tests)],
+        ],
+        sort_keys=True,
+    ).encode("utf-8")
+).hexdigest()
+
+def normalize_prompt(prompt: str) -> str:
+    """Collapse whitespace and case so trivially edited requirements share a cache entry."""
+    return " ".join((prompt or "").split()).casefold()
+
+def make_cache_key(prompt: str, mode: str, llm_config: dict | None = None, model_name: str | None = None) -> str:
+    payload = {
+        "prompt": normalize_prompt(prompt),
+        "mode": mode,
+        "llm_config": llm_config or {},
+        "model": model_name or GEMINI_MODEL_NAME,
+        "templates": PROMPT_TEMPLATES_HASH,
+    }
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+class GenerationCache:
+    """Two-tier (memory LRU + SQLite) cache with TTL and size-bounded eviction. Thread-safe."""
+
+    def __init__(self, ttl_seconds: int, memory_entries: int, max_rows: int):
+        self.ttl = timedelta(seconds=ttl_seconds)
+        self.memory_entries = memory_entries
+        self.max_rows = max_rows
+        self._memory: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"memory_hits": 0, "db_hits": 0, "misses": 0, "writes": 0, "evictions": 0, "bypassed": 0}
+
+    def _count(self, name: str, amount: int = 1) -> None:
+        with self._lock:
+            self.counters[name] += amount
+
+    def _remember(self, key: str, value, expires_at: datetime) -> None:
+        with self._lock:
+            self._memory[key] = (expires_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+                self.counters["evictions"] += 1
+
+    def record_bypass(self) -> None:
+        self._count("bypassed")
+
+    def get(self, key: str):
+        now = datetime.utcnow()
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                expires_at, value = entry
+                if expires_at > now:
+                    self._memory.move_to_end(key)
+                    self.counters["memory_hits"] += 1
+                    return value
+                del self._memory[key]
+
+        db = SessionLocal()
+        try:
+            row = db.query(GenerationCacheEntry).filter(GenerationCacheEntry.key == key).first()
+            if row is None or row.expires_at <= now:
+                if row is not None:
+                    db.delete(row)
+                    db.commit()
+                self._count("misses")
+                return None
+            row.last_accessed = now
+            db.commit()
+            value = json.loads(row.value)
+            expires_at = row.expires_at
+        finally:
+            db.close()
+        self._remember(key, value, expires_at)
+        self._count("db_hits")
+        return value
+
+    def set(self, key: str, value) -> None:
+        now = datetime.utcnow()
+        expires_at = now + self.ttl
+        serialized = json.dumps(value)
+        self._remember(key, value, expires_at)
+        db = SessionLocal()
+        try:
+            db.merge(GenerationCacheEntry(
+                key=key,
+                value=serialized,
+                size=len(serialized),
+                created_at=now,
+                last_accessed=now,
+                expires_at=expires_at,
+            ))
+            db.commit()
+            self._evict(db, now)
+        finally:
+            db.close()
+        self._count("writes")
+
+    def _evict(self, db: Session, now: datetime) -> None:
+        evicted = db.query(GenerationCacheEntry).filter(GenerationCacheEntry.expires_at <= now).delete(synchronize_session=False)
+        overflow = db.query(GenerationCacheEntry).count() - self.max_rows
+        if overflow > 0:
+            oldest = [key for (key,) in db.query(GenerationCacheEntry.key).order_by(GenerationCacheEntry.last_accessed).limit(overflow)]
+            evicted += db.query(GenerationCacheEntry).filter(GenerationCacheEntry.key.in_(oldest)).delete(synchronize_session=False)
+        if evicted:
+            db.commit()
+            self._count("evictions", evicted)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self.counters)
+            stats["memory_entries"] = len(self._memory)
+        hits = stats["memory_hits"] + stats["db_hits"]
+        lookups = hits + stats["misses"]
+        stats["hit_ratio"] = round(hits / lookups, 4) if lookups else 0.0
+        return stats
+
+generation_cache = GenerationCache(GENERATION_CACHE_TTL_SECONDS, GENERATION_CACHE_MEMORY_ENTRIES, GENERATION_CACHE_MAX_ROWS)
+
+def _call_model(composed: str | LLMPrompt, on_token=None, cancel: Optional[threading.Event] = None) -> str:
+    """
+    Blocking Gemini call; run it off the event loop.
+    When on_token is given the streaming API is used and each chunk is passed to it as it arrives.
+    When cancel is given the call also streams, and stops reading the response once cancel is set.
+    """
+    if model is None:
+        raise HTTPException(status_code=503, detail="LLM not configured: Set GEMINI_API_KEY in environment or .env")
+    if not isinstance(composed, LLMPrompt):
+        composed = LLMPrompt(composed)
+    return llm_limiter.call(lambda: _generate_content(composed, on_token, cancel), estimate_tokens(composed.text))
+
+def _generate_content(prompt: LLMPrompt, on_token, cancel: Optional[threading.Event]) -> str:
+    if cancel is not None and cancel.is_set():
+        # A hedge that lost while it was queued in the limiter
+        return ""
+    if prompt.static_prefix:
+        cached_model = context_cache.model_for(prompt.static_prefix)
+        if cached_model is not None:
+            streamed = False
+            sink = on_token
+            if on_token is not None:
+                def sink(text: str) -> None:
+                    nonlocal streamed
+                    streamed = True
+                    on_token(text)
+            try:
+                return time_llm_call("gemini", lambda: _stream_content(
+                    cached_model, prompt.suffix, prompt.static_prefix + prompt.suffix, sink, cancel,
+                ))
+            except Exception as e:
+                if is_rate_limit_error(e):
+                    raise
+                # Typically the handle expired or was deleted provider-side
+                context_cache.invalidate(prompt.static_prefix, e)
+                if streamed:
+                    # The client already has part of this attempt; replaying it inline would repeat those
+                    # tokens and count the call twice, so fail the attempt instead
+                    raise
+    return time_llm_call("gemini", lambda: _stream_content(model, prompt.text, prompt.text, on_token, cancel))
+
+def _stream_content(target, contents: str, billed: str, on_token, cancel: Optional[threading.Event]) -> str:
+    count_llm_call()
+    if on_token is None and cancel is None:
+        response = target.generate_content(contents)
+        text = getattr(response, 'text', '') or ''
+        _record_usage(billed, text, getattr(response, "usage_metadata", None))
+        return text
+    parts: list[str] = []
+    usage_metadata = None
+    for chunk in target.generate_content(contents, stream=True):
+        if cancel is not None and cancel.is_set():
+            break
+        # Usage is cumulative; the last chunk that carries it has the totals
+        usage_metadata = getattr(chunk, "usage_metadata", None) or usage_metadata
+        try:
+            text = chunk.text or ''
+        except ValueError:
+            # Chunks without text parts (e.g. safety or finish metadata) raise on .text
+            continue
+        if text:
+            parts.append(text)
+            if on_token is not None:
+                on_token(text)
+    text = "".join(parts)
+    _record_usage(billed, text, usage_metadata)
+    return text
+
+def _record_usage(composed: str, text: str, usage_metadata) -> None:
+    # Fall back to ~4 characters per token when the response carries no usage metadata
+    input_tokens = getattr(usage_metadata, "prompt_token_count", None) or len(composed) // 4
+    output_tokens = getattr(usage_metadata, "candidates_token_count", None) or len(text) // 4
+    record_llm_tokens(input_tokens, output_tokens)
+    context_cache.record_cached_tokens(getattr(usage_metadata, "cached_content_token_count", None) or 0)
+
+def _ensure_gherkin_fence(content: str) -> str:
+    if "```" not in content:
+        return f"```gherkin\n{content}\n```"
+    return content
+
+def _describe_error(exc: Exception) -> str:
+    if isinstance(exc, HTTPException):
+        return str(exc.detail)
+    return str(exc)
+
+def _no_emit(event: str, data: dict) -> None:
+    pass
+
+def _token_sink(section: str, emit, attempt: int):
+    if emit is _no_emit:
+        return None
+    return lambda text: emit("token", {"section": section, "attempt": attempt, "text": text})
+
+def _repair_locally(section: str, content: str, result: ValidationResult, emit, attempt: int) -> tuple[str, ValidationResult]:
+    """Try the local repairs; keep the repaired text only if it strictly reduces the failures."""
+    repaired = repair_section(section, content, result.codes)
+    if repaired == content:
+        return content, result
+    repaired_result = SECTION_VALIDATORS[section](repaired)
+    if not set(repaired_result.codes) < set(result.codes):
+        return content, result
+    generation_stats.incr("repairs_applied")
+    if repaired_result.ok:
+        logger.info(f"Section '{section}' repaired locally: {result.codes}")
+    emit("validation", {"section": section, "attempt": attempt, "repaired": True, "ok": repaired_result.ok,
+                        "codes": repaired_result.codes, "reasons": repaired_result.reasons})
+    return repaired, repaired_result
+
+async def _retry_section(section: str, prompt: str, content: str, reasons: list[str], emit) -> str:
+    with trace_span("retry", section=section, kind="patch" if content else "full"):
+        logger.info(f"Section '{section}' failed validation, retrying: {reasons}")
+        fix_note = "Your previous output failed these checks: " + "; ".join(reasons) + ". " + SECTION_FIX_NOTES[section]
+        if content:
+            # Ask for a patch of the failing parts rather than a full regeneration from the system prompt
+            generation_stats.incr("patch_retries")
+            section_retries_total.inc(1, section, "patch")
+            composed_retry = (
+                f"{fix_note}\nFix only what these checks require, keep everything else unchanged, "
+                f"and return the complete corrected section.\n\nPrevious output:\n{content}"
+            )
+        else:
+            generation_stats.incr("full_retries")
+            section_retries_total.inc(1, section, "full")
+            composed_retry = cacheable_section_prompt(section, prompt, instruction=fix_note)
+        content_retry = await run_llm(_call_model, composed_retry, _token_sink(section, emit, 2))
+        if section == "test_cases":
+            # Ensure fenced block on retry
+            content_retry = _ensure_gherkin_fence(content_retry)
+        return content_retry.strip() or content
+
+async def _finish_section(section: str, prompt: str, content: str, emit, use_cache: bool) -> str:
+    """
+    Validate a first-attempt output, repair mechanical problems locally, and only if it still fails
+    ask the model once to patch it. Then cache and report the result.
+    """
+    llm_section.set(section)
+    result = validate_section(section, content, 1)
+    emit("validation", {"section": section, "attempt": 1, "ok": result.ok, "codes": result.codes, "reasons": result.reasons})
+    if not result.ok:
+        generation_stats.incr("validation_failures")
+        record_validation_failures(section, result, 1)
+        content, result = _repair_locally(section, content, result, emit, 1)
+        if result.ok:
+            # Only here does a repair stand in for the model retry below
+            generation_stats.incr("retries_avoided")
+    if not result.ok:
+        content = await _retry_section(section, prompt, content, result.reasons, emit)
+        result = validate_section(section, content, 2)
+        if not result.ok:
+            record_validation_failures(section, result, 2)
+            content, result = _repair_locally(section, content, result, emit, 2)
+    ok = result.ok
+
+    # Only outputs that satisfy the template are worth replaying
+    if use_cache and ok:
+        await run_db(generation_cache.set, make_cache_key(prompt, section), content)
+    emit("section_complete", {"section": section, "content": content})
+    return content
+
+async def _cached_sections(prompt: str, sections, emit, use_cache: bool) -> dict:
+    if not use_cache:
+        generation_cache.record_bypass()
+        return {}
+    found = {}
+    for section in sections:
+        cached = await run_db(generation_cache.get, make_cache_key(prompt, section))
+        if cached is not None:
+            emit("section_complete", {"section": section, "content": cached, "cached": True})
+            found[section] = cached
+    return found
+
+# --- Hedging ---
+# Opt-in (HEDGE_ENABLED). If the first call for a section has not finished after HEDGE_DELAY_MS, or
+# straight away for sections whose first attempts often fail validation, a second identical call is
+# started. The first output that passes the validator wins and the other call is cancelled. Hedges
+# are capped at HEDGE_MAX_RATE extra calls per primary call so quota spend stays bounded. While a
+# race may still happen, streamed tokens are held back and only the winner's are sent, so the client
+# never sees a loser's partial text.
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+HEDGE_DELAY_MS = int(os.getenv("HEDGE_DELAY_MS", "4000"))
+HEDGE_MAX_RATE = float(os.getenv("HEDGE_MAX_RATE", "0.2"))
+HEDGE_IMMEDIATE_FAILURE_RATE = float(os.getenv("HEDGE_IMMEDIATE_FAILURE_RATE", "0.5"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+class HedgePolicy:
+    """Decides when to hedge a section call and enforces the hedge budget."""
+
+    def __init__(self, delay_seconds: float, max_rate: float, immediate_failure_rate: float, min_samples: int):
+        self.delay_seconds = delay_seconds
+        self.max_rate = max_rate
+        self.immediate_failure_rate = immediate_failure_rate
+        self.min_samples = min_samples
+        self._lock = threading.Lock()
+        self.primary_calls = 0
+        self.hedged_calls = 0
+        self._outcomes: dict[str, list[int]] = {}  # section -> [validated, failed]
+
+    def record_primary(self) -> None:
+        with self._lock:
+            self.primary_calls += 1
+
+    def record_validation(self, section: str, ok: bool) -> None:
+        with self._lock:
+            outcome = self._outcomes.setdefault(section, [0, 0])
+            outcome[0] += 1
+            outcome[1] += 0 if ok else 1
+
+    def failure_rate(self, section: str) -> Optional[float]:
+        with self._lock:
+            validated, failed = self._outcomes.get(section, (0, 0))
+        if validated < self.min_samples:
+            return None
+        return failed / validated
+
+    def delay_for(self, section: str) -> float:
+        rate = self.failure_rate(section)
+        if rate is not None and rate >= self.immediate_failure_rate:
+            return 0.0
+        return self.delay_seconds
+
+    def try_acquire(self) -> bool:
+        """Reserve one hedge if it keeps hedged calls within max_rate of primary calls."""
+        with self._lock:
+            if self.hedged_calls + 1 > self.max_rate * self.primary_calls:
+                return False
+            self.hedged_calls += 1
+            return True
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "enabled": HEDGE_ENABLED,
+                "primary_calls": self.primary_calls,
+                "hedged_calls": self.hedged_calls,
+                "hedge_rate": round(self.hedged_calls / self.primary_calls, 4) if self.primary_calls else 0.0,
+                "failure_rates": {
+                    section: round(failed / validated, 4)
+                    for section, (validated, failed) in self._outcomes.items() if validated
+                },
+            }
+
+hedge_policy = HedgePolicy(HEDGE_DELAY_MS / 1000, HEDGE_MAX_RATE, HEDGE_IMMEDIATE_FAILURE_RATE, HEDGE_MIN_SAMPLES)
+
+async def _generate_candidate(section: str, composed: str | LLMPrompt, on_token=None, cancel: Optional[threading.Event] = None) -> tuple[str, ValidationResult]:
+    content = await run_llm(_call_model, composed, on_token, cancel)
+    if section == "test_cases":
+        content = _ensure_gherkin_fence(content)
+    content = content.strip()
+    result = SECTION_VALIDATORS[section](content)
+    if cancel is None or not cancel.is_set():
+        hedge_policy.record_validation(section, result.ok)
+    return content, result
+
+class _TokenBuffer:
+    """Holds a candidate's streamed tokens until it is chosen, then replays them and streams the rest."""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self._lock = threading.Lock()
+        self._parts: list[str] = []
+        self._live = False
+
+    def __call__(self, text: str) -> None:
+        with self._lock:
+            if self._live:
+                self.sink(text)
+            else:
+                self._parts.append(text)
+
+    def release(self) -> None:
+        with self._lock:
+            self._live = True
+            for text in self._parts:
+                self.sink(text)
+            self._parts.clear()
+
+async def _race_candidates(section: str, composed: str | LLMPrompt, emit) -> str:
+    """
+    Run the primary call and, if the policy allows, a hedge; return the first output that passes
+    validation. If neither passes, the output with the fewest failures goes on to repair and retry.
+    """
+    hedge_policy.record_primary()
+    cancels: list[threading.Event] = []
+    tasks: dict[asyncio.Task, str] = {}
+    sink = _token_sink(section, emit, 1)
+    buffers: dict[str, _TokenBuffer] = {}
+
+    def launch(role: str) -> None:
+        cancel = threading.Event()
+        cancels.append(cancel)
+        if sink is not None:
+            buffers[role] = _TokenBuffer(sink)
+        tasks[asyncio.ensure_future(_generate_candidate(section, composed, buffers.get(role), cancel))] = role
+
+    def choose(role: str) -> None:
+        if role in buffers:
+            buffers[role].release()
+
+    launch("primary")
+    try:
+        done, pending = await asyncio.wait(tasks, timeout=hedge_policy.delay_for(section))
+        if done:
+            # The primary beat the hedge delay; an invalid result goes to the cheaper patch retry
+            choose("primary")
+            return next(iter(done)).result()[0]
+        if hedge_policy.try_acquire():
+            generation_stats.incr("hedges_started")
+            logger.info(f"Hedging section '{section}'")
+            launch("hedge")
+        else:
+            # No race after all, so the primary can stream live from here on
+            generation_stats.incr("hedges_skipped")
+            choose("primary")
+
+        finished: list[tuple[str, tuple[str, ValidationResult]]] = []
+        first_error: Optional[BaseException] = None
+        pending = set(tasks)
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    first_error = first_error or task.exception()
+                    continue
+                content, result = task.result()
+                if result.ok:
+                    if tasks[task] == "hedge":
+                        generation_stats.incr("hedge_wins")
+                    choose(tasks[task])
+                    return content
+                finished.append((tasks[task], (content, result)))
+        if not finished:
+            raise first_error
+        # Fewest failures wins; on a tie prefer the primary
+        finished.sort(key=lambda item: (len(item[1][1].codes), item[0] != "primary"))
+        choose(finished[0][0])
+        return finished[0][1][0]
+    finally:
+        for cancel in cancels:
+            cancel.set()
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+                generation_stats.incr("hedge_losers_cancelled")
+
+async def generate_section(section: str, prompt: str, emit=None, use_cache: bool = True) -> str:
+    """
+    Generate one artifact section, validating it and retrying once with explicit feedback.
+    If emit(event, data) is given, tokens are streamed and progress events are reported through it.
+    Valid results are served from and stored in the generation cache unless use_cache is False.
+    """
+    emit = emit or _no_emit
+    with trace_span("generate_section", section=section) as span:
+        cached = await _cached_sections(prompt, (section,), emit, use_cache)
+        span.set(cached=section in cached)
+        if section in cached:
+            return cached[section]
+
+        llm_section.set(section)
+        composed = cacheable_section_prompt(section, prompt)
+        if HEDGE_ENABLED:
+            content = await _race_candidates(section, composed, emit)
+        else:
+            content, _ = await _generate_candidate(section, composed, _token_sink(section, emit, 1))
+        return await _finish_section(section, prompt, content, emit, use_cache)
+
+def _collect_sections(sections, results, emit) -> tuple[dict, dict]:
+    artifacts: dict[str, str] = {}
+    failures: dict[str, Exception] = {}
+    for section, result in zip(sections, results):
+        if isinstance(result, Exception):
+            logger.error(f"Section '{section}' failed: {_describe_error(result)}")
+            emit("error", {"section": section, "detail": _describe_error(result)})
+            failures[section] = result
+        else:
+            artifacts[section] = result
+    return artifacts, failures
+
+async def generate_sections(prompt: str, sections, emit=None, use_cache: bool = True) -> tuple[dict, dict]:
+    """
+    Run several sections (and their validate-and-retry loops) concurrently.
+    Returns (artifacts, failures) so one failing section does not discard the others.
+    """
+    emit = emit or _no_emit
+    results = await asyncio.gather(
+        *(generate_section(section, prompt, emit=emit, use_cache=use_cache) for section in sections),
+        return_exceptions=True,
+    )
+    return _collect_sections(sections, results, emit)
+
+# --- Single-shot generation ---
+# SYSTEM_PROMPT already asks for all three templates in order, so one call can produce every
+# section; the response is split locally on the "#### 1./2./3." headings.
+SINGLE_SHOT_MODE = "single_shot"
+_SECTION_HEADING_RE = re.compile(r"^[ \t>*_]*#{2,6}\s*([123])\.[^\n]*$", re.MULTILINE)
+_SECTION_BY_NUMBER = {"1": "description", "2": "story", "3": "test_cases"}
+_TEMPLATE_NOTE_RE = re.compile(r"^\s*[*_]\(.*\)[*_]\s*$")
+_TRAILING_RULE_RE = re.compile(r"\n\s*(?:-{3,}|\*{3,}|_{3,})\s*$")
+_FENCE_LINE_RE = re.compile(r"^[ \t>]*(`{3,}|~{3,})", re.MULTILINE)
+
+def _fenced_spans(text: str) -> list[tuple[int, int]]:
+    """(start, end) of every code fence; an unclosed fence runs to the end of the text."""
+    spans = []
+    opened = None
+    for fence in _FENCE_LINE_RE.finditer(text):
+        if opened is None:
+            opened = fence
+        elif fence.group(1)[0] == opened.group(1)[0] and len(fence.group(1)) >= len(opened.group(1)):
+            spans.append((opened.start(), fence.end()))
+            opened = None
+    if opened is not None:
+        spans.append((opened.start(), len(text)))
+    return spans
+
+def split_artifacts(text: str) -> dict[str, str]:
+    """Split a full three-template response into {section: body}; sections without a heading are omitted."""
+    text = text or ""
+    fenced = _fenced_spans(text)
+    # A "## 2. ..." line inside the gherkin block is a comment in the test cases, not the next section
+    headings = [
+        heading for heading in _SECTION_HEADING_RE.finditer(text)
+        if not any(start <= heading.start() < end for start, end in fenced)
+    ]
+    parts: dict[str, str] = {}
+    for index, heading in enumerate(headings):
+        section = _SECTION_BY_NUMBER[heading.group(1)]
+        end = headings[index + 1].start() if index + 1 < len(headings) else len(text)
+        lines = text[heading.end():end].strip().splitlines()
+        # Drop the italic "(This section is for ...)" note the template places under each heading
+        if lines and _TEMPLATE_NOTE_RE.match(lines[0]):
+            lines = lines[1:]
+        body = _TRAILING_RULE_RE.sub("", "\n".join(lines).strip()).strip()
+        if body and section not in parts:
+            parts[section] = body
+    return parts
+
+async def generate_single_shot(prompt: str, emit=None, use_cache: bool = True) -> tuple[dict, dict]:
+    """
+    Generate all sections with a single LLM call, then validate each part locally and
+    re-request only the sections that fail. Returns (artifacts, failures) like generate_sections.
+    """
+    emit = emit or _no_emit
+    artifacts = await _cached_sections(prompt, ARTIFACT_SECTIONS, emit, use_cache)
+    missing = [section for section in ARTIFACT_SECTIONS if section not in artifacts]
+    if len(missing) <= 1:
+        # Nothing or a single section left: a scoped call is cheaper than the full template
+        generated, failures = await generate_sections(prompt, missing, emit=emit, use_cache=use_cache)
+        artifacts.update(generated)
+        return artifacts, failures
+
+    requirement = f"User Requirement:\n{prompt}"
+    composed = LLMPrompt(f"{SYSTEM_PROMPT}\n\n{requirement}", SYSTEM_PROMPT, requirement)
+    llm_section.set(SINGLE_SHOT_MODE)
+    try:
+        text = await run_llm(_call_model, composed, _token_sink(SINGLE_SHOT_MODE, emit, 1))
+    except Exception as exc:
+        return artifacts, _collect_sections(missing, [exc] * len(missing), emit)[1]
+
+    parts = split_artifacts(text)
+    logger.info(f"Single-shot response split into sections: {sorted(parts)}")
+    if "test_cases" in parts:
+        parts["test_cases"] = _ensure_gherkin_fence(parts["test_cases"])
+    results = await asyncio.gather(
+        *(_finish_section(section, prompt, parts.get(section, ""), emit, use_cache) for section in missing),
+        return_exceptions=True,
+    )
+    generated, failures = _collect_sections(missing, results, emit)
+    artifacts.update(generated)
+    return artifacts, failures
+
+# --- Artifact Graph ---
+# Each requested artifact is produced exactly once: by its llm_config chain when one is configured for
+# it, otherwise by generate_section (SYSTEM_PROMPT + validation + retry). A chain-produced test_cases
+# takes the story as input (prompt_tests' user_story), so it waits for the story node; every other
+# node only needs the requirement and runs concurrently.
+ARTIFACT_DEPENDENCIES = {"test_cases": ("story",)}
+
+async def _generate_with_chain(section: str, prompt: str, cfg, inputs: dict, emit, use_cache: bool) -> str:
+    llm_section.set(section)
+    cache_key = make_cache_key(prompt, f"chain:{section}", {"backend": cfg, "inputs": inputs})
+    if use_cache:
+        cached = await run_db(generation_cache.get, cache_key)
+        if cached is not None:
+            emit("section_complete", {"section": section, "content": cached, "cached": True})
+            return cached
+    else:
+        generation_cache.record_bypass()
+
+    if section == "test_cases":
+        chain_input = {"user_story": inputs.get("story") or prompt}
+    else:
+        chain_input = {"requirement": prompt}
+    content = await run_llm(build_artifact_chain(section, cfg).invoke, chain_input)
+    if section == "test_cases":
+        content = _ensure_gherkin_fence(content)
+    content = content.strip()
+
+    # The configured backend owns this artifact, so failures are repaired locally but not re-asked of Gemini
+    result = validate_section(section, content, 1)
+    emit("validation", {"section": section, "attempt": 1, "ok": result.ok, "codes": result.codes, "reasons": result.reasons})
+    if not result.ok:
+        generation_stats.incr("validation_failures")
+        record_validation_failures(section, result, 1)
+        content, result = _repair_locally(section, content, result, emit, 1)
+    if use_cache and result.ok:
+        await run_db(generation_cache.set, cache_key, content)
+    emit("section_complete", {"section": section, "content": content})
+    return content
+
+async def generate_artifact_graph(prompt: str, sections, llm_config: dict | None = None, emit=None,
+                                  use_cache: bool = True, existing: dict | None = None) -> tuple[dict, dict]:
+    """
+    Produce every section not already in existing, once each, running independent nodes concurrently.
+    Returns (artifacts, failures) like generate_sections.
+    """
+    emit = emit or _no_emit
+    llm_config = llm_config or {}
+    existing = existing or {}
+    pending = [section for section in sections if section not in existing]
+    tasks: dict[str, asyncio.Future] = {}
+
+    async def produce(section: str) -> str:
+        cfg = llm_config.get(section)
+        if not cfg:
+            return await generate_section(section, prompt, emit=emit, use_cache=use_cache)
+        inputs = {}
+        for dependency in ARTIFACT_DEPENDENCIES.get(section, ()):
+            if existing.get(dependency):
+                inputs[dependency] = existing[dependency]
+            elif dependency in tasks:
+                try:
+                    inputs[dependency] = await tasks[dependency]
+                except Exception:
+                    pass  # fall back to the requirement alone
+        with trace_span("generate_section", section=section, backend="chain"):
+            return await _generate_with_chain(section, prompt, cfg, inputs, emit, use_cache)
+
+    for section in pending:
+        tasks[section] = asyncio.ensure_future(produce(section))
+    results = await asyncio.gather(*tasks.values(), return_exceptions=True)
+    return _collect_sections(pending, results, emit)
+
+async def _generate_artifacts(request: "StoryRequest", emit=None, existing: dict | None = None,
+                              usage: LLMUsage | None = None) -> dict:
+    """
+    Produce the AI response dict (description, story, test_cases) for a story request.
+    Sections already present in existing (e.g. from a resumed job) are reused, not regenerated.
+    LLM calls and tokens are added to usage when given.
+    """
+    token = llm_usage.set(usage)
+    try:
+        return await _generate_artifacts_in_context(request, emit, existing)
+    finally:
+        llm_usage.reset(token)
+
+async def _generate_artifacts_in_context(request: "StoryRequest", emit, existing: dict | None) -> dict:
+    mode = (request.mode or "all").lower()
+    sections = (mode,) if mode in ARTIFACT_SECTIONS else ARTIFACT_SECTIONS
+    existing = {section: content for section, content in (existing or {}).items() if section in sections and content}
+
+    ai_response_dict = {"description": None, "story": None, "test_cases": None}
+    if mode == SINGLE_SHOT_MODE and not existing and not request.llm_config:
+        artifacts, failures = await generate_single_shot(request.prompt, emit=emit, use_cache=request.use_cache)
+    else:
+        artifacts, failures = await generate_artifact_graph(
+            request.prompt, sections, request.llm_config, emit=emit, use_cache=request.use_cache, existing=existing,
+        )
+    artifacts = {**existing, **artifacts}
+    if not artifacts:
+        raise next(iter(failures.values()))
+    ai_response_dict.update(artifacts)
+    if failures:
+        ai_response_dict["errors"] = {section: _describe_error(exc) for section, exc in failures.items()}
+    return ai_response_dict
+
+# --- Request Coalescing ---
+# Identical generations (same prompt, mode, llm_config and use_cache) that are in flight at the same
+# time share one underlying run. The run is its own task, so it survives any single caller
+# disconnecting; each caller still saves the result to its own chat.
+
+class SingleFlight:
+    def __init__(self):
+        self._inflight: dict[str, asyncio.Task] = {}
+
+    async def _run(self, key: str, fn):
+        try:
+            return await fn()
+        finally:
+            self._inflight.pop(key, None)
+
+    async def do(self, key: str, fn) -> tuple:
+        """Return (result, shared); shared is True when the result came from another caller's run."""
+        task = self._inflight.get(key)
+        if task is None:
+            task = self._inflight[key] = asyncio.create_task(self._run(key, fn))
+            return await asyncio.shield(task), False
+        return await asyncio.shield(task), True
+
+    def in_flight(self) -> int:
+        return len(self._inflight)
+
+generation_flights = SingleFlight()
+
+async def generate_coalesced(request: StoryRequest) -> tuple[dict, dict]:
+    """
+    Returns (ai_response_dict, usage). A request that joined another's run reports zero usage of its
+    own; the calls it would have made are counted as saved instead.
+    """
+    async def run() -> tuple[dict, dict]:
+        usage = LLMUsage()
+        ai_response_dict = await _generate_artifacts(request, usage=usage)
+        return ai_response_dict, usage.as_dict()
+
+    # A cache-bypassing request must not join a run that reads and writes the cache, or vice versa
+    key = make_cache_key(request.prompt, request.mode or "all", request.llm_config)
+    key += ":cached" if request.use_cache else ":bypass"
+    (ai_response_dict, usage), shared = await generation_flights.do(key, run)
+    if shared:
+        generation_stats.incr("coalesced_requests")
+        generation_stats.incr("llm_calls_saved", usage["calls"])
+        usage = LLMUsage().as_dict()
+    return dict(ai_response_dict), usage
+
+# --- Artifact Storage ---
+# AI replies are stored as one message_artifacts row per section instead of a JSON string in
+# chat_messages.message. Bodies at or above ARTIFACT_COMPRESS_MIN_BYTES are zlib-compressed, and
+# each row records the content hash and the validation result at save time. ChatMessage.message
+# rebuilds the original JSON, so existing clients see the same shape.
+ARTIFACT_COMPRESS_MIN_BYTES = int(os.getenv("ARTIFACT_COMPRESS_MIN_BYTES", "512"))
+ARTIFACT_COMPRESS_LEVEL = int(os.getenv("ARTIFACT_COMPRESS_LEVEL", "6"))
+ARTIFACT_MIGRATION_BATCH_SIZE = int(os.getenv("ARTIFACT_MIGRATION_BATCH_SIZE", "500"))
+
+def encode_artifact_body(content: str) -> tuple[str, bytes]:
+    raw = content.encode("utf-8")
+    if len(raw) >= ARTIFACT_COMPRESS_MIN_BYTES:
+        compressed = zlib.compress(raw, ARTIFACT_COMPRESS_LEVEL)
+        # Keep it plain when compression does not pay for itself
+        if len(compressed) < len(raw):
+            return "zlib", compressed
+    return "plain", raw
+
+def decode_artifact_body(encoding: str, body: Optional[bytes]) -> Optional[str]:
+    if body is None:
+        return None
+    if encoding == "zlib":
+        body = zlib.decompress(body)
+    return body.decode("utf-8")
+
+def build_artifacts(ai_response_dict: dict) -> list["MessageArtifact"]:
+    """One MessageArtifact per generated or failed section of an AI reply."""
+    errors = ai_response_dict.get("errors") or {}
+    artifacts = []
+    for section in ARTIFACT_SECTIONS:
+        content = ai_response_dict.get(section)
+        if content is None and section not in errors:
+            continue
+        artifact = MessageArtifact(section=section, error=errors.get(section))
+        if content is not None:
+            encoding, body = encode_artifact_body(content)
+            result = SECTION_VALIDATORS[section](content)
+            artifact.content_hash = hashlib.sha256(content.encode("utf-8")).hexdigest()
+            artifact.encoding = encoding
+            artifact.body = body
+            artifact.size = len(content.encode("utf-8"))
+            artifact.stored_size = len(body)
+            artifact.valid = result.ok
+            artifact.validation_codes = json.dumps(result.codes)
+        artifacts.append(artifact)
+    return artifacts
+
+def artifacts_to_dict(artifacts) -> dict:
+    """The {description, story, test_cases[, errors]} dict the artifacts were built from."""
+    ai_response_dict = {section: None for section in ARTIFACT_SECTIONS}
+    errors = {}
+    for artifact in artifacts:
+        ai_response_dict[artifact.section] = artifact.content
+        if artifact.error:
+            errors[artifact.section] = artifact.error
+    if errors:
+        ai_response_dict["errors"] = errors
+    return ai_response_dict
+
+def _is_artifact_dict(value) -> bool:
+    if not isinstance(value, dict) or not set(value) <= {*ARTIFACT_SECTIONS, "errors"}:
+        return False
+    errors = value.get("errors") or {}
+    return (
+        all(value.get(section) is None or isinstance(value[section], str) for section in ARTIFACT_SECTIONS)
+        and isinstance(errors, dict) and set(errors) <= set(ARTIFACT_SECTIONS)
+    )
+
+def migrate_message_artifacts(batch_size: int = ARTIFACT_MIGRATION_BATCH_SIZE) -> int:
+    """
+    Move AI replies saved as a JSON string into message_artifacts. Idempotent: migrated rows have a
+    NULL message, and rows that are not an artifact dict are left as they are.
+    """
+    migrated = 0
+    last_id = 0
+    db = SessionLocal()
+    try:
+        while True:
+            messages = (
+                db.query(ChatMessage)
+                .filter(ChatMessage.is_user.is_(False), ChatMessage._message.isnot(None), ChatMessage.id > last_id)
+                .order_by(ChatMessage.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not messages:
+                break
+            for message in messages:
+                try:
+                    value = json.loads(message._message)
+                except ValueError:
+                    continue
+                if _is_artifact_dict(value):
+                    message.artifacts = build_artifacts(value)
+                    message._message = None
+                    migrated += 1
+            db.commit()
+            last_id = messages[-1].id
+    finally:
+        db.close()
+    if migrated:
+        logger.info(f"Moved {migrated} AI messages into message_artifacts")
+    return migrated
+
+def _artifact_loader(include_bodies: bool):
+    # Loads the artifacts of a page of messages in one extra query instead of one per message
+    loader = selectinload(ChatMessage.artifacts)
+    return loader.undefer(MessageArtifact.body) if include_bodies else loader
+
+def _message_artifacts_query(db: Session, chat_id: int, message_id: int):
+    message = db.query(ChatMessage.id).filter(ChatMessage.id == message_id, ChatMessage.chat_id == chat_id).first()
+    if not message:
+        raise HTTPException(status_code=404, detail="Message not found")
+    return db.query(MessageArtifact).filter(MessageArtifact.message_id == message_id)
+
+# --- Search ---
+# search_index is an FTS5 table with one row per user prompt, plain message and artifact section.
+# The after_flush hook below keeps it in step inside the same transaction as the write, which covers
+# every write path (generate_story, create_chat_message, jobs, the artifact migration); SQL triggers
+# can't, since artifact bodies are stored compressed. rowid = message_id * 8 + kind code, so the
+# rows of one message are a rowid range and never need a scan to find.
+# The scope column holds tokens for the project, user, chat and kind (p7 u3 c12 kstory, captured
+# when the row is written), so filters are intersected inside the full-text index instead of
+# being applied to every match afterwards.
+SEARCH_TITLE_WEIGHT = float(os.getenv("SEARCH_TITLE_WEIGHT", "4.0"))
+SEARCH_SNIPPET_TOKENS = int(os.getenv("SEARCH_SNIPPET_TOKENS", "16"))
+SEARCH_REBUILD_BATCH_SIZE = int(os.getenv("SEARCH_REBUILD_BATCH_SIZE", "1000"))
+_SEARCH_ROWS_PER_MESSAGE = 8
+_SEARCH_KIND_CODES = {"prompt": 0, "reply": 0, "description": 1, "story": 2, "test_cases": 3}
+_FEATURE_NAME_RE = re.compile(r"\*\*Feature:\*\*\s*([^\n]+)")
+_USER_STORY_RE = re.compile(r"\bAs an? [^\n]+", re.IGNORECASE)
+_GHERKIN_TITLE_RE = re.compile(r"^\s*(?:Feature|Scenario|Scenario Outline):\s*([^\n]+)$", re.MULTILINE)
+_SEARCH_TERM_RE = re.compile(r"\w+")
+
+def create_search_index(bind) -> bool:
+    """Create search_index if it is missing; returns True when it was created (and needs a rebuild)."""
+    with bind.begin() as conn:
+        exists = conn.exec_driver_sql("SELECT 1 FROM sqlite_master WHERE name = 'search_index'").first()
+        if exists:
+            return False
+        # prefix='2 3' indexes short prefixes so the type-ahead prefix match on the last term stays an index lookup
+        conn.exec_driver_sql(
+            "CREATE VIRTUAL TABLE search_index USING fts5("
+            "kind UNINDEXED, chat_id UNINDEXED, message_id UNINDEXED, scope, title, content, "
+            "tokenize='porter unicode61', prefix='2 3')"
+        )
+    return True
+
+def search_title(kind: str, text: str) -> str:
+    """What an artifact is about: the feature name, the user story sentence, or the Gherkin titles."""
+    if kind == "description":
+        match = _FEATURE_NAME_RE.search(text)
+        return match.group(1).strip() if match else ""
+    if kind == "story":
+        match = _USER_STORY_RE.search(text)
+        return match.group(0).strip() if match else ""
+    if kind == "test_cases":
+        return " | ".join(title.strip() for title in _GHERKIN_TITLE_RE.findall(text))
+    return ""
+
+def _scope_tokens(project_id: Optional[int] = None, user_id: Optional[int] = None,
+                  chat_id: Optional[int] = None, kind: Optional[str] = None) -> list[str]:
+    tokens = []
+    for prefix, value in (("p", project_id), ("u", user_id), ("c", chat_id)):
+        if value is not None:
+            tokens.append(f"{prefix}{value}")
+    if kind is not None:
+        # unicode61 splits on "_", so test_cases becomes ktestcases
+        tokens.append(f"k{kind.replace('_', '')}")
+    return tokens
+
+def _search_row(message_id: int, chat_id: int, kind: str, content: str, chat_scope: tuple) -> dict:
+    project_id, user_id = chat_scope
+    return {
+        "rowid": message_id * _SEARCH_ROWS_PER_MESSAGE + _SEARCH_KIND_CODES[kind],
+        "kind": kind,
+        "chat_id": chat_id,
+        "message_id": message_id,
+        "scope": " ".join(_scope_tokens(project_id, user_id, chat_id, kind)),
+        "title": search_title(kind, content),
+        "content": content,
+    }
+
+def _message_search_rows(message: "ChatMessage", chat_scope: tuple) -> list[dict]:
+    rows = []
+    if message._message is not None:
+        kind = "prompt" if message.is_user else "reply"
+        rows.append(_search_row(message.id, message.chat_id, kind, message._message, chat_scope))
+    for artifact in message.artifacts:
+        content = artifact.content
+        if content is not None:
+            rows.append(_search_row(message.id, message.chat_id, artifact.section, content, chat_scope))
+    return rows
+
+def _chat_scopes(conn, chat_ids) -> dict:
+    """{chat_id: (project_id, user_id)} for the given chats."""
+    chat_ids = {chat_id for chat_id in chat_ids if chat_id is not None}
+    if not chat_ids:
+        return {}
+    rows = conn.execute(select(Chat.id, Chat.project_id, Chat.user_id).where(Chat.id.in_(chat_ids)))
+    return {chat_id: (project_id, user_id) for chat_id, project_id, user_id in rows}
+
+_SEARCH_DELETE_SQL = text("DELETE FROM search_index WHERE rowid BETWEEN :first AND :last")
+_SEARCH_INSERT_SQL = text(
+    "INSERT INTO search_index (rowid, kind, chat_id, message_id, scope, title, content) "
+    "VALUES (:rowid, :kind, :chat_id, :message_id, :scope, :title, :content)"
+)
+
+@event.listens_for(SessionLocal, "after_flush")
+def _sync_search_index(session: Session, flush_context) -> None:
+    deletes: list[dict] = []
+    # (message_id, chat_id, kind, content) to index once the chats' scopes are known
+    pending: list[tuple] = []
+    for obj in session.deleted:
+        if isinstance(obj, ChatMessage):
+            first = obj.id * _SEARCH_ROWS_PER_MESSAGE
+            deletes.append({"first": first, "last": first + _SEARCH_ROWS_PER_MESSAGE - 1})
+        elif isinstance(obj, MessageArtifact):
+            rowid = obj.message_id * _SEARCH_ROWS_PER_MESSAGE + _SEARCH_KIND_CODES[obj.section]
+            deletes.append({"first": rowid, "last": rowid})
+    for obj in list(session.new) + list(session.dirty):
+        if isinstance(obj, ChatMessage):
+            if obj not in session.new and not inspect(obj).attrs._message.history.has_changes():
+                continue
+            rowid = obj.id * _SEARCH_ROWS_PER_MESSAGE
+            deletes.append({"first": rowid, "last": rowid})
+            if obj._message is not None:
+                pending.append((obj.id, obj.chat_id, "prompt" if obj.is_user else "reply", obj._message))
+        elif isinstance(obj, MessageArtifact):
+            rowid = obj.message_id * _SEARCH_ROWS_PER_MESSAGE + _SEARCH_KIND_CODES[obj.section]
+            deletes.append({"first": rowid, "last": rowid})
+            content = obj.content
+            if content is not None:
+                pending.append((obj.message_id, obj.chat_message.chat_id, obj.section, content))
+    if not deletes and not pending:
+        return
+    conn = session.connection()
+    if deletes:
+        conn.execute(_SEARCH_DELETE_SQL, deletes)
+    if pending:
+        scopes = _chat_scopes(conn, [chat_id for _, chat_id, _, _ in pending])
+        conn.execute(_SEARCH_INSERT_SQL, [
+            _search_row(message_id, chat_id, kind, content, scopes.get(chat_id, (None, None)))
+            for message_id, chat_id, kind, content in pending
+        ])
+
+def rebuild_search_index(batch_size: int = SEARCH_REBUILD_BATCH_SIZE) -> int:
+    """Re-index every message from scratch; run when search_index is created on an existing database."""
+    indexed = 0
+    last_id = 0
+    db = SessionLocal()
+    try:
+        db.execute(text("DELETE FROM search_index"))
+        while True:
+            messages = (
+                db.query(ChatMessage)
+                .filter(ChatMessage.id > last_id)
+                .options(_artifact_loader(True))
+                .order_by(ChatMessage.id)
+                .limit(batch_size)
+                .all()
+            )
+            if not messages:
+                break
+            scopes = _chat_scopes(db.connection(), [message.chat_id for message in messages])
+            rows = [
+                row for message in messages
+                for row in _message_search_rows(message, scopes.get(message.chat_id, (None, None)))
+            ]
+            if rows:
+                db.execute(_SEARCH_INSERT_SQL, rows)
+            indexed += len(rows)
+            last_id = messages[-1].id
+        db.commit()
+    finally:
+        db.close()
+    logger.info(f"Search index rebuilt with {indexed} rows")
+    return indexed
+
+def fts_query(q: str, scope: list[str] = ()) -> str:
+    """
+    Turn free text into an FTS5 query: every word must match the title or content, the last one
+    also as a prefix, and every scope token must match the scope column.
+    """
+    terms = _SEARCH_TERM_RE.findall(q)
+    if not terms:
+        raise HTTPException(status_code=400, detail="Search query must contain at least one word")
+    # Quoted so FTS5 syntax in user input (AND, NEAR, column filters, ...) is matched literally
+    phrases = [f'"{term}"' for term in terms[:-1]] + [f'"{terms[-1]}"*']
+    return " AND ".join([f"{{title content}} : ({' '.join(phrases)})"] + [f'scope : "{token}"' for token in scope])
+
+# The page is ranked first without building snippets; the outer query re-runs the match (cheap without
+# ranking) and builds snippets only for the page's rows. "+s.rowid" stops the planner from seeking
+# each page row by rowid, which costs a full query evaluation per row, and CROSS JOIN fixes the
+# join order so chats and messages are only looked up for rows on the page.
+_SEARCH_SQL = """
+WITH page AS MATERIALIZED (
+    SELECT rowid AS hit, bm25(search_index, 0, 0, 0, 0, :title_weight, 1.0) AS score
+    FROM search_index
+    WHERE search_index MATCH :query
+    ORDER BY score, rowid
+    LIMIT :limit OFFSET :offset
+)
+SELECT s.message_id, s.chat_id, c.title AS chat_title, c.project_id, s.kind, s.title,
+       snippet(search_index, 5, :mark_start, :mark_end, '…', :snippet_tokens) AS snippet,
+       page.score, m.created_at
+FROM search_index s
+CROSS JOIN page ON page.hit = +s.rowid
+CROSS JOIN chats c ON c.id = s.chat_id
+CROSS JOIN chat_messages m ON m.id = s.message_id
+WHERE search_index MATCH :query
+ORDER BY page.score, page.hit
+"""
+
+def search_messages(db: Session, q: str, limit: int, offset: int = 0, project_id: Optional[int] = None,
+                    user_id: Optional[int] = None, chat_id: Optional[int] = None, kind: Optional[str] = None) -> list:
+    params = {
+        "query": fts_query(q, _scope_tokens(project_id, user_id, chat_id, kind)),
+        "limit": limit, "offset": offset, "mark_start": "<mark>", "mark_end": "</mark>",
+        "snippet_tokens": SEARCH_SNIPPET_TOKENS, "title_weight": SEARCH_TITLE_WEIGHT,
+    }
+    statement = text(_SEARCH_SQL).columns(created_at=DateTime)
+    return db.execute(statement, params).mappings().all()
+
+def encode_offset_cursor(offset: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"offset": offset}).encode("utf-8")).decode("ascii").rstrip("=")
+
+def decode_offset_cursor(cursor: str) -> int:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        return max(0, int(json.loads(raw)["offset"]))
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+try:
+    search_index_created = create_search_index(engine)
+    migrate_message_artifacts()
+    if search_index_created:
+        rebuild_search_index()
+except Exception as e:
+    logger.error(f"Error preparing message artifacts and search index: {e}")
+    raise
+
+def _usage_columns(usage: dict | None) -> dict:
+    if not usage:
+        return {}
+    return {
+        "input_tokens": usage["input_tokens"],
+        "output_tokens": usage["output_tokens"],
+        "token_usage": json.dumps(usage),
+    }
+
+def _build_ai_message(chat_id: int, ai_response_dict: dict, usage: dict | None = None) -> "ChatMessage":
+    return ChatMessage(
+        chat_id=chat_id,
+        user_id=None,
+        message=None,
+        is_user=False,
+        artifacts=build_artifacts(ai_response_dict),
+        **_usage_columns(usage),
+    )
+
+def _save_ai_message(db: Session, chat_id: int, ai_response_dict: dict, usage: dict | None = None) -> "ChatMessageResponse":
+    with trace_span("ai_message_commit"):
+        bot_message = _build_ai_message(chat_id, ai_response_dict, usage)
+        db.add(bot_message)
+        db.commit()
+    # Serialized here, in the worker thread, since reading .message loads the artifact rows
+    return ChatMessageResponse.from_message(bot_message)
+
+def _prepare_chat(db: Session, request: "StoryRequest") -> "Chat":
+    # Ensure chat exists (guest mode - auto-create if missing)
+    with trace_span("chat_lookup") as span:
+        chat = db.query(Chat).filter(Chat.id == request.chat_id).first()
+        span.set(created=chat is None)
+        if not chat:
+            chat = Chat(title="New Chat", user_id=None, project_id=None)
+            db.add(chat)
+            db.commit()
+            db.refresh(chat)
+
+    # Save user's prompt message
+    with trace_span("user_message_commit"):
+        user_message = ChatMessage(
+            chat_id=chat.id,
+            user_id=None,
+            message=request.prompt,
+            is_user=True
+        )
+        db.add(user_message)
+        db.commit()
+    return chat
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+# Streaming generations keep running (and are saved) even if the client disconnects
+_background_tasks: set = set()
+
+# --- Background Jobs ---
+# Generations requested with background=True are persisted in generation_jobs and processed by
+# a fixed number of workers, independent of the HTTP request. Workers hold a lease on the job
+# they run and renew it while working; a job whose lease lapses (for example because the process
+# died) is picked up again by the next worker and resumes from the sections it already finished.
+# A worker that can no longer renew its lease stops working on the job rather than racing the next one.
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_LEASE_SECONDS = int(os.getenv("JOB_LEASE_SECONDS", "60"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "2"))
+JOB_MAX_ATTEMPTS = int(os.getenv("JOB_MAX_ATTEMPTS", "3"))
+
+_job_wakeup = asyncio.Event()
+_job_worker_tasks: list = []
+
+def _enqueue_job(db: Session, chat_id: int, request: "StoryRequest") -> "GenerationJob":
+    job = GenerationJob(
+        id=uuid.uuid4().hex,
+        chat_id=chat_id,
+        request=request.model_dump_json(),
+        status="queued",
+        artifacts=json.dumps({}),
+    )
+    db.add(job)
+    db.commit()
+    db.refresh(job)
+    return job
+
+def _claim_next_job(worker_id: str):
+    """Atomically take the oldest queued (or abandoned) job. Returns (job_id, chat_id, request, artifacts) or None."""
+    db = SessionLocal()
+    try:
+        now = datetime.utcnow()
+        claimable = or_(
+            GenerationJob.status == "queued",
+            and_(GenerationJob.status.in_(("running", "section_done")), GenerationJob.lease_expires_at < now),
+        )
+        for job in db.query(GenerationJob).filter(claimable).order_by(GenerationJob.created_at).limit(5):
+            if job.attempts >= JOB_MAX_ATTEMPTS:
+                job.status = "failed"
+                job.errors = json.dumps({"job": f"Abandoned after {job.attempts} attempts"})
+                job.updated_at = now
+                db.commit()
+                continue
+            # The attempts check makes the claim a compare-and-swap across workers and processes
+            claimed = db.query(GenerationJob).filter(
+                GenerationJob.id == job.id,
+                GenerationJob.attempts == job.attempts,
+            ).update(
+                {
+                    GenerationJob.status: "running",
+                    GenerationJob.attempts: job.attempts + 1,
+                    GenerationJob.worker_id: worker_id,
+                    GenerationJob.lease_expires_at: now + timedelta(seconds=JOB_LEASE_SECONDS),
+                    GenerationJob.updated_at: now,
+                },
+                synchronize_session=False,
+            )
+            db.commit()
+            if claimed:
+                return job.id, job.chat_id, json.loads(job.request), json.loads(job.artifacts or "{}")
+        return None
+    finally:
+        db.close()
+
+def _renew_job_lease(job_id: str, worker_id: str) -> bool:
+    """Extend the lease if worker_id still holds it. False means another worker has taken the job over."""
+    db = SessionLocal()
+    try:
+        renewed = db.query(GenerationJob).filter(
+            GenerationJob.id == job_id,
+            GenerationJob.worker_id == worker_id,
+        ).update(
+            {GenerationJob.lease_expires_at: datetime.utcnow() + timedelta(seconds=JOB_LEASE_SECONDS)},
+            synchronize_session=False,
+        )
+        db.commit()
+        return bool(renewed)
+    finally:
+        db.close()
+
+def _record_job_section(job_id: str, section: str, content: str) -> None:
+    db = SessionLocal()
+    try:
+        job = db.query(GenerationJob).filter(GenerationJob.id == job_id).first()
+        artifacts = json.loads(job.artifacts or "{}")
+        artifacts[section] = content
+        job.artifacts = json.dumps(artifacts)
+        job.status = "section_done"
+        job.updated_at = datetime.utcnow()
+        job.lease_expires_at = job.updated_at + timedelta(seconds=JOB_LEASE_SECONDS)
+        db.commit()
+    finally:
+        db.close()
+
+def _complete_job(job_id: str, chat_id: int, ai_response_dict: dict, usage: dict | None = None) -> None:
+    db = SessionLocal()
+    try:
+        # The AI message and the job state are committed together so a resumed job never saves twice
+        bot_message = _build_ai_message(chat_id, ai_response_dict, usage)
+        db.add(bot_message)
+        db.flush()
+        job = db.query(GenerationJob).filter(GenerationJob.id == job_id).first()
+        job.status = "complete"
+        job.message_id = bot_message.id
+        job.artifacts = json.dumps({s: ai_response_dict.get(s) for s in ARTIFACT_SECTIONS if ai_response_dict.get(s)})
+        job.errors = json.dumps(ai_response_dict["errors"]) if ai_response_dict.get("errors") else None
+        job.lease_expires_at = None
+        job.updated_at = datetime.utcnow()
+        db.commit()
+    finally:
+        db.close()
+
+def _fail_job(job_id: str, detail: str) -> None:
+    db = SessionLocal()
+    try:
+        db.query(GenerationJob).filter(GenerationJob.id == job_id).update(
+            {
+                GenerationJob.status: "failed",
+                GenerationJob.errors: json.dumps({"job": detail}),
+                GenerationJob.lease_expires_at: None,
+                GenerationJob.updated_at: datetime.utcnow(),
+            },
+            synchronize_session=False,
+        )
+        db.commit()
+    finally:
+        db.close()
+
+async def _keep_job_leased(job_id: str, worker_id: str) -> None:
+    """Renew the lease until cancelled. Returns once the lease can no longer be held, which stops the job."""
+    while True:
+        await asyncio.sleep(JOB_LEASE_SECONDS / 3)
+        try:
+            renewed = await run_db(_renew_job_lease, job_id, worker_id)
+        except Exception as e:
+            logger.error(f"Job {job_id} lease renewal failed: {_describe_error(e)}")
+            return
+        if not renewed:
+            logger.error(f"Job {job_id} lease was taken over by another worker")
+            return
+
+async def _run_job(job_id: str, worker_id: str, chat_id: int, request_data: dict, artifacts: dict) -> None:
+    request = StoryRequest(**request_data)
+    write_lock = asyncio.Lock()
+    writes: list = []
+
+    async def persist(section: str, content: str) -> None:
+        async with write_lock:
+            await run_db(_record_job_section, job_id, section, content)
+
+    def emit(event: str, data: dict) -> None:
+        # section_complete is reported from the event loop; token events are not persisted
+        if event == "section_complete":
+            writes.append(asyncio.ensure_future(persist(data["section"], data["content"])))
+
+    usage = LLMUsage()
+    heartbeat = asyncio.create_task(_keep_job_leased(job_id, worker_id))
+    generation = asyncio.create_task(_generate_artifacts(request, emit=emit, existing=artifacts, usage=usage))
+    try:
+        await asyncio.wait({generation, heartbeat}, return_when=asyncio.FIRST_COMPLETED)
+        if not generation.done():
+            # Without a lease another worker may already be running the job, so stop here and leave
+            # it to whoever claims it next (the finished sections are kept)
+            generation.cancel()
+            await asyncio.gather(generation, *writes, return_exceptions=True)
+            logger.error(f"Job {job_id} stopped on worker {worker_id} after losing its lease")
+            return
+        ai_response_dict = generation.result()
+        await asyncio.gather(*writes)
+        await run_db(_complete_job, job_id, chat_id, ai_response_dict, usage.as_dict())
+        logger.info(f"Job {job_id} complete")
+    except Exception as e:
+        logger.error(f"Job {job_id} failed: {_describe_error(e)}")
+        await asyncio.gather(*writes, return_exceptions=True)
+        await run_db(_fail_job, job_id, _describe_error(e))
+    finally:
+        generation.cancel()
+        heartbeat.cancel()
+
+async def job_worker(worker_id: str) -> None:
+    while True:
+        try:
+            claimed = await run_db(_claim_next_job, worker_id)
+        except Exception as e:
+            logger.error(f"Job worker {worker_id} could not claim a job: {e}")
+            claimed = None
+        if claimed is None:
+            _job_wakeup.clear()
+            try:
+                await asyncio.wait_for(_job_wakeup.wait(), timeout=JOB_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+            continue
+        job_id, chat_id, request_data, artifacts = claimed
+        logger.info(f"Worker {worker_id} running job {job_id} (resuming with {sorted(artifacts)})")
+        await _run_job(job_id, worker_id, chat_id, request_data, artifacts)
+
+def start_job_workers() -> None:
+    boot_id = uuid.uuid4().hex[:8]
+    for index in range(JOB_WORKERS):
+        _job_worker_tasks.append(asyncio.create_task(job_worker(f"{os.getpid()}-{boot_id}-{index}")))
+
+async def stop_job_workers() -> None:
+    for task in _job_worker_tasks:
+        task.cancel()
+    await asyncio.gather(*_job_worker_tasks, return_exceptions=True)
+    _job_worker_tasks.clear()
+
+# --- Startup ---
+LLM_WARMUP = os.getenv("LLM_WARMUP", "1") == "1"
+
+def warm_up_llm_clients() -> None:
+    """Build the default clients and chains and open the Gemini connection ahead of the first request."""
+    if not GEMINI_API_KEY:
+        return
+    try:
+        build_chains(None)
+        if model is not None:
+            # count_tokens is free and forces the TLS/connection setup on the shared client
+            model.count_tokens("warm-up")
+            # Register the cached system prompt now rather than on the first generation
+            context_cache.model_for(SYSTEM_PROMPT)
+        logger.info("LLM clients warmed up")
+    except Exception as e:
+        logger.warning(f"LLM warm-up failed: {e}")
+
+async def on_startup() -> None:
+    if LLM_WARMUP:
+        # Warm up in the background so the server starts accepting requests immediately
+        asyncio.get_running_loop().run_in_executor(llm_executor, warm_up_llm_clients)
+
 # API Endpoints
 @app.get("/")
 async def root():
     return {"message": "Welcome to StoryCrafter API (Guest Mode)"}
 
 @app.post("/signup", response_model=UserResponse)
-async def signup(user: UserCreate, db: Session = Depends(get_db)):
+async def signup(request: Request, user: UserCreate, db: Session = Depends(get_db)):
     try:
         logger.info(f"Attempting to create user with email: {user.email}")
-        db_user = get_user(db, email=user.email)
+        db_user = await run_db(get_user, db, email=user.email)
         if db_user:
             logger.warning(f"Email already registered: {user.email}")
             raise HTTPException(status_code=400, detail="Email already registered")
         
-        new_user = create_user(db, user)
+        async with hash_gate.slot(client_ip(request)):
+            hashed_password = await run_hash(get_password_hash, user.password)
+        new_user = await run_db(create_user, db, user, hashed_password)
         logger.info(f"Successfully created user with email: {user.email}")
         return new_user
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"Error during signup: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/token", response_model=Token)
-async def login(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = get_user(db, email=form_data.username)
-    if not user or not verify_password(form_data.password, user.hashed_password):
+async def login(request: Request, form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
+    async with hash_gate.slot(client_ip(request)):
+        user = await run_db(get_user, db, email=form_data.username)
+        verified, new_hash = False, None
+        if user:
+            verified, new_hash = await run_hash(verify_and_update_password, form_data.password, user.hashed_password)
+    if not verified:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect email or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        logger.info(f"Rehashing password for user {user.id} with the current bcrypt settings")
+        await run_db(store_password_hash, db, user, new_hash)
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
         data={"sub": user.email}, expires_delta=access_token_expires
     )
     return {"access_token": access_token, "token_type": "bearer", "user_id": user.id}
 
-@app.post("/api/generate-story", response_model=ChatMessageResponse)
+@app.post(
+    "/api/generate-story",
+    response_model=ChatMessageResponse,
+    responses={202: {"model": GenerationJobResponse, "description": "Job queued (background=true)"}},
+)
 async def generate_story(
     request: StoryRequest,
     db: Session = Depends(get_db)
 ):
     """
     Generate artifacts strictly using SYSTEM_PROMPT to enforce the multi-artifact template.
-    Persists messages and stores a JSON string with keys: description, story, test_cases.
+    Persists messages, storing each section as a message_artifacts row; the returned message is
+    the JSON string with keys: description, story, test_cases.
     """
     logger.info(f"Generating content for chat_id={request.chat_id} with mode={request.mode}")
+    validate_llm_config(request.llm_config)
     try:
-        # Ensure chat exists (guest mode - auto-create if missing)
-        chat = db.query(Chat).filter(Chat.id == request.chat_id).first()
-        if not chat:
-            chat = Chat(title="New Chat", user_id=None, project_id=None)
-            db.add(chat)
-            db.commit()
-            db.refresh(chat)
-
-        # Save user's prompt message
-        user_message = ChatMessage(
-            chat_id=chat.id,
-            user_id=None,
-            message=request.prompt,
-            is_user=True
-        )
-        db.add(user_message)
-        db.commit()
+        chat = await run_db(_prepare_chat, db, request)
+        if request.background:
+            job = await run_db(_enqueue_job, db, chat.id, request)
+            _job_wakeup.set()
+            logger.info(f"Queued generation job {job.id}")
+            return JSONResponse(status_code=202, content=GenerationJobResponse.from_job(job).model_dump(mode="json"))
 
-        # Always use SYSTEM_PROMPT for generation. Generate each artifact independently to enforce structure.
-        mode = (request.mode or "all").lower()
-
-        def _validate_story_format(output_text: str) -> tuple[bool, list[str]]:
-            failures: list[str] = []
-            text = (output_text or "").strip()
-            # Must include the exact label
-            if "User Story:" not in text:
-                failures.append("Missing 'User Story:' label")
-            # Must include required phrasing
-            normalized = text.lower()
-            if not ("as a" in normalized and "i want to" in normalized and "so that i can" in normalized):
-                failures.append("User Story sentence must use 'As a ... I want to ... so that I can ...'")
-            # Must include at least three acceptance criteria with GIVEN/WHEN/THEN
-            given_count = text.count("GIVEN ") + text.count("Given ")
-            when_present = (" WHEN " in text) or (" When " in text) or ("\nWhen " in text)
-            then_present = (" THEN " in text) or (" Then " in text) or ("\nThen " in text)
-            if given_count < 3:
-                failures.append("At least three acceptance criteria (GIVEN/WHEN/THEN) are required")
-            if not when_present:
-                failures.append("Acceptance criteria must include WHEN")
-            if not then_present:
-                failures.append("Acceptance criteria must include THEN")
-            # Disallow generic placeholders
-            if "achieve my goal" in normalized or "objective" in normalized:
-                failures.append("Avoid placeholders like 'achieve my goal' or 'objective'; be specific")
-            return (len(failures) == 0, failures)
-
-        def _validate_description_format(output_text: str) -> tuple[bool, list[str]]:
-            failures: list[str] = []
-            text = (output_text or "").strip()
-            # Required bold labels
-            required_labels = ["**Feature:**", "**Summary:**", "**Problem:**", "**Solution:**", "**Scope:"]
-            for label in required_labels:
-                if label not in text:
-                    failures.append(f"Missing '{label}' label")
-            # Scope should contain at least two bullet points
-            scope_index = text.find("**Scope:")
-            if scope_index != -1:
-                scope_part = text[scope_index:]
-                bullet_count = scope_part.count("\n*") + (1 if scope_part.strip().startswith("*") else 0)
-                if bullet_count < 2:
-                    failures.append("Scope should include at least two bullet points")
-            return (len(failures) == 0, failures)
-
-        def _validate_testcases_format(output_text: str) -> tuple[bool, list[str]]:
-            failures: list[str] = []
-            text = (output_text or "").strip()
-            # Must be in fenced gherkin block
-            if not (text.startswith("```gherkin") and text.endswith("```")):
-                failures.append("Test cases must be wrapped in a fenced code block starting with ```gherkin and ending with ```")
-            # Basic Gherkin structure
-            if "Feature:" not in text:
-                failures.append("Missing 'Feature:' header")
-            if "Scenario:" not in text:
-                failures.append("Missing 'Scenario:' block")
-            if "Scenario Outline:" not in text:
-                failures.append("Missing 'Scenario Outline:' block")
-            # Examples table
-            if "Examples:" not in text or "|" not in text:
-                failures.append("Missing 'Examples' table for the Scenario Outline")
-            # Given/When/Then lines
-            if (" Given " not in text and "\nGiven " not in text):
-                failures.append("At least one 'Given' is required")
-            if (" When " not in text and "\nWhen " not in text):
-                failures.append("At least one 'When' is required")
-            if (" Then " not in text and "\nThen " not in text):
-                failures.append("At least one 'Then' is required")
-            return (len(failures) == 0, failures)
-
-        def generate_section(section: str) -> str:
-            instruction = ""
-            if section == "description":
-                instruction = (
-                    "Output ONLY the 'Feature Description' section exactly as defined in the template, "
-                    "including the labeled fields and the 'Scope' bullet list. Do not include any other sections."
-                )
-            elif section == "story":
-                instruction = (
-                    "Output ONLY the 'User Story & Acceptance Criteria' section exactly as defined in the template. "
-                    "Ensure the 'User Story' sentence uses the specified phrasing and include at least three acceptance criteria "
-                    "using GIVEN/WHEN/THEN lines. Do not include other sections."
-                )
-            elif section == "test_cases":
-                instruction = (
-                    "Output ONLY the 'Test Cases' section exactly as defined in the template and wrap the body in a fenced "
-                    "code block starting with ```gherkin and ending with ```. Do not include other sections."
-                )
-            composed = (
-                f"{SYSTEM_PROMPT}\n\nNow, apply the process to the user's requirement. {instruction}\n\n"
-                f"User Requirement:\n{request.prompt}"
-            )
-            if model is None:
-                raise HTTPException(status_code=503, detail="LLM not configured: Set GEMINI_API_KEY in environment or .env")
-            response = model.generate_content(composed)
-            content = getattr(response, 'text', '') or ''
-            if section == "test_cases" and "```" not in content:
-                content = f"```gherkin\n{content}\n```"
-            content = content.strip()
-
-            # Validate and retry once with explicit feedback if story section fails checks
-            if section == "story":
-                ok, reasons = _validate_story_format(content)
-                if not ok:
-                    fix_note = (
-                        "Your previous output failed these checks: " + "; ".join(reasons) + ". "
-                        "Rewrite to strictly satisfy the template: include 'User Story:' heading, use the exact phrasing 'As a ... I want to ... so that I can ...' with specific objective (no placeholders), and include at least three acceptance criteria with GIVEN/WHEN/THEN. Output only this section."
-                    )
-                    composed_retry = (
-                        f"{SYSTEM_PROMPT}\n\n{fix_note}\n\nUser Requirement:\n{request.prompt}"
-                    )
-                    response_retry = model.generate_content(composed_retry)
-                    content_retry = getattr(response_retry, 'text', '') or ''
-                    content = content_retry.strip() or content
-
-            if section == "description":
-                ok, reasons = _validate_description_format(content)
-                if not ok:
-                    fix_note = (
-                        "Your previous output failed these checks: " + "; ".join(reasons) + ". "
-                        "Rewrite to strictly satisfy the template: include all bold labels exactly (**Feature:**, **Summary:**, **Problem:**, **Solution:**, **Scope:**) and ensure Scope has at least two bullet points. Output only this section."
-                    )
-                    composed_retry = (
-                        f"{SYSTEM_PROMPT}\n\n{fix_note}\n\nUser Requirement:\n{request.prompt}"
-                    )
-                    response_retry = model.generate_content(composed_retry)
-                    content_retry = getattr(response_retry, 'text', '') or ''
-                    content = content_retry.strip() or content
-
-            if section == "test_cases":
-                ok, reasons = _validate_testcases_format(content)
-                if not ok:
-                    fix_note = (
-                        "Your previous output failed these checks: " + "; ".join(reasons) + ". "
-                        "Rewrite to strictly satisfy the template: wrap in ```gherkin fenced block, include 'Feature:', at least one 'Scenario:' and one 'Scenario Outline:' with an 'Examples' table, and use Given/When/Then lines. Output only this section."
-                    )
-                    composed_retry = (
-                        f"{SYSTEM_PROMPT}\n\n{fix_note}\n\nUser Requirement:\n{request.prompt}"
-                    )
-                    response_retry = model.generate_content(composed_retry)
-                    content_retry = getattr(response_retry, 'text', '') or ''
-                    # Ensure fenced block on retry
-                    if "```" not in content_retry:
-                        content_retry = f"```gherkin\n{content_retry}\n```"
-                    content = content_retry.strip() or content
-
-            return content
-
-        # If llm_config provided, use LangChain multi-LLM path; else fallback to direct Gemini
-        ai_response_dict = {"description": None, "story": None, "test_cases": None}
-        if hasattr(request, "llm_config") and request.llm_config:
-            chains = build_chains(request.llm_config)
-            ai_response_dict = chains["final_chain"].invoke({"requirement": request.prompt})
-        else:
-            # direct Gemini generation path
-            pass
-        if mode == "description":
-            ai_response_dict["description"] = generate_section("description")
-        elif mode == "story":
-            ai_response_dict["story"] = generate_section("story")
-        elif mode == "test_cases":
-            ai_response_dict["test_cases"] = generate_section("test_cases")
-        else:
-            ai_response_dict["description"] = generate_section("description")
-            ai_response_dict["story"] = generate_section("story")
-            ai_response_dict["test_cases"] = generate_section("test_cases")
-
-        # Save AI response as JSON string
-        ai_message_content = json.dumps(ai_response_dict)
-        bot_message = ChatMessage(
-            chat_id=chat.id,
-            user_id=None,
-            message=ai_message_content,
-            is_user=False
-        )
-        db.add(bot_message)
-        db.commit()
-        db.refresh(bot_message)
+        ai_response_dict, usage = await generate_coalesced(request)
+        bot_message = await run_db(_save_ai_message, db, chat.id, ai_response_dict, usage)
 
         logger.info("Content generated and saved successfully")
         return bot_message
@@ -948,9 +4276,167 @@ async def generate_story(
         logger.error(f"Unexpected error in generate_story: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
+@app.post("/api/generate-story/stream")
+async def generate_story_stream(
+    request: StoryRequest,
+    db: Session = Depends(get_db)
+):
+    """
+    Server-Sent Events variant of /api/generate-story.
+    Emits `token` events per section as Gemini streams them, `validation` and `section_complete`
+    events as each section settles, and a final `done` event carrying the saved ChatMessage.
+    """
+    logger.info(f"Streaming content for chat_id={request.chat_id} with mode={request.mode}")
+    validate_llm_config(request.llm_config)
+    chat = await run_db(_prepare_chat, db, request)
+    chat_id = chat.id
+
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def emit(event: str, data: dict) -> None:
+        # Called from worker threads while tokens arrive, so hop back onto the loop
+        loop.call_soon_threadsafe(queue.put_nowait, (event, data))
+
+    def save(ai_response_dict: dict, usage: dict) -> dict:
+        session = SessionLocal()
+        try:
+            return _save_ai_message(session, chat_id, ai_response_dict, usage).model_dump(mode="json")
+        finally:
+            session.close()
+
+    async def generate_and_save() -> dict:
+        usage = LLMUsage()
+        ai_response_dict = await _generate_artifacts(request, emit=emit, usage=usage)
+        return await run_db(save, ai_response_dict, usage.as_dict())
+
+    task = asyncio.create_task(generate_and_save())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    task.add_done_callback(lambda _: queue.put_nowait((None, None)))
+
+    async def event_stream():
+        yield _sse("start", {"chat_id": chat_id, "mode": request.mode})
+        while True:
+            event, data = await queue.get()
+            if event is None:
+                break
+            yield _sse(event, data)
+        try:
+            yield _sse("done", task.result())
+            logger.info("Streamed content generated and saved successfully")
+        except Exception as e:
+            logger.error(f"Unexpected error in generate_story_stream: {_describe_error(e)}")
+            yield _sse("error", {"detail": _describe_error(e)})
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.get("/api/jobs/{job_id}", response_model=GenerationJobResponse)
+def get_generation_job(job_id: str, db: Session = Depends(get_db)):
+    job = db.query(GenerationJob).filter(GenerationJob.id == job_id).first()
+    if not job:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return GenerationJobResponse.from_job(job)
+
+@app.get("/api/cache/stats")
+async def get_generation_cache_stats():
+    return generation_cache.stats()
+
+@app.get("/api/auth/cache/stats")
+async def get_auth_cache_stats():
+    return auth_user_cache.stats()
+
+@app.get("/api/auth/login/stats")
+async def get_login_stats():
+    return {**hash_gate.stats(), "hash_pool_size": HASH_POOL_SIZE, "bcrypt_rounds": BCRYPT_ROUNDS}
+
+@app.get("/api/generation/stats")
+async def get_generation_stats():
+    return {**generation_stats.snapshot(), "hedging": hedge_policy.stats(), "rate_limiter": llm_limiter.stats(),
+            "routing": provider_router.stats(), "in_flight_generations": generation_flights.in_flight(),
+            "context_cache": context_cache.stats()}
+
+# --- Metrics Endpoint ---
+# Scrape-time collectors over the stats the components above already keep
+CACHES = {"generation": generation_cache, "auth_user": auth_user_cache, "context": context_cache}
+# Non-counter keys in the caches' stats()
+CACHE_STATS_GAUGES = ("entries", "memory_entries", "handles", "hit_ratio", "enabled", "cached_tokens")
+
+def _cache_hit_ratio(name: str, stats: dict) -> float:
+    if name == "context":
+        # A context cache miss is a call that went inline with the full prompt
+        lookups = stats["hits"] + stats["fallbacks"]
+        return round(stats["hits"] / lookups, 4) if lookups else 0.0
+    return stats["hit_ratio"]
+
+def _collect_cache_events():
+    for name, cache in CACHES.items():
+        for event_name, value in cache.stats().items():
+            if event_name not in CACHE_STATS_GAUGES:
+                yield (name, event_name), value
+
+def _collect_job_queue():
+    db = SessionLocal()
+    try:
+        counts = dict(db.query(GenerationJob.status, func.count()).group_by(GenerationJob.status).all())
+    finally:
+        db.close()
+    return [((job_status,), counts.get(job_status, 0)) for job_status in ("queued", "running", "section_done", "failed", "complete")]
+
+metrics.collector(
+    "cache_events_total", "Cache lookups and maintenance by cache and event.", "counter", ("cache", "event"), _collect_cache_events,
+)
+metrics.collector(
+    "cache_hit_ratio", "Hits over lookups since startup, by cache.", "gauge", ("cache",),
+    lambda: [((name,), _cache_hit_ratio(name, cache.stats())) for name, cache in CACHES.items()],
+)
+metrics.collector(
+    "llm_cached_tokens_total", "Input tokens served from the provider context cache.", "counter", (),
+    lambda: [((), context_cache.stats()["cached_tokens"])],
+)
+metrics.collector(
+    "generation_events_total", "Generation pipeline events (validation, repairs, retries, hedging, coalescing).",
+    "counter", ("event",), lambda: [((name,), value) for name, value in generation_stats.snapshot().items()],
+)
+metrics.collector(
+    "llm_limiter_events_total", "LLM limiter admissions, 429s, rate-limit retries, backoffs and queue timeouts.",
+    "counter", ("event",), lambda: [((name,), value) for name, value in llm_limiter.stats().items() if name in llm_limiter.counters],
+)
+metrics.collector(
+    "llm_limiter_queue", "LLM calls waiting for and holding a limiter slot.", "gauge", ("state",),
+    lambda: [((state,), llm_limiter.stats()[state]) for state in ("queued", "in_flight")],
+)
+metrics.collector(
+    "llm_limiter_concurrency_limit", "Current adaptive LLM concurrency limit.", "gauge", (),
+    lambda: [((), llm_limiter.stats()["limit"])],
+)
+metrics.collector(
+    "generations_in_flight", "Distinct generations running (coalesced requests share one).", "gauge", (),
+    lambda: [((), generation_flights.in_flight())],
+)
+metrics.collector(
+    "login_hash_pending", "Password checks running or queued for the hash pool.", "gauge", (),
+    lambda: [((), hash_gate.stats()["pending"])],
+)
+metrics.collector(
+    "login_events_total", "Password checks admitted and rejected by the login gate.", "counter", ("event",),
+    lambda: [((name,), value) for name, value in hash_gate.counters.items()],
+)
+metrics.collector("generation_jobs", "Background generation jobs by status.", "gauge", ("status",), _collect_job_queue)
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def get_metrics():
+    # Rendering sums per-thread arrays and counts jobs, so keep it off the event loop
+    body = await run_db(metrics.render)
+    return PlainTextResponse(body, media_type="text/plain; version=0.0.4; charset=utf-8")
+
 # Project endpoints
 @app.post("/projects/", response_model=ProjectResponse)
-async def create_project(
+def create_project(
     project: ProjectCreate,
     current_user: UserModel = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -962,14 +4448,19 @@ async def create_project(
     return db_project
 
 @app.get("/projects/", response_model=list[ProjectResponse])
-async def get_user_projects(
+def get_user_projects(
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
     current_user: UserModel = Depends(get_current_user),
     db: Session = Depends(get_db)
 ):
-    return db.query(Project).filter(Project.user_id == current_user.id).all()
+    query = db.query(Project).filter(Project.user_id == current_user.id)
+    return paginate(query, Project, cursor, limit, response, order)
 
 @app.get("/projects/{project_id}", response_model=ProjectResponse)
-async def get_project(
+def get_project(
     project_id: int,
     current_user: UserModel = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -984,7 +4475,7 @@ async def get_project(
 
 # Chat endpoints
 @app.post("/chats/", response_model=ChatResponse)
-async def create_chat(
+def create_chat(
     chat: ChatCreate,
     db: Session = Depends(get_db)
 ):
@@ -1003,17 +4494,68 @@ async def create_chat(
     return db_chat
 
 @app.get("/chats/", response_model=list[ChatResponse])
-async def get_user_chats(
+def get_user_chats(
+    response: Response,
+    project_id: Optional[int] = None,
+    cursor: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    order: str = Query("desc", pattern="^(asc|desc)$"),
+    db: Session = Depends(get_db)
+):
+    query = db.query(Chat)
+    if project_id is not None:
+        query = query.filter(Chat.project_id == project_id)
+    return paginate(query, Chat, cursor, limit, response, order)
+
+@app.get("/chats/with-messages/", response_model=list[ChatWithMessagesResponse])
+def get_chats_with_messages(
     project_id: Optional[int] = None,
+    limit: Optional[int] = Query(None, ge=1),
+    messages_per_chat: Optional[int] = Query(None, ge=1),
+    include_artifacts: bool = True,
     db: Session = Depends(get_db)
 ):
+    """
+    Chats together with their messages in two queries, replacing one /messages/ request per chat.
+    Returns every chat (oldest first), or only the `limit` most recent ones, and, if messages_per_chat is set,
+    only the latest N messages of each. With include_artifacts=false AI replies carry section
+    summaries instead of their bodies.
+    """
     query = db.query(Chat)
     if project_id is not None:
         query = query.filter(Chat.project_id == project_id)
-    return query.all()
+    if limit is None:
+        chats = query.order_by(Chat.created_at, Chat.id).all()
+    else:
+        chats = query.order_by(Chat.created_at.desc(), Chat.id.desc()).limit(limit).all()[::-1]
+    if not chats:
+        return []
+
+    chat_ids = [chat.id for chat in chats]
+    messages_query = db.query(ChatMessage).filter(ChatMessage.chat_id.in_(chat_ids))
+    if messages_per_chat is not None:
+        ranked = db.query(
+            ChatMessage.id.label("id"),
+            func.row_number().over(
+                partition_by=ChatMessage.chat_id,
+                order_by=(ChatMessage.created_at.desc(), ChatMessage.id.desc()),
+            ).label("position"),
+        ).filter(ChatMessage.chat_id.in_(chat_ids)).subquery()
+        messages_query = messages_query.join(ranked, ranked.c.id == ChatMessage.id).filter(ranked.c.position <= messages_per_chat)
+
+    messages_query = messages_query.options(_artifact_loader(include_artifacts))
+    messages_by_chat: dict[int, list] = {chat_id: [] for chat_id in chat_ids}
+    for message in messages_query.order_by(ChatMessage.chat_id, ChatMessage.created_at, ChatMessage.id):
+        messages_by_chat[message.chat_id].append(ChatMessageResponse.from_message(message, include_artifacts))
+
+    # Built explicitly so pydantic does not touch the lazy Chat.messages relationship
+    return [
+        ChatWithMessagesResponse(**ChatResponse.model_validate(chat).model_dump(), messages=messages_by_chat[chat.id])
+        for chat in chats
+    ]
 
 @app.get("/chats/{chat_id}", response_model=ChatResponse)
-async def get_chat(
+def get_chat(
     chat_id: int,
     db: Session = Depends(get_db)
 ):
@@ -1025,7 +4567,7 @@ async def get_chat(
     return chat
 
 @app.put("/projects/{project_id}", response_model=ProjectResponse)
-async def update_project(
+def update_project(
     project_id: int,
     project: ProjectCreate,
     current_user: UserModel = Depends(get_current_user),
@@ -1044,7 +4586,7 @@ async def update_project(
     return db_project
 
 @app.delete("/projects/{project_id}", status_code=204)
-async def delete_project(
+def delete_project(
     project_id: int,
     current_user: UserModel = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -1060,7 +4602,7 @@ async def delete_project(
     return None
 
 @app.delete("/chats/{chat_id}", status_code=204)
-async def delete_chat(
+def delete_chat(
     chat_id: int,
     current_user: UserModel = Depends(get_current_user),
     db: Session = Depends(get_db)
@@ -1076,7 +4618,7 @@ async def delete_chat(
     return None
 
 @app.post("/chats/{chat_id}/messages/", response_model=ChatMessageResponse)
-async def create_chat_message(
+def create_chat_message(
     chat_id: int,
     message: ChatMessageCreate,
     db: Session = Depends(get_db)
@@ -1100,10 +4642,19 @@ async def create_chat_message(
     return db_message
 
 @app.get("/chats/{chat_id}/messages/", response_model=list[ChatMessageResponse])
-async def get_chat_messages(
+def get_chat_messages(
     chat_id: int,
+    response: Response,
+    cursor: Optional[str] = None,
+    limit: Optional[int] = Query(None, ge=1, le=PAGE_SIZE_MAX),
+    order: str = Query("asc", pattern="^(asc|desc)$"),
+    include_artifacts: bool = True,
     db: Session = Depends(get_db)
 ):
+    """
+    The chat's messages oldest first. Without limit the whole conversation is returned, as it always
+    was; with limit, one page, and the next page's cursor is returned in the X-Next-Cursor header.
+    """
     # Guest mode: just ensure chat exists
     chat = db.query(Chat).filter(
         Chat.id == chat_id
@@ -1111,7 +4662,60 @@ async def get_chat_messages(
     if not chat:
         raise HTTPException(status_code=404, detail="Chat not found")
 
-    return db.query(ChatMessage).filter(ChatMessage.chat_id == chat_id).order_by(ChatMessage.created_at).all()
+    query = db.query(ChatMessage).filter(ChatMessage.chat_id == chat_id).options(_artifact_loader(include_artifacts))
+    messages = paginate(query, ChatMessage, cursor, limit, response, order)
+    return [ChatMessageResponse.from_message(message, include_artifacts) for message in messages]
+
+@app.get("/search/", response_model=list[SearchResult])
+def search(
+    response: Response,
+    q: str = Query(..., min_length=1, max_length=500),
+    project_id: Optional[int] = None,
+    user_id: Optional[int] = None,
+    chat_id: Optional[int] = None,
+    kind: Optional[str] = Query(None, pattern="^(prompt|reply|description|story|test_cases)$"),
+    cursor: Optional[str] = None,
+    limit: int = Query(PAGE_SIZE_DEFAULT, ge=1, le=PAGE_SIZE_MAX),
+    db: Session = Depends(get_db)
+):
+    """
+    Full-text search over prompts, replies and generated artifacts, best match first.
+    Every word must match and the last one may be a prefix. The next page's cursor is returned
+    in the X-Next-Cursor header.
+    """
+    offset = decode_offset_cursor(cursor) if cursor else 0
+    rows = search_messages(db, q, limit + 1, offset, project_id=project_id, user_id=user_id, chat_id=chat_id, kind=kind)
+    if len(rows) > limit:
+        rows = rows[:limit]
+        response.headers["X-Next-Cursor"] = encode_offset_cursor(offset + limit)
+    return [SearchResult(**row) for row in rows]
+
+@app.get("/chats/{chat_id}/messages/{message_id}/artifacts", response_model=list[MessageArtifactSummary])
+def get_message_artifacts(
+    chat_id: int,
+    message_id: int,
+    db: Session = Depends(get_db)
+):
+    """The sections of an AI reply with hash, sizes and validation status, without reading their bodies."""
+    artifacts = _message_artifacts_query(db, chat_id, message_id).order_by(MessageArtifact.id).all()
+    return [MessageArtifactSummary.from_artifact(artifact) for artifact in artifacts]
+
+@app.get("/chats/{chat_id}/messages/{message_id}/artifacts/{section}", response_model=MessageArtifactResponse)
+def get_message_artifact(
+    chat_id: int,
+    message_id: int,
+    section: str,
+    db: Session = Depends(get_db)
+):
+    artifact = (
+        _message_artifacts_query(db, chat_id, message_id)
+        .filter(MessageArtifact.section == section)
+        .options(undefer(MessageArtifact.body))
+        .first()
+    )
+    if not artifact:
+        raise HTTPException(status_code=404, detail="Artifact not found")
+    return MessageArtifactResponse.from_artifact(artifact, content=artifact.content)
 
 if __name__ == "__main__":
     import uvicorn
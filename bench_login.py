@@ -0,0 +1,97 @@
+"""
+Login benchmark: login throughput, and latency of a cheap endpoint while logins are in flight.
+
+Usage: python bench_login.py [--logins N] [--clients N] [--seconds S] [--inline]
+
+Runs the app in-process on one event loop (as a uvicorn worker would) against a scratch database,
+with each simulated client on its own IP. --inline verifies passwords on the event loop instead of
+the hash pool, which is how /token used to behave, for comparison.
+"""
+import argparse
+import asyncio
+import logging
+import os
+import sys
+import tempfile
+import time
+
+EMAIL = "bench@example.com"
+PASSWORD = "correct horse battery staple"
+
+
+def percentile(samples, fraction):
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * fraction))] * 1000 if ordered else 0.0
+
+async def login_client(httpx, app, ip, deadline, results):
+    transport = httpx.ASGITransport(app=app, client=(ip, 40000))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        while time.perf_counter() < deadline:
+            response = await client.post("/token", data={"username": EMAIL, "password": PASSWORD})
+            results[response.status_code] = results.get(response.status_code, 0) + 1
+            if response.status_code == 429:
+                await asyncio.sleep(0.1)
+
+async def probe(httpx, app, deadline, latencies, interval=0.01):
+    """GET / on a fixed schedule; latency counts from when the request was due, so time the loop
+    spent blocked before it could even send is included."""
+    transport = httpx.ASGITransport(app=app, client=("10.0.0.1", 40000))
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        due = time.perf_counter()
+        while due < deadline:
+            await client.get("/")
+            latencies.append(time.perf_counter() - due)
+            due += interval
+            await asyncio.sleep(max(0.0, due - time.perf_counter()))
+
+async def run(app, httpx, logins, clients, seconds):
+    latencies, results = [], {}
+    deadline = time.perf_counter() + seconds
+    tasks = [probe(httpx, app, deadline, latencies)]
+    if logins:
+        tasks += [
+            login_client(httpx, app, f"10.1.{index // 250}.{index % 250 + 1}", deadline, results)
+            for index in range(clients)
+            for _ in range(logins)
+        ]
+    await asyncio.gather(*tasks)
+    return latencies, results
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--logins", type=int, default=2, help="concurrent logins per client")
+    parser.add_argument("--clients", type=int, default=8, help="client IPs logging in")
+    parser.add_argument("--seconds", type=float, default=10.0, help="duration of each phase")
+    parser.add_argument("--inline", action="store_true", help="verify on the event loop (old behaviour)")
+    args = parser.parse_args()
+
+    os.chdir(tempfile.mkdtemp(prefix="bench_login_"))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import httpx
+    import app
+    logging.disable(logging.WARNING)
+
+    db = app.SessionLocal()
+    try:
+        app.create_user(db, app.UserCreate(email=EMAIL, password=PASSWORD))
+    finally:
+        db.close()
+    if args.inline:
+        async def run_inline(fn, *fn_args, **fn_kwargs):
+            return fn(*fn_args, **fn_kwargs)
+        app.run_hash = run_inline
+
+    print(f"bcrypt rounds {app.BCRYPT_ROUNDS}, hash pool {app.HASH_POOL_SIZE}, cpus {os.cpu_count()}, "
+          f"{'inline' if args.inline else 'hash pool'} verification\n")
+    print(f"{'phase':<16} {'logins/s':>9} {'429s':>6} {'GET / p50 ms':>13} {'p99 ms':>9} {'max ms':>9}")
+    print("-" * 68)
+    for phase, logins in (("idle", 0), ("login storm", args.logins)):
+        latencies, results = asyncio.run(run(app.app, httpx, logins, args.clients, args.seconds))
+        throughput = results.get(200, 0) / args.seconds
+        print(
+            f"{phase:<16} {throughput:>9.1f} {results.get(429, 0):>6} {percentile(latencies, 0.5):>13.1f} "
+            f"{percentile(latencies, 0.99):>9.1f} {max(latencies) * 1000:>9.1f}"
+        )
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,118 @@
+"""
+Search benchmark: fills a scratch database with chats, prompts and generated artifacts, then times
+/search/ queries against it and prints their SQLite query plans.
+
+Usage: python bench_search.py [--messages N] [--repeat N]
+
+Runs offline in a temporary directory (no API key needed); the real storycrafter.db is not touched.
+"""
+import argparse
+import os
+import random
+import sys
+import tempfile
+import time
+
+WORDS = (
+    "invoice billing export csv report dashboard login password reset admin user role permission "
+    "search filter saved notification email upload attachment calendar reminder payment refund "
+    "subscription plan trial onboarding profile avatar audit log archive share comment mention"
+).split()
+
+QUERIES = ["invoice", "export csv", "password reset", "refu", "saved filter dashboard", "zzzz"]
+
+# Long tail of filler words so term frequencies look more like real prose than a 40-word corpus
+FILLER = [f"{a}{b}{c}" for a in "bcdfgklmnprst" for b in "aeiou" for c in ("ra", "lo", "nen", "tis", "mar", "vek")]
+
+
+def words(rng, count):
+    return " ".join(rng.choice(WORDS) if rng.random() < 0.15 else rng.choice(FILLER) for _ in range(count))
+
+def fake_artifacts(rng):
+    feature = words(rng, 3).title()
+    action = words(rng, 4)
+    return {
+        "description": (
+            f"**Feature:** {feature}\n\n**Summary:** {action}.\n\n**Problem:** {words(rng, 8)}.\n\n"
+            f"**Solution:** {words(rng, 8)}.\n\n**Scope:**\n* {action}\n* {words(rng, 4)}"
+        ),
+        "story": (
+            f"**User Story:** As a user, I want to {action}, so that I can {words(rng, 3)}.\n\n"
+            "**Acceptance Criteria:**\n"
+            + "\n".join(f"* GIVEN {rng.choice(WORDS)}, WHEN {rng.choice(WORDS)}, THEN {rng.choice(WORDS)}." for _ in range(3))
+        ),
+        "test_cases": (
+            f"```gherkin\nFeature: {feature}\n\n  Scenario: {action}\n    Given {rng.choice(WORDS)}\n"
+            f"    When {rng.choice(WORDS)}\n    Then {rng.choice(WORDS)}\n\n  Scenario Outline: {rng.choice(WORDS)}\n"
+            "    Given <a>\n    When <b>\n    Then <c>\n\n    Examples:\n      | a | b | c |\n      | 1 | 2 | 3 |\n```"
+        ),
+    }
+
+def populate(app, messages, rng):
+    """Half prompts, half AI replies, 20 messages per chat, 50 chats per project; written through the ORM."""
+    db = app.SessionLocal()
+    try:
+        project = chat = None
+        for index in range(0, messages, 2):
+            if index % 1000 == 0:
+                project = app.Project(name=f"project {index // 1000}", overview="", type="", industry="")
+                db.add(project)
+            if index % 20 == 0:
+                chat = app.Chat(title=" ".join(rng.sample(WORDS, 2)), project=project)
+                db.add(chat)
+                db.flush()
+            db.add(app.ChatMessage(chat_id=chat.id, message=words(rng, 12), is_user=True))
+            db.add(app._build_ai_message(chat.id, fake_artifacts(rng)))
+            if index % 2000 == 0:
+                db.commit()
+                print(f"\r  {index:>7}/{messages}", end="", flush=True)
+        db.commit()
+        print()
+    finally:
+        db.close()
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--messages", type=int, default=100_000, help="messages to create")
+    parser.add_argument("--repeat", type=int, default=20, help="runs per query")
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_search_")
+    os.chdir(workdir)
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import app
+
+    rng = random.Random(42)
+    print(f"Populating {args.messages} messages in {workdir}")
+    started = time.perf_counter()
+    populate(app, args.messages, rng)
+    print(f"  done in {time.perf_counter() - started:.1f}s")
+
+    db = app.SessionLocal()
+    try:
+        rows = db.execute(app.text("SELECT count(*) FROM search_index")).scalar()
+        print(f"\nsearch_index rows: {rows}\n")
+        print(f"{'query':<26} {'scope':<10} {'hits':>5} {'ms (median)':>12}")
+        print("-" * 56)
+        for query in QUERIES:
+            for scope, filters in (("all", {}), ("project", {"project_id": 7})):
+                timings = []
+                for _ in range(args.repeat):
+                    started = time.perf_counter()
+                    results = app.search_messages(db, query, 50, **filters)
+                    timings.append((time.perf_counter() - started) * 1000)
+                timings.sort()
+                print(f"{query:<26} {scope:<10} {len(results):>5} {timings[len(timings) // 2]:>12.2f}")
+
+        print("\nQuery plan (project-scoped):")
+        params = {
+            "query": app.fts_query("invoice", app._scope_tokens(project_id=7)), "limit": 50, "offset": 0,
+            "mark_start": "[", "mark_end": "]", "snippet_tokens": 16, "title_weight": 4.0,
+        }
+        for row in db.execute(app.text(f"EXPLAIN QUERY PLAN {app._SEARCH_SQL}"), params):
+            print(f"  {row[-1]}")
+    finally:
+        db.close()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,165 @@
+"""
+Micro-benchmark: compiled single-pass validators vs. the previous per-rule substring checks.
+
+Usage: python bench_validators.py [--repeat N] [--scale N]
+
+Runs offline (no API key needed). Also checks that both implementations report the same
+failures on every sample before timing them.
+"""
+import argparse
+import random
+import timeit
+
+from app import SECTION_VALIDATORS
+
+
+# Previous implementation, kept here verbatim as the baseline
+def legacy_validate_story_format(output_text):
+    failures = []
+    text = (output_text or "").strip()
+    if "User Story:" not in text:
+        failures.append("Missing 'User Story:' label")
+    normalized = text.lower()
+    if not ("as a" in normalized and "i want to" in normalized and "so that i can" in normalized):
+        failures.append("User Story sentence must use 'As a ... I want to ... so that I can ...'")
+    given_count = text.count("GIVEN ") + text.count("Given ")
+    when_present = (" WHEN " in text) or (" When " in text) or ("\nWhen " in text)
+    then_present = (" THEN " in text) or (" Then " in text) or ("\nThen " in text)
+    if given_count < 3:
+        failures.append("At least three acceptance criteria (GIVEN/WHEN/THEN) are required")
+    if not when_present:
+        failures.append("Acceptance criteria must include WHEN")
+    if not then_present:
+        failures.append("Acceptance criteria must include THEN")
+    if "achieve my goal" in normalized or "objective" in normalized:
+        failures.append("Avoid placeholders like 'achieve my goal' or 'objective'; be specific")
+    return (len(failures) == 0, failures)
+
+def legacy_validate_description_format(output_text):
+    failures = []
+    text = (output_text or "").strip()
+    required_labels = ["**Feature:**", "**Summary:**", "**Problem:**", "**Solution:**", "**Scope:"]
+    for label in required_labels:
+        if label not in text:
+            failures.append(f"Missing '{label}' label")
+    scope_index = text.find("**Scope:")
+    if scope_index != -1:
+        scope_part = text[scope_index:]
+        bullet_count = scope_part.count("\n*") + (1 if scope_part.strip().startswith("*") else 0)
+        if bullet_count < 2:
+            failures.append("Scope should include at least two bullet points")
+    return (len(failures) == 0, failures)
+
+def legacy_validate_testcases_format(output_text):
+    failures = []
+    text = (output_text or "").strip()
+    if not (text.startswith("```gherkin") and text.endswith("```")):
+        failures.append("Test cases must be wrapped in a fenced code block starting with ```gherkin and ending with ```")
+    if "Feature:" not in text:
+        failures.append("Missing 'Feature:' header")
+    if "Scenario:" not in text:
+        failures.append("Missing 'Scenario:' block")
+    if "Scenario Outline:" not in text:
+        failures.append("Missing 'Scenario Outline:' block")
+    if "Examples:" not in text or "|" not in text:
+        failures.append("Missing 'Examples' table for the Scenario Outline")
+    if (" Given " not in text and "\nGiven " not in text):
+        failures.append("At least one 'Given' is required")
+    if (" When " not in text and "\nWhen " not in text):
+        failures.append("At least one 'When' is required")
+    if (" Then " not in text and "\nThen " not in text):
+        failures.append("At least one 'Then' is required")
+    return (len(failures) == 0, failures)
+
+LEGACY_VALIDATORS = {
+    "description": legacy_validate_description_format,
+    "story": legacy_validate_story_format,
+    "test_cases": legacy_validate_testcases_format,
+}
+
+DESCRIPTION = """**Feature:** Saved searches
+**Summary:** Let analysts store and rerun filters.
+**Problem:** Analysts rebuild the same filters every morning.
+**Solution:** Persist named filter sets per user.
+**Scope:**
+* Save, rename and delete searches
+* Run a saved search from the sidebar
+"""
+
+STORY = """User Story:
+As a data analyst, I want to save my search filters so that I can rerun them quickly.
+
+Acceptance Criteria:
+1. GIVEN I have applied filters WHEN I click save THEN the search is stored
+2. GIVEN a saved search exists WHEN I open the sidebar THEN it is listed
+3. GIVEN a saved search WHEN I delete it THEN it disappears
+"""
+
+TEST_CASES = """```gherkin
+Feature: Saved searches
+  Scenario: Save a search
+    Given I have applied filters
+    When I click save
+    Then the search is stored
+
+  Scenario Outline: Rename a search
+    Given a saved search named "<old>"
+    When I rename it to "<new>"
+    Then it is listed as "<new>"
+
+    Examples:
+      | old   | new     |
+      | daily | morning |
+```"""
+
+SAMPLES = {"description": DESCRIPTION, "story": STORY, "test_cases": TEST_CASES}
+
+FILLER = "Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor.\n"
+
+
+def make_large(section, scale):
+    """A realistic valid section padded with prose to simulate a long model output."""
+    sample = SAMPLES[section]
+    body = FILLER * scale
+    if section == "test_cases":
+        return sample[:-3] + "\n# " + body.replace("\n", "\n# ") + "\n```"
+    return sample + body
+
+def make_broken(section, scale, rng):
+    """Drop random lines from a large sample so that various rules fail."""
+    lines = make_large(section, scale).split("\n")
+    keep = [line for line in lines if rng.random() > 0.3]
+    return "\n".join(keep)
+
+def check_equivalence(rng):
+    checked = 0
+    for section in SAMPLES:
+        corpus = [SAMPLES[section], make_large(section, 50), ""]
+        corpus += [make_broken(section, 5, rng) for _ in range(300)]
+        for text in corpus:
+            legacy_ok, legacy_reasons = LEGACY_VALIDATORS[section](text)
+            result = SECTION_VALIDATORS[section](text)
+            assert (legacy_ok, legacy_reasons) == (result.ok, result.reasons), (section, text, legacy_reasons, result.reasons)
+            checked += 1
+    return checked
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=200, help="validations per timing run")
+    parser.add_argument("--scale", type=int, default=2000, help="filler lines appended to each sample")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"Equivalence: {check_equivalence(rng)} samples agree")
+    print(f"\n{'section':<12} {'size':>10} {'legacy ms':>10} {'compiled ms':>12} {'speedup':>8}")
+    print("-" * 56)
+    for section in SAMPLES:
+        text = make_large(section, args.scale)
+        legacy = LEGACY_VALIDATORS[section]
+        compiled = SECTION_VALIDATORS[section]
+        legacy_time = min(timeit.repeat(lambda: legacy(text), number=args.repeat, repeat=3)) / args.repeat
+        compiled_time = min(timeit.repeat(lambda: compiled(text), number=args.repeat, repeat=3)) / args.repeat
+        print(f"{section:<12} {len(text):>10} {legacy_time * 1000:>10.3f} {compiled_time * 1000:>12.3f} {legacy_time / compiled_time:>7.2f}x")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import tempfile
+
+# Importing app creates its tables, so point it at a throwaway database (never storycrafter.db)
+# and enable the offline stub provider before any test module imports it
+os.environ.setdefault("DATABASE_URL", "sqlite:///" + os.path.join(tempfile.mkdtemp(prefix="pmpro-tests-"), "test.db"))
+os.environ.setdefault("LLM_STUB_ENABLED", "1")
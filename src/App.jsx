@@ -915,6 +915,26 @@ const ChatInterface = ({ user, project, chats, activeChatId, onLogout, onBackToD
     );
 };
 
+// Loads every chat together with its messages in one request
+const fetchChatsWithMessages = async () => {
+    const response = await fetch('http://127.0.0.1:8000/chats/with-messages/');
+    if (!response.ok) {
+        return null;
+    }
+    const chatData = await response.json();
+    return chatData.map(chat => ({
+        id: chat.id,
+        title: chat.title,
+        projectId: chat.project_id,
+        messages: chat.messages.map(msg => ({
+            id: msg.id,
+            text: msg.message,
+            isUser: msg.is_user,
+            timestamp: msg.created_at
+        }))
+    }));
+};
+
 // --- Main App Component (Router) ---
 export default function App() {
     const [page, setPage] = useState('home');
@@ -934,32 +954,8 @@ export default function App() {
     useEffect(() => {
         const fetchUserChats = async () => {
             try {
-                const response = await fetch('http://127.0.0.1:8000/chats/');
-                if (response.ok) {
-                    const chatData = await response.json();
-                    const transformedChats = await Promise.all(chatData.map(async (chat) => {
-                        const messagesResponse = await fetch(`http://127.0.0.1:8000/chats/${chat.id}/messages/`);
-                        if (messagesResponse.ok) {
-                            const messages = await messagesResponse.json();
-                            return {
-                                id: chat.id,
-                                title: chat.title,
-                                projectId: chat.project_id,
-                                messages: messages.map(msg => ({
-                                    id: msg.id,
-                                    text: msg.message,
-                                    isUser: msg.is_user,
-                                    timestamp: msg.created_at
-                                }))
-                            };
-                        }
-                        return {
-                            id: chat.id,
-                            title: chat.title,
-                            projectId: chat.project_id,
-                            messages: []
-                        };
-                    }));
+                const transformedChats = await fetchChatsWithMessages();
+                if (transformedChats) {
                     setChats(transformedChats);
                 }
             } catch (error) {
@@ -1016,34 +1012,9 @@ export default function App() {
             
             // Since the backend creates a new chat automatically, we need to refresh the chats
             // to get the new chat with the messages
-            const chatsResponse = await fetch('http://127.0.0.1:8000/chats/');
+            const transformedChats = await fetchChatsWithMessages();
             
-            if (chatsResponse.ok) {
-                const chatData = await chatsResponse.json();
-                const transformedChats = await Promise.all(chatData.map(async (chat) => {
-                    // Fetch messages for each chat
-                    const messagesResponse = await fetch(`http://127.0.0.1:8000/chats/${chat.id}/messages/`);
-                    if (messagesResponse.ok) {
-                        const messages = await messagesResponse.json();
-                        return {
-                            id: chat.id,
-                            title: chat.title,
-                            projectId: chat.project_id,
-                            messages: messages.map(msg => ({
-                                id: msg.id,
-                                text: msg.message,
-                                isUser: msg.is_user,
-                                timestamp: msg.created_at
-                            }))
-                        };
-                    }
-                    return {
-                        id: chat.id,
-                        title: chat.title,
-                        projectId: chat.project_id,
-                        messages: []
-                    };
-                }));
+            if (transformedChats) {
                 setChats(transformedChats);
                 
                 // Set the active chat to the newest one (which should be the one with the new messages)
@@ -0,0 +1,81 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+from app import ChatMessage, MessageArtifact, migrate_message_artifacts
+
+LONG_STORY = "As a user, I want to log in so that I can see my projects.\n" * 40
+LEGACY_REPLIES = [
+    {"description": "**Feature:** Login", "story": LONG_STORY, "test_cases": None},
+    {"description": None, "story": None, "test_cases": "```gherkin\nFeature: Login\n```\n" * 30},
+    {"description": "**Feature:** Export", "story": None, "test_cases": None, "errors": {"story": "timed out"}},
+    {"description": "short", "story": "short", "test_cases": "short"},
+    {"description": LONG_STORY, "story": LONG_STORY, "test_cases": LONG_STORY},
+]
+
+
+@pytest.fixture
+def chat_id():
+    """A chat holding AI replies in the old format: the sections as one JSON string in message."""
+    db = app.SessionLocal()
+    chat = app.Chat(title="legacy")
+    db.add(chat)
+    db.flush()
+    db.add(ChatMessage(chat_id=chat.id, message="write a login story", is_user=True))
+    for reply in LEGACY_REPLIES:
+        db.add(ChatMessage(chat_id=chat.id, message=json.dumps(reply), is_user=False))
+    db.add(ChatMessage(chat_id=chat.id, message="Sorry, something went wrong", is_user=False))
+    db.commit()
+    chat_id = chat.id
+    db.close()
+    return chat_id
+
+def messages(chat_id):
+    db = app.SessionLocal()
+    rows = db.query(ChatMessage).filter(ChatMessage.chat_id == chat_id).order_by(ChatMessage.id).all()
+    loaded = [(row._message, row.message, [(a.section, a.encoding, a.size, a.stored_size) for a in row.artifacts]) for row in rows]
+    db.close()
+    return loaded
+
+def test_migration_moves_replies_into_compressed_artifacts_in_batches(chat_id):
+    assert migrate_message_artifacts(batch_size=2) == len(LEGACY_REPLIES)
+    rows = messages(chat_id)
+    user, replies, plain_reply = rows[0], rows[1:-1], rows[-1]
+    assert user[0] == "write a login story" and user[2] == []
+    assert plain_reply[0] == "Sorry, something went wrong" and plain_reply[2] == []
+    for (stored, message, artifacts), reply in zip(replies, LEGACY_REPLIES):
+        assert stored is None
+        assert json.loads(message) == {"description": None, "story": None, "test_cases": None, **reply}
+        assert [section for section, *_ in artifacts] == [s for s in app.ARTIFACT_SECTIONS if reply.get(s) or s in reply.get("errors", {})]
+    story_artifact = replies[0][2][1]
+    assert story_artifact[1] == "zlib" and story_artifact[3] < story_artifact[2] == len(LONG_STORY.encode("utf-8"))
+    assert {encoding for _, encoding, *_ in replies[3][2]} == {"plain"}
+
+def test_failed_sections_keep_their_error_and_no_body(chat_id):
+    migrate_message_artifacts(batch_size=2)
+    db = app.SessionLocal()
+    artifact = (
+        db.query(MessageArtifact).join(ChatMessage)
+        .filter(ChatMessage.chat_id == chat_id, MessageArtifact.section == "story", MessageArtifact.error.isnot(None))
+        .one()
+    )
+    assert artifact.error == "timed out" and artifact.content is None and artifact.content_hash is None
+    db.close()
+
+def test_migration_is_idempotent(chat_id):
+    migrate_message_artifacts(batch_size=2)
+    before = messages(chat_id)
+    assert migrate_message_artifacts(batch_size=2) == 0
+    assert messages(chat_id) == before
+
+def test_api_payload_is_unchanged_for_old_clients(chat_id):
+    client = TestClient(app.app)
+    before = client.get(f"/chats/{chat_id}/messages/").json()
+    migrate_message_artifacts(batch_size=3)
+    after = client.get(f"/chats/{chat_id}/messages/").json()
+    assert [row["message"] for row in after] == [row["message"] for row in before]
+    assert [json.loads(row["message"]) for row in after[1:-1]] == [
+        {"description": None, "story": None, "test_cases": None, **reply} for reply in LEGACY_REPLIES
+    ]
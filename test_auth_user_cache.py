@@ -0,0 +1,88 @@
+import uuid
+
+import pytest
+
+import app
+from app import UserModel, auth_user_cache
+
+
+@pytest.fixture
+def db():
+    db = app.SessionLocal()
+    yield db
+    db.close()
+
+@pytest.fixture
+def email(db):
+    email = f"{uuid.uuid4().hex}@example.com"
+    app.create_user(db, app.UserCreate(email=email, password="unused"), hashed_password="hash-1")
+    return email
+
+def authenticate(email):
+    db = app.SessionLocal()
+    try:
+        token = app.create_access_token({"sub": email})
+        return app.get_current_user(token, db)
+    finally:
+        db.close()
+
+def cached(email):
+    return email in auth_user_cache._entries
+
+def test_second_request_is_served_from_the_cache(email):
+    first = authenticate(email)
+    assert cached(email)
+    hits = auth_user_cache.counters["hits"]
+    assert authenticate(email) is first
+    assert auth_user_cache.counters["hits"] == hits + 1
+
+def test_password_change_evicts_at_commit(db, email):
+    authenticate(email)
+    user = app.get_user(db, email)
+    user.hashed_password = "hash-2"
+    db.flush()
+    assert cached(email)
+    db.commit()
+    assert not cached(email)
+    assert authenticate(email).hashed_password == "hash-2"
+
+def test_email_change_evicts_the_old_subject(db, email):
+    authenticate(email)
+    user = app.get_user(db, email)
+    user.email = f"renamed-{email}"
+    db.commit()
+    assert not cached(email)
+
+def test_delete_evicts(db, email):
+    authenticate(email)
+    db.delete(app.get_user(db, email))
+    db.commit()
+    assert not cached(email)
+
+def test_rollback_keeps_the_entry(db, email):
+    user = authenticate(email)
+    row = app.get_user(db, email)
+    row.hashed_password = "hash-2"
+    db.flush()
+    db.rollback()
+    assert auth_user_cache.get(email) is user
+    # The discarded change is not applied by the next commit of the same session
+    db.commit()
+    assert cached(email)
+
+def test_unrelated_user_is_kept(db, email):
+    authenticate(email)
+    other = f"{uuid.uuid4().hex}@example.com"
+    app.create_user(db, app.UserCreate(email=other, password="unused"), hashed_password="hash-1")
+    app.get_user(db, other).hashed_password = "hash-2"
+    db.commit()
+    assert cached(email)
+
+def test_load_that_raced_a_commit_is_not_cached(db, email):
+    # A request read the old row, then the change committed before it could store it
+    generation = auth_user_cache.generation
+    stale = app.get_user(db, email)
+    db.expunge(stale)
+    app.store_password_hash(db, app.get_user(db, email), "hash-2")
+    auth_user_cache.put(email, stale, None, generation)
+    assert not cached(email)
@@ -0,0 +1,44 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+
+@pytest.fixture
+def client():
+    return TestClient(app.app)
+
+@pytest.fixture
+def project_id():
+    db = app.SessionLocal()
+    project = app.Project(name="sidebar", overview="", type="", industry="")
+    db.add(project)
+    db.commit()
+    project_id = project.id
+    db.close()
+    return project_id
+
+def add_chats(client, project_id, count):
+    ids = []
+    for index in range(count):
+        chat = client.post("/chats/", json={"title": f"chat {index}", "project_id": project_id}).json()
+        for turn in range(2):
+            client.post(f"/chats/{chat['id']}/messages/", json={"message": f"c{index} t{turn}", "is_user": True, "chat_id": chat["id"]})
+        ids.append(chat["id"])
+    return ids
+
+def test_every_chat_is_returned_by_default(client, project_id):
+    ids = add_chats(client, project_id, 205)
+    chats = client.get("/chats/with-messages/", params={"project_id": project_id}).json()
+    assert [chat["id"] for chat in chats] == ids
+    assert [message["message"] for message in chats[-1]["messages"]] == ["c204 t0", "c204 t1"]
+
+def test_limit_returns_the_most_recent_chats(client, project_id):
+    ids = add_chats(client, project_id, 5)
+    chats = client.get("/chats/with-messages/", params={"project_id": project_id, "limit": 2}).json()
+    assert [chat["id"] for chat in chats] == ids[-2:]
+
+def test_messages_per_chat_keeps_the_latest_messages(client, project_id):
+    add_chats(client, project_id, 2)
+    chats = client.get("/chats/with-messages/", params={"project_id": project_id, "messages_per_chat": 1}).json()
+    assert [[message["message"] for message in chat["messages"]] for chat in chats] == [["c0 t1"], ["c1 t1"]]
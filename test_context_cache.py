@@ -0,0 +1,158 @@
+import pytest
+from google.api_core import exceptions as google_exceptions
+
+import app
+from app import ContextCache, LLMPrompt
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def monotonic(self):
+        return self.now
+
+    def perf_counter(self):
+        return self.now
+
+class Response:
+    def __init__(self, text):
+        self.text = text
+
+class FakeModel:
+    def __init__(self, name, error=None, chunks_before_error=0):
+        self.name = name
+        self.error = error
+        self.chunks_before_error = chunks_before_error
+        self.prompts = []
+
+    def generate_content(self, contents, stream=False):
+        self.prompts.append(contents)
+        if stream:
+            return self._stream()
+        if self.error is not None:
+            raise self.error
+        return Response(f"{self.name} reply")
+
+    def _stream(self):
+        for index in range(self.chunks_before_error):
+            yield Response(f"{self.name} chunk {index} ")
+        if self.error is not None:
+            raise self.error
+        yield Response(f"{self.name} reply")
+
+class FakeBackend:
+    def __init__(self):
+        self.created = []
+        self.refreshed = []
+        self.deleted = []
+        self.fail_create = False
+        self.cached_error = None
+        self.chunks_before_error = 0
+
+    def create(self, model_name, system_instruction, ttl_seconds):
+        if self.fail_create:
+            raise google_exceptions.InvalidArgument("cached content is too small")
+        handle = f"handle-{len(self.created)}"
+        self.created.append(handle)
+        return handle
+
+    def refresh(self, handle, ttl_seconds):
+        self.refreshed.append(handle)
+
+    def bind(self, handle):
+        return FakeModel(handle, self.cached_error, self.chunks_before_error)
+
+    def delete(self, handle):
+        self.deleted.append(handle)
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(app, "time", clock)
+    return clock
+
+@pytest.fixture
+def backend():
+    return FakeBackend()
+
+@pytest.fixture
+def cache(backend):
+    return ContextCache(backend, "gemini-test", ttl_seconds=60, refresh_seconds=10, retry_seconds=30)
+
+def test_second_call_reuses_the_handle(clock, backend, cache):
+    first = cache.model_for("system prompt")
+    assert cache.model_for("system prompt") is first
+    assert backend.created == ["handle-0"]
+    assert cache.stats()["hits"] == 1 and cache.stats()["creates"] == 1
+
+def test_handle_is_refreshed_near_expiry(clock, backend, cache):
+    first = cache.model_for("system prompt")
+    clock.now += 55
+    assert cache.model_for("system prompt") is first
+    assert backend.refreshed == ["handle-0"]
+    clock.now += 55
+    assert cache.model_for("system prompt") is first
+    assert backend.created == ["handle-0"]
+
+def test_expired_handle_is_recreated(clock, backend, cache):
+    cache.model_for("system prompt")
+    clock.now += 61
+    assert cache.model_for("system prompt").name == "handle-1"
+    assert backend.refreshed == []
+
+def test_refused_prefix_goes_inline_until_retry(clock, backend, cache):
+    backend.fail_create = True
+    assert cache.model_for("system prompt") is None
+    backend.fail_create = False
+    assert cache.model_for("system prompt") is None
+    assert backend.created == []
+    clock.now += 31
+    assert cache.model_for("system prompt") is not None
+
+def test_close_deletes_created_handles(clock, backend, cache):
+    cache.model_for("system prompt")
+    cache.close()
+    assert backend.deleted == ["handle-0"]
+    assert cache.stats()["handles"] == 0
+
+@pytest.fixture
+def wired(monkeypatch, clock, backend, cache):
+    inline = FakeModel("inline")
+    monkeypatch.setattr(app, "context_cache", cache)
+    monkeypatch.setattr(app, "model", inline)
+    return inline
+
+PROMPT = LLMPrompt(text="system prompt\nwrite a story", static_prefix="system prompt\n", suffix="write a story")
+
+def test_cached_call_sends_only_the_suffix(wired, cache):
+    assert app._generate_content(PROMPT, None, None) == "handle-0 reply"
+    assert cache.model_for(PROMPT.static_prefix).prompts == ["write a story"]
+    assert wired.prompts == []
+
+def test_provider_error_invalidates_and_falls_back_inline(wired, backend, cache):
+    backend.cached_error = google_exceptions.NotFound("cached content not found")
+    assert app._generate_content(PROMPT, None, None) == "inline reply"
+    assert wired.prompts == [PROMPT.text]
+    assert cache.stats()["invalidations"] == 1 and cache.stats()["handles"] == 0
+    backend.cached_error = None
+    assert cache.model_for(PROMPT.static_prefix).name == "handle-1"
+
+def test_error_after_streamed_tokens_is_not_replayed_inline(wired, backend, cache):
+    backend.cached_error = google_exceptions.NotFound("cached content not found")
+    backend.chunks_before_error = 1
+    tokens = []
+    with pytest.raises(google_exceptions.NotFound):
+        app._generate_content(PROMPT, tokens.append, None)
+    assert tokens == ["handle-0 chunk 0 "]
+    assert wired.prompts == []
+    assert cache.stats()["invalidations"] == 1
+
+def test_rate_limit_keeps_the_handle(wired, backend, cache):
+    backend.cached_error = google_exceptions.ResourceExhausted("quota")
+    with pytest.raises(google_exceptions.ResourceExhausted):
+        app._generate_content(PROMPT, None, None)
+    assert cache.stats()["invalidations"] == 0 and cache.stats()["handles"] == 1
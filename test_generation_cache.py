@@ -0,0 +1,97 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+import app
+from app import GenerationCache, GenerationCacheEntry
+
+
+class Clock(datetime):
+    now_value = datetime(2026, 1, 1, 12, 0, 0)
+
+    @classmethod
+    def utcnow(cls):
+        return cls.now_value
+
+@pytest.fixture
+def clock(monkeypatch):
+    monkeypatch.setattr(Clock, "now_value", datetime(2026, 1, 1, 12, 0, 0))
+    monkeypatch.setattr(app, "datetime", Clock)
+    db = app.SessionLocal()
+    db.query(GenerationCacheEntry).delete()
+    db.commit()
+    db.close()
+    return Clock
+
+def advance(clock, seconds):
+    clock.now_value += timedelta(seconds=seconds)
+
+def db_keys():
+    db = app.SessionLocal()
+    keys = {key for (key,) in db.query(GenerationCacheEntry.key)}
+    db.close()
+    return keys
+
+def test_set_then_get_is_a_memory_hit(clock):
+    cache = GenerationCache(ttl_seconds=60, memory_entries=4, max_rows=10)
+    cache.set("k", {"story": "s"})
+    assert cache.get("k") == {"story": "s"}
+    assert cache.stats()["memory_hits"] == 1 and cache.stats()["db_hits"] == 0
+    assert db_keys() == {"k"}
+
+def test_entries_expire_after_the_ttl(clock):
+    cache = GenerationCache(ttl_seconds=60, memory_entries=4, max_rows=10)
+    cache.set("k", {"story": "s"})
+    advance(clock, 59)
+    assert cache.get("k") is not None
+    advance(clock, 2)
+    assert cache.get("k") is None
+    assert cache.stats()["misses"] == 1 and cache.stats()["memory_entries"] == 0
+    assert db_keys() == set()
+
+def test_memory_tier_evicts_the_least_recently_used(clock):
+    cache = GenerationCache(ttl_seconds=60, memory_entries=2, max_rows=10)
+    cache.set("a", "A")
+    cache.set("b", "B")
+    cache.get("a")
+    cache.set("c", "C")
+    assert list(cache._memory) == ["a", "c"]
+    # Still in the database tier, and promoted back into memory on the next read
+    assert cache.get("b") == "B"
+    assert cache.stats()["db_hits"] == 1
+    assert list(cache._memory) == ["c", "b"]
+
+def test_database_hit_is_promoted_to_memory(clock):
+    GenerationCache(ttl_seconds=60, memory_entries=4, max_rows=10).set("k", {"story": "s"})
+    # A new process starts with an empty memory tier
+    cache = GenerationCache(ttl_seconds=60, memory_entries=4, max_rows=10)
+    assert cache.get("k") == {"story": "s"}
+    assert cache.get("k") == {"story": "s"}
+    assert cache.stats()["db_hits"] == 1 and cache.stats()["memory_hits"] == 1
+
+def test_promoted_entry_keeps_its_original_expiry(clock):
+    GenerationCache(ttl_seconds=60, memory_entries=4, max_rows=10).set("k", "v")
+    advance(clock, 50)
+    cache = GenerationCache(ttl_seconds=60, memory_entries=4, max_rows=10)
+    assert cache.get("k") == "v"
+    advance(clock, 11)
+    assert cache.get("k") is None
+
+def test_database_tier_drops_the_least_recently_read_rows(clock):
+    cache = GenerationCache(ttl_seconds=600, memory_entries=0, max_rows=2)
+    cache.set("a", "A")
+    advance(clock, 1)
+    cache.set("b", "B")
+    advance(clock, 1)
+    assert cache.get("a") == "A"
+    advance(clock, 1)
+    cache.set("c", "C")
+    assert db_keys() == {"a", "c"}
+    assert cache.stats()["evictions"] >= 1
+
+def test_set_replaces_an_existing_entry(clock):
+    cache = GenerationCache(ttl_seconds=60, memory_entries=4, max_rows=10)
+    cache.set("k", "old")
+    cache.set("k", "new")
+    assert cache.get("k") == "new"
+    assert GenerationCache(ttl_seconds=60, memory_entries=4, max_rows=10).get("k") == "new"
@@ -0,0 +1,88 @@
+import asyncio
+
+import pytest
+
+import app
+from app import HedgePolicy, ValidationResult, _race_candidates, _TokenBuffer
+
+PASS = ValidationResult(True, [], [])
+
+
+def failing(*codes):
+    return ValidationResult(False, list(codes), list(codes))
+
+def test_token_buffer_holds_tokens_until_released():
+    sent = []
+    buffer = _TokenBuffer(sent.append)
+    buffer("a")
+    buffer("b")
+    assert sent == []
+    buffer.release()
+    buffer("c")
+    assert sent == ["a", "b", "c"]
+
+def race(monkeypatch, candidates, max_rate=1.0):
+    """Run _race_candidates with fake candidates: [(tokens, delay_seconds, result)] in launch order."""
+    monkeypatch.setattr(app, "hedge_policy", HedgePolicy(0.05, max_rate, 0.5, 20))
+    launched = []
+
+    async def fake_generate_candidate(section, composed, on_token=None, cancel=None):
+        tokens, delay, result = candidates[len(launched)]
+        launched.append(tokens)
+        for token in tokens:
+            if on_token is not None:
+                on_token(token)
+            await asyncio.sleep(delay / len(tokens))
+        return "".join(tokens), result
+
+    monkeypatch.setattr(app, "_generate_candidate", fake_generate_candidate)
+    events = []
+    content = asyncio.run(_race_candidates("story", "prompt", lambda event, data: events.append(data["text"])))
+    return content, events, len(launched)
+
+def test_winning_hedge_streams_only_its_own_tokens(monkeypatch):
+    content, streamed, launched = race(monkeypatch, [
+        (["slow-1 ", "slow-2"], 0.5, PASS),
+        (["fast-1 ", "fast-2"], 0.01, PASS),
+    ])
+    assert launched == 2
+    assert content == "fast-1 fast-2"
+    assert streamed == ["fast-1 ", "fast-2"]
+
+def test_primary_within_the_delay_streams_its_tokens(monkeypatch):
+    content, streamed, launched = race(monkeypatch, [(["p-1 ", "p-2"], 0.0, failing("missing_then"))])
+    assert launched == 1
+    assert content == "p-1 p-2"
+    assert streamed == ["p-1 ", "p-2"]
+
+def test_primary_streams_live_when_no_hedge_budget(monkeypatch):
+    content, streamed, launched = race(monkeypatch, [(["p-1 ", "p-2 ", "p-3"], 0.2, PASS)], max_rate=0)
+    assert launched == 1
+    assert streamed == ["p-1 ", "p-2 ", "p-3"]
+
+def test_valid_primary_beats_an_invalid_hedge(monkeypatch):
+    content, streamed, _ = race(monkeypatch, [
+        (["p-1 ", "p-2"], 0.2, PASS),
+        (["h-1 ", "h-2"], 0.01, failing("missing_when")),
+    ])
+    assert content == "p-1 p-2"
+    assert streamed == ["p-1 ", "p-2"]
+
+def test_fewest_failures_wins_when_neither_passes(monkeypatch):
+    content, streamed, _ = race(monkeypatch, [
+        (["p-1 ", "p-2"], 0.2, failing("missing_when", "missing_then")),
+        (["h-1 ", "h-2"], 0.01, failing("missing_when")),
+    ])
+    assert content == "h-1 h-2"
+    assert streamed == ["h-1 ", "h-2"]
+
+def test_errors_surface_when_no_candidate_finishes(monkeypatch):
+    monkeypatch.setattr(app, "hedge_policy", HedgePolicy(0.01, 1.0, 0.5, 20))
+
+    async def broken(section, composed, on_token=None, cancel=None):
+        await asyncio.sleep(0.05)
+        raise RuntimeError("backend down")
+
+    monkeypatch.setattr(app, "_generate_candidate", broken)
+    with pytest.raises(RuntimeError):
+        asyncio.run(_race_candidates("story", "prompt", lambda event, data: None))
@@ -0,0 +1,135 @@
+import asyncio
+import json
+import logging
+import threading
+from datetime import datetime, timedelta
+
+import pytest
+
+import app
+from app import GenerationJob, StoryRequest, _claim_next_job
+
+
+@pytest.fixture
+def chat_id():
+    db = app.SessionLocal()
+    db.query(GenerationJob).delete()
+    chat = app.Chat(title="jobs")
+    db.add(chat)
+    db.commit()
+    chat_id = chat.id
+    db.close()
+    return chat_id
+
+@pytest.fixture
+def job_id(chat_id):
+    db = app.SessionLocal()
+    job = app._enqueue_job(db, chat_id, StoryRequest(prompt="save searches", chat_id=chat_id, background=True))
+    db.close()
+    return job.id
+
+def load(job_id):
+    db = app.SessionLocal()
+    job = db.query(GenerationJob).filter(GenerationJob.id == job_id).first()
+    db.close()
+    return job
+
+def expire_lease(job_id, **changes):
+    db = app.SessionLocal()
+    db.query(GenerationJob).filter(GenerationJob.id == job_id).update(
+        {GenerationJob.lease_expires_at: datetime.utcnow() - timedelta(seconds=1), **changes},
+        synchronize_session=False,
+    )
+    db.commit()
+    db.close()
+
+def test_only_one_of_many_workers_claims_a_job(job_id):
+    start = threading.Barrier(8)
+    claims = [None] * 8
+
+    def claim(index):
+        start.wait()
+        claims[index] = _claim_next_job(f"worker-{index}")
+
+    threads = [threading.Thread(target=claim, args=(index,)) for index in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    winners = [index for index, claimed in enumerate(claims) if claimed is not None]
+    assert len(winners) == 1
+    job = load(job_id)
+    assert job.status == "running" and job.attempts == 1 and job.worker_id == f"worker-{winners[0]}"
+
+def test_leased_job_is_reclaimed_only_after_the_lease_lapses(job_id):
+    assert _claim_next_job("a")[0] == job_id
+    assert _claim_next_job("b") is None
+    expire_lease(job_id, artifacts=json.dumps({"description": "kept"}), status="section_done")
+    claimed_id, _, request, artifacts = _claim_next_job("b")
+    assert claimed_id == job_id and request["prompt"] == "save searches"
+    assert artifacts == {"description": "kept"}
+    job = load(job_id)
+    assert job.worker_id == "b" and job.attempts == 2 and job.status == "running"
+
+def test_job_is_abandoned_after_max_attempts(job_id):
+    expire_lease(job_id, status="running", attempts=app.JOB_MAX_ATTEMPTS)
+    assert _claim_next_job("a") is None
+    assert load(job_id).status == "failed"
+
+def test_restarted_worker_resumes_from_finished_sections(monkeypatch, chat_id, job_id):
+    # The first process finished the description and died; its lease lapses and a new worker takes over
+    _claim_next_job("old-process")
+    app._record_job_section(job_id, "description", "saved description")
+    expire_lease(job_id)
+    seen = {}
+
+    async def fake_generate_artifacts(request, emit=None, existing=None, usage=None):
+        seen.update(existing)
+        return {"description": existing["description"], "story": "new story", "test_cases": None, "errors": None}
+
+    monkeypatch.setattr(app, "_generate_artifacts", fake_generate_artifacts)
+    claimed_id, claimed_chat, request, artifacts = _claim_next_job("new-process")
+    asyncio.run(app._run_job(claimed_id, "new-process", claimed_chat, request, artifacts))
+    assert seen == {"description": "saved description"}
+    job = load(job_id)
+    assert job.status == "complete" and job.message_id is not None
+    assert json.loads(job.artifacts) == {"description": "saved description", "story": "new story"}
+
+def run_with_lease_failure(monkeypatch, job_id, renew):
+    monkeypatch.setattr(app, "JOB_LEASE_SECONDS", 0.03)
+    monkeypatch.setattr(app, "_renew_job_lease", renew)
+    cancelled = []
+
+    async def endless_generation(request, emit=None, existing=None, usage=None):
+        try:
+            await asyncio.sleep(10)
+        except asyncio.CancelledError:
+            cancelled.append(True)
+            raise
+
+    monkeypatch.setattr(app, "_generate_artifacts", endless_generation)
+    claimed_id, claimed_chat, request, artifacts = _claim_next_job("w")
+    asyncio.run(asyncio.wait_for(app._run_job(claimed_id, "w", claimed_chat, request, artifacts), timeout=2))
+    return cancelled
+
+def test_lease_renewal_error_is_logged_and_stops_the_job(monkeypatch, caplog, job_id):
+    def broken_renew(job_id, worker_id):
+        raise RuntimeError("disk I/O error")
+
+    with caplog.at_level(logging.ERROR):
+        cancelled = run_with_lease_failure(monkeypatch, job_id, broken_renew)
+    assert cancelled == [True]
+    assert "lease renewal failed: disk I/O error" in caplog.text
+    # Left for the next claim rather than completed or failed by a worker without the lease
+    assert load(job_id).status == "running"
+
+def test_job_stops_when_another_worker_holds_the_lease(monkeypatch, caplog, job_id):
+    with caplog.at_level(logging.ERROR):
+        cancelled = run_with_lease_failure(monkeypatch, job_id, lambda job_id, worker_id: False)
+    assert cancelled == [True]
+    assert "taken over by another worker" in caplog.text
+
+def test_lease_is_renewed_only_by_its_holder(job_id):
+    _claim_next_job("a")
+    assert app._renew_job_lease(job_id, "a") is True
+    assert app._renew_job_lease(job_id, "b") is False
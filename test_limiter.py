@@ -0,0 +1,127 @@
+import time
+
+import pytest
+from fastapi import HTTPException
+from google.api_core import exceptions as google_exceptions
+
+import app
+from app import AdaptiveLimiter, TokenBucket, is_rate_limit_error
+
+
+def make_limiter(initial=4, minimum=1, maximum=8, rpm=0, tpm=0):
+    return AdaptiveLimiter(rpm=rpm, tpm=tpm, initial=initial, minimum=minimum, maximum=maximum, spike_factor=3.0)
+
+def test_success_increases_limit_additively():
+    limiter = make_limiter(initial=4)
+    limiter.acquire(100, time.monotonic() + 1)
+    limiter.release(1.0)
+    assert limiter.limit == pytest.approx(4.25)
+    assert limiter.in_flight == 0
+
+def test_limit_never_exceeds_maximum():
+    limiter = make_limiter(initial=8, maximum=8)
+    for _ in range(5):
+        limiter.acquire(100, time.monotonic() + 1)
+        limiter.release(1.0)
+    assert limiter.limit == 8
+
+def test_rate_limit_halves_limit_down_to_minimum():
+    limiter = make_limiter(initial=8, minimum=3)
+    limiter.acquire(100, time.monotonic() + 1)
+    limiter.release(None, rate_limited=True)
+    assert limiter.limit == 4
+    limiter.acquire(100, time.monotonic() + 1)
+    limiter.release(None, rate_limited=True)
+    assert limiter.limit == 3
+    assert limiter.counters["rate_limited"] == 2
+
+def test_rate_limit_drains_buckets():
+    limiter = make_limiter(rpm=60)
+    limiter.acquire(100, time.monotonic() + 1)
+    limiter.release(None, rate_limited=True)
+    assert limiter._rpm.tokens <= 0
+
+def test_latency_spike_backs_off():
+    limiter = make_limiter(initial=5)
+    limiter.acquire(100, time.monotonic() + 1)
+    limiter.release(1.0)
+    before = limiter.limit
+    limiter.acquire(100, time.monotonic() + 1)
+    limiter.release(10.0)
+    assert limiter.limit == pytest.approx(before * 0.9)
+    assert limiter.counters["latency_backoffs"] == 1
+
+def test_acquire_past_deadline_raises_429():
+    limiter = make_limiter(initial=1)
+    limiter.acquire(100, time.monotonic() + 1)
+    started = time.monotonic()
+    with pytest.raises(HTTPException) as excinfo:
+        limiter.acquire(100, started + 0.05)
+    assert excinfo.value.status_code == 429
+    assert "Retry-After" in excinfo.value.headers
+    assert time.monotonic() - started < 1
+    assert limiter.counters["queue_timeouts"] == 1
+    assert limiter.in_flight == 1
+
+def test_token_bucket_waits_for_refill():
+    bucket = TokenBucket(60)
+    now = bucket.updated
+    bucket.take(60)
+    assert bucket.wait_time(1, now) == pytest.approx(1.0)
+    assert bucket.wait_time(1, now + 1) == 0
+
+def test_call_retries_rate_limited_calls(monkeypatch):
+    monkeypatch.setattr(app.time, "sleep", lambda seconds: None)
+    limiter = make_limiter()
+    failures = [google_exceptions.ResourceExhausted("quota")]
+
+    def fn():
+        if failures:
+            raise failures.pop()
+        return "ok"
+
+    assert limiter.call(fn, 100, timeout=60) == "ok"
+    assert limiter.counters["retries"] == 1
+    assert limiter.in_flight == 0
+
+def test_call_gives_up_when_backoff_passes_deadline():
+    limiter = make_limiter()
+
+    def fn():
+        raise google_exceptions.TooManyRequests("slow down")
+
+    with pytest.raises(HTTPException) as excinfo:
+        limiter.call(fn, 100, timeout=0.5)
+    assert excinfo.value.status_code == 429
+    assert limiter.in_flight == 0
+
+def test_call_propagates_other_errors():
+    limiter = make_limiter(initial=4)
+
+    def fn():
+        raise ValueError("boom")
+
+    with pytest.raises(ValueError):
+        limiter.call(fn, 100, timeout=1)
+    assert limiter.in_flight == 0
+    assert limiter.limit == 4
+
+def test_rate_limit_errors_are_recognized_by_type():
+    assert is_rate_limit_error(google_exceptions.ResourceExhausted("quota"))
+    assert is_rate_limit_error(google_exceptions.TooManyRequests("slow down"))
+    try:
+        try:
+            raise google_exceptions.ResourceExhausted("quota")
+        except Exception as exc:
+            raise RuntimeError("wrapped") from exc
+    except RuntimeError as wrapped:
+        assert is_rate_limit_error(wrapped)
+
+def test_status_code_attribute_counts_as_rate_limit():
+    error = RuntimeError("too many")
+    error.status_code = 429
+    assert is_rate_limit_error(error)
+
+def test_messages_mentioning_429_are_not_rate_limits():
+    assert not is_rate_limit_error(ValueError("request 429 failed validation"))
+    assert not is_rate_limit_error(google_exceptions.InvalidArgument("prompt has 4290 tokens"))
@@ -0,0 +1,58 @@
+import logging
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+from app import MetricsRegistry, routed_llm, time_llm_call
+
+
+def sample(text, name, **labels):
+    """The value of one series in a Prometheus text body, or 0 when it has not been recorded."""
+    label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+    prefix = f"{name}{{{label_text}}} " if label_text else f"{name} "
+    for line in text.splitlines():
+        if line.startswith(prefix):
+            return float(line[len(prefix):])
+    return 0.0
+
+def scrape():
+    response = TestClient(app.app).get("/metrics")
+    assert response.status_code == 200
+    return response.text
+
+def test_routed_call_is_timed_by_provider_and_outcome():
+    name = "storycrafter_llm_request_duration_seconds_count"
+    before = sample(scrape(), name, provider="stub", section="other", outcome="ok")
+    routed_llm([{"provider": "stub"}]).invoke("Write a user story for: export")
+    assert sample(scrape(), name, provider="stub", section="other", outcome="ok") == before + 1
+
+def test_failed_call_is_recorded_as_an_error():
+    name = "storycrafter_llm_request_duration_seconds_count"
+    before = sample(scrape(), name, provider="test", section="story", outcome="error")
+    token = app.llm_section.set("story")
+    try:
+        with pytest.raises(RuntimeError):
+            time_llm_call("test", lambda: (_ for _ in ()).throw(RuntimeError("backend down")))
+    finally:
+        app.llm_section.reset(token)
+    assert sample(scrape(), name, provider="test", section="story", outcome="error") == before + 1
+
+def test_limiter_state_is_exported():
+    text = scrape()
+    assert sample(text, "storycrafter_llm_limiter_concurrency_limit") == app.llm_limiter.stats()["limit"]
+    assert "# TYPE storycrafter_llm_limiter_events_total counter" in text
+
+def test_broken_collector_is_skipped_and_logged(caplog):
+    registry = MetricsRegistry("t")
+    registry.counter("calls_total", "Calls.").inc(2)
+
+    def broken():
+        raise RuntimeError("stats unavailable")
+
+    registry.collector("broken", "Always fails.", "gauge", (), broken)
+    with caplog.at_level(logging.WARNING):
+        text = registry.render()
+    assert sample(text, "t_calls_total") == 2
+    assert "t_broken" not in text
+    assert "Metric t_broken failed to collect: stats unavailable" in caplog.text
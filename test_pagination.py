@@ -0,0 +1,54 @@
+import pytest
+from fastapi.testclient import TestClient
+
+import app
+
+
+@pytest.fixture
+def client():
+    return TestClient(app.app)
+
+@pytest.fixture
+def chat_id(client):
+    chat_id = client.post("/chats/", json={"title": "pagination"}).json()["id"]
+    for index in range(7):
+        client.post(f"/chats/{chat_id}/messages/", json={"message": f"m{index}", "is_user": True, "chat_id": chat_id})
+    return chat_id
+
+def walk(client, url, **params):
+    seen, cursor = [], None
+    while True:
+        response = client.get(url, params={**params, **({"cursor": cursor} if cursor else {})})
+        assert response.status_code == 200
+        seen += [row["message"] for row in response.json()]
+        cursor = response.headers.get("x-next-cursor")
+        if not cursor:
+            return seen
+
+def test_message_history_defaults_to_the_whole_conversation_oldest_first(client, chat_id):
+    response = client.get(f"/chats/{chat_id}/messages/")
+    assert [row["message"] for row in response.json()] == [f"m{index}" for index in range(7)]
+    assert "x-next-cursor" not in response.headers
+
+def test_message_pages_cover_every_row_in_both_orders(client, chat_id):
+    url = f"/chats/{chat_id}/messages/"
+    assert walk(client, url, limit=3) == [f"m{index}" for index in range(7)]
+    assert walk(client, url, limit=3, order="desc") == [f"m{index}" for index in range(6, -1, -1)]
+
+def test_chats_page_newest_first(client, chat_id):
+    newest = client.post("/chats/", json={"title": "newest"}).json()["id"]
+    assert client.get("/chats/", params={"limit": 1}).json()[0]["id"] == newest
+
+def test_cursor_is_rejected_with_the_other_order(client, chat_id):
+    url = f"/chats/{chat_id}/messages/"
+    cursor = client.get(url, params={"limit": 3, "order": "desc"}).headers["x-next-cursor"]
+    response = client.get(url, params={"limit": 3, "order": "asc", "cursor": cursor})
+    assert response.status_code == 400
+
+def test_invalid_cursor_and_order_are_rejected(client, chat_id):
+    assert client.get("/chats/", params={"cursor": "garbage!"}).status_code == 400
+    assert client.get("/chats/", params={"order": "sideways"}).status_code == 422
+
+def test_cursor_header_is_exposed_to_browsers(client, chat_id):
+    response = client.get("/chats/", params={"limit": 1}, headers={"Origin": "http://localhost:5173"})
+    assert "X-Next-Cursor" in response.headers["access-control-expose-headers"]
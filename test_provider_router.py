@@ -0,0 +1,115 @@
+import asyncio
+
+import pytest
+
+import app
+from app import ProviderRouter, _registry_key, routed_llm
+
+PRIMARY = {"provider": "stub", "model": "primary"}
+BACKUP = {"provider": "stub", "model": "backup"}
+
+
+def circuit(router, cfg):
+    return router.stats()[_registry_key(cfg)]["circuit"]
+
+def open_circuit(router, cfg):
+    for _ in range(app.ROUTER_BREAKER_FAILURES):
+        router.record(cfg, None, ok=False)
+
+def test_repeated_failures_open_the_circuit():
+    router = ProviderRouter()
+    router.record(PRIMARY, 0.1, ok=True)
+    router.record(BACKUP, 0.5, ok=True)
+    assert router.rank([PRIMARY, BACKUP]) == [PRIMARY, BACKUP]
+    open_circuit(router, PRIMARY)
+    assert circuit(router, PRIMARY) == "open"
+    assert router.rank([PRIMARY, BACKUP]) == [BACKUP, PRIMARY]
+
+def test_fastest_healthy_candidate_goes_first():
+    router = ProviderRouter()
+    router.record(PRIMARY, 2.0, ok=True)
+    router.record(BACKUP, 0.1, ok=True)
+    assert router.rank([PRIMARY, BACKUP]) == [BACKUP, PRIMARY]
+
+def test_cooldown_lets_one_probe_through(monkeypatch):
+    monkeypatch.setattr(app, "ROUTER_BREAKER_COOLDOWN_SECONDS", 0)
+    router = ProviderRouter()
+    router.record(BACKUP, 0.5, ok=True)
+    open_circuit(router, PRIMARY)
+    assert circuit(router, PRIMARY) == "half_open"
+    # The first ranking claims the probe; until it settles the candidate stays out of rotation
+    assert router.rank([PRIMARY, BACKUP])[0] == PRIMARY
+    assert router.rank([PRIMARY, BACKUP])[0] == BACKUP
+
+def test_successful_probe_closes_the_circuit(monkeypatch):
+    monkeypatch.setattr(app, "ROUTER_BREAKER_COOLDOWN_SECONDS", 0)
+    router = ProviderRouter()
+    open_circuit(router, PRIMARY)
+    router.rank([PRIMARY])
+    router.record(PRIMARY, 0.2, ok=True)
+    assert circuit(router, PRIMARY) == "closed"
+
+def test_failed_probe_reopens_the_circuit(monkeypatch):
+    router = ProviderRouter()
+    open_circuit(router, PRIMARY)
+    monkeypatch.setattr(app, "ROUTER_BREAKER_COOLDOWN_SECONDS", 0)
+    router.rank([PRIMARY])
+    monkeypatch.setattr(app, "ROUTER_BREAKER_COOLDOWN_SECONDS", 30)
+    router.record(PRIMARY, None, ok=False)
+    assert circuit(router, PRIMARY) == "open"
+
+def test_release_frees_an_unsettled_probe(monkeypatch):
+    monkeypatch.setattr(app, "ROUTER_BREAKER_COOLDOWN_SECONDS", 0)
+    router = ProviderRouter()
+    open_circuit(router, PRIMARY)
+    router.rank([PRIMARY])
+    router.release(PRIMARY)
+    assert circuit(router, PRIMARY) == "half_open"
+
+def test_routed_llm_fails_over_to_the_next_candidate(monkeypatch):
+    router = ProviderRouter()
+    monkeypatch.setattr(app, "provider_router", router)
+    failing = {"provider": "stub", "model": "failing", "fail": True}
+    result = routed_llm([failing, BACKUP]).invoke("Write a user story for: login")
+    assert "login" in result.content
+    assert router.stats()[_registry_key(failing)]["error_rate"] > 0
+    assert router.stats()[_registry_key(BACKUP)]["samples"] == 1
+
+def test_routed_llm_releases_probe_when_the_call_is_cancelled(monkeypatch):
+    monkeypatch.setattr(app, "ROUTER_BREAKER_COOLDOWN_SECONDS", 0)
+    router = ProviderRouter()
+    monkeypatch.setattr(app, "provider_router", router)
+    open_circuit(router, PRIMARY)
+
+    def cancelled(cfg, prompt_value):
+        raise asyncio.CancelledError()
+
+    monkeypatch.setattr(app, "_invoke_candidate", cancelled)
+    with pytest.raises(asyncio.CancelledError):
+        routed_llm([PRIMARY]).invoke("Write a user story for: login")
+    assert circuit(router, PRIMARY) == "half_open"
+    assert router.rank([PRIMARY, BACKUP])[0] == PRIMARY
+
+def test_value_error_from_a_candidate_fails_over(monkeypatch):
+    router = ProviderRouter()
+    monkeypatch.setattr(app, "provider_router", router)
+    invoke_candidate = app._invoke_candidate
+
+    def bad_response(cfg, prompt_value):
+        if cfg is PRIMARY:
+            raise ValueError("could not parse the provider response")
+        return invoke_candidate(cfg, prompt_value)
+
+    monkeypatch.setattr(app, "_invoke_candidate", bad_response)
+    result = routed_llm([PRIMARY, BACKUP]).invoke("Write a user story for: login")
+    assert "login" in result.content
+    assert router.stats()[_registry_key(PRIMARY)]["error_rate"] > 0
+    assert router.stats()[_registry_key(BACKUP)]["samples"] == 1
+
+def test_unsupported_provider_is_raised_without_failing_over(monkeypatch):
+    router = ProviderRouter()
+    monkeypatch.setattr(app, "provider_router", router)
+    unknown = {"provider": "nope"}
+    with pytest.raises(app.UnsupportedProviderError):
+        routed_llm([unknown, BACKUP]).invoke("Write a user story for: login")
+    assert _registry_key(BACKUP) not in router.stats()
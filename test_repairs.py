@@ -0,0 +1,69 @@
+from app import SECTION_VALIDATORS, repair_section
+
+
+def repaired(section, text):
+    result = SECTION_VALIDATORS[section](text)
+    return repair_section(section, text, result.codes)
+
+def test_description_labels_and_bullets_are_normalized():
+    text = "Feature: Login\nSummary: s\n**Problem** p\n## Solution: x\nScope:\n- a\n1. b"
+    fixed = repaired("description", text)
+    assert fixed == "**Feature:** Login\n**Summary:** s\n**Problem:** p\n**Solution:** x\n**Scope:**\n* a\n* b"
+    assert SECTION_VALIDATORS["description"](fixed).ok
+
+def test_bare_label_words_in_prose_are_left_alone():
+    text = "**Feature:** Login\n**Summary:** s\nProblem solving is out of scope.\n**Solution:** x\n**Scope:**\n* a\n* b"
+    assert "Problem solving is out of scope." in repaired("description", text)
+
+def test_story_label_and_phrasing():
+    text = "User story: As a user, I want to log in so I can see my data."
+    fixed = repair_section("story", text, ["missing_user_story_label", "story_phrasing"])
+    assert fixed == "**User Story:** As a user, I want to log in so that I can see my data."
+
+def test_criteria_keywords_uppercased_where_they_start_a_clause():
+    text = (
+        "**User Story:** As a user, I want to log in so that I can see my data.\n\n"
+        "Acceptance Criteria:\n"
+        "1. given a user, when they log in, then they see data\n"
+        "- **Given** a, **when** b, **then** c\n"
+        "* Given x, When y, Then z"
+    )
+    fixed = repaired("story", text)
+    assert "1. GIVEN a user, WHEN they log in, THEN they see data" in fixed
+    assert "- GIVEN a, WHEN b, THEN c" in fixed
+    assert SECTION_VALIDATORS["story"](fixed).ok
+
+def test_criteria_keywords_in_prose_are_left_alone():
+    text = (
+        "**User Story:** As a user, I want to redeem a coupon so that I can save money.\n\n"
+        "Acceptance Criteria:\n"
+        "The given coupon applies when valid, then it shows a receipt."
+    )
+    fixed = repair_section("story", text, ["too_few_acceptance_criteria", "missing_when", "missing_then"])
+    assert fixed == text
+
+def test_criteria_keywords_before_the_heading_are_left_alone():
+    text = "**User Story:** given the time, when possible\n\nAcceptance Criteria:\n* given a, when b, then c"
+    fixed = repair_section("story", text, ["missing_when"])
+    assert fixed.startswith("**User Story:** given the time, when possible")
+    assert fixed.endswith("* GIVEN a, WHEN b, THEN c")
+
+def test_gherkin_keywords_and_fence():
+    text = (
+        "feature: Login\n  scenario: ok\n    given a\n    when b\n    then c\n"
+        "  scenario outline: o\n    given <a>\n    when b\n    then c\n    examples:\n      | a |\n      | 1 |"
+    )
+    fixed = repaired("test_cases", text)
+    assert fixed.startswith("```gherkin\nFeature: Login\n  Scenario: ok\n    Given a\n")
+    assert "  Scenario Outline: o\n" in fixed and "    Examples:\n" in fixed
+    assert fixed.endswith("```")
+    assert SECTION_VALIDATORS["test_cases"](fixed).ok
+
+def test_gherkin_fence_rewraps_other_languages():
+    text = "```cucumber\nFeature: Login\n  Scenario: ok\n```"
+    assert repair_section("test_cases", text, ["missing_gherkin_fence"]) == "```gherkin\nFeature: Login\n  Scenario: ok\n```"
+
+def test_only_repairs_for_reported_codes_run():
+    text = "User story: As a user, I want to log in so I can see my data."
+    assert repair_section("story", text, ["story_phrasing"]) == "User story: As a user, I want to log in so that I can see my data."
+    assert repair_section("story", text, []) == text
@@ -0,0 +1,95 @@
+import pytest
+from sqlalchemy import text
+
+import app
+from app import Chat, ChatMessage, SessionLocal, encode_artifact_body, rebuild_search_index, search_messages
+
+DESCRIPTION = "**Feature:** Invoice export\n\n**Summary:** s\n\n**Problem:** p\n\n**Solution:** x\n\n**Scope:**\n* a\n* b"
+STORY = "**User Story:** As an accountant, I want to export invoices, so that I can file taxes."
+
+
+@pytest.fixture
+def db():
+    app.create_search_index(app.engine)
+    session = SessionLocal()
+    yield session
+    session.close()
+
+@pytest.fixture
+def chat(db):
+    chat = Chat(title="search tests")
+    db.add(chat)
+    db.commit()
+    return chat
+
+def kinds(db, q, **filters):
+    return sorted(row["kind"] for row in search_messages(db, q, 50, **filters))
+
+def index_rows(db):
+    return db.execute(text("SELECT rowid, kind, chat_id, message_id, scope, title, content FROM search_index ORDER BY rowid")).all()
+
+def test_new_messages_are_indexed(db, chat):
+    db.add(ChatMessage(chat_id=chat.id, message="please reconcile quarterly ledgers", is_user=True))
+    db.commit()
+    assert kinds(db, "ledgers", chat_id=chat.id) == ["prompt"]
+    assert kinds(db, "ledg", chat_id=chat.id) == ["prompt"]
+
+def test_edited_message_replaces_its_row(db, chat):
+    message = ChatMessage(chat_id=chat.id, message="migrate the payroll service", is_user=True)
+    db.add(message)
+    db.commit()
+    message.message = "migrate the timesheet service"
+    db.commit()
+    assert kinds(db, "payroll", chat_id=chat.id) == []
+    assert kinds(db, "timesheet", chat_id=chat.id) == ["prompt"]
+
+def test_untouched_message_is_not_reindexed(db, chat):
+    message = ChatMessage(chat_id=chat.id, message="archive dormant tenants", is_user=True)
+    db.add(message)
+    db.commit()
+    message.input_tokens = 5
+    db.commit()
+    assert kinds(db, "dormant", chat_id=chat.id) == ["prompt"]
+
+def test_deleted_message_leaves_no_rows(db, chat):
+    message = app._build_ai_message(chat.id, {"description": DESCRIPTION, "story": STORY, "test_cases": None})
+    db.add(message)
+    db.commit()
+    assert kinds(db, "invoices", chat_id=chat.id) == ["description", "story"]
+    db.delete(message)
+    db.commit()
+    assert kinds(db, "invoices", chat_id=chat.id) == []
+
+def test_edited_and_deleted_artifacts_update_their_rows(db, chat):
+    message = app._build_ai_message(chat.id, {"description": DESCRIPTION, "story": STORY, "test_cases": None})
+    db.add(message)
+    db.commit()
+    description, story = sorted(message.artifacts, key=lambda artifact: artifact.section)
+    description.encoding, description.body = encode_artifact_body(DESCRIPTION.replace("Invoice export", "Receipt upload"))
+    db.delete(story)
+    db.commit()
+    assert kinds(db, "invoices", chat_id=chat.id) == []
+    assert [row["title"] for row in search_messages(db, "receipt", 50, chat_id=chat.id)] == ["Receipt upload"]
+
+def test_deleted_chat_leaves_no_rows(db, chat):
+    db.add(ChatMessage(chat_id=chat.id, message="rotate signing keys", is_user=True))
+    db.add(app._build_ai_message(chat.id, {"description": DESCRIPTION, "story": STORY, "test_cases": None}))
+    db.commit()
+    db.delete(db.get(Chat, chat.id))
+    db.commit()
+    assert search_messages(db, "signing", 50, chat_id=chat.id) == []
+    assert search_messages(db, "invoices", 50, chat_id=chat.id) == []
+
+def test_index_matches_a_rebuild_after_edits(db, chat):
+    kept = ChatMessage(chat_id=chat.id, message="draft onboarding checklist", is_user=True)
+    edited = ChatMessage(chat_id=chat.id, message="draft offboarding checklist", is_user=True)
+    removed = app._build_ai_message(chat.id, {"description": DESCRIPTION, "story": STORY, "test_cases": None})
+    db.add_all([kept, edited, removed])
+    db.commit()
+    edited.message = "final offboarding checklist"
+    db.delete(removed)
+    db.commit()
+    incremental = index_rows(db)
+    rebuild_search_index()
+    db.expire_all()
+    assert index_rows(db) == incremental
@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+
+import app
+from app import SingleFlight, StoryRequest, generate_coalesced
+
+
+def test_concurrent_callers_share_one_run():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "result"
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(flights.do("key", fn), flights.do("key", fn), flights.do("key", fn))
+        return flights, results
+
+    flights, results = asyncio.run(main())
+    assert len(calls) == 1
+    assert [result for result, _ in results] == ["result"] * 3
+    assert sorted(shared for _, shared in results) == [False, True, True]
+    assert flights.in_flight() == 0
+
+def test_different_keys_run_separately():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return len(calls)
+
+    async def main():
+        flights = SingleFlight()
+        return await asyncio.gather(flights.do("a", fn), flights.do("b", fn))
+
+    results = asyncio.run(main())
+    assert len(calls) == 2
+    assert all(not shared for _, shared in results)
+
+def test_finished_run_is_not_reused():
+    calls = []
+
+    async def fn():
+        calls.append(1)
+        return len(calls)
+
+    async def main():
+        flights = SingleFlight()
+        first = await flights.do("key", fn)
+        second = await flights.do("key", fn)
+        return first, second
+
+    assert asyncio.run(main()) == ((1, False), (2, False))
+
+def test_errors_reach_every_caller_and_clear_the_key():
+    async def fn():
+        await asyncio.sleep(0.01)
+        raise RuntimeError("boom")
+
+    async def main():
+        flights = SingleFlight()
+        results = await asyncio.gather(flights.do("key", fn), flights.do("key", fn), return_exceptions=True)
+        return flights, results
+
+    flights, results = asyncio.run(main())
+    assert all(isinstance(result, RuntimeError) for result in results)
+    assert flights.in_flight() == 0
+
+@pytest.fixture
+def fake_generation(monkeypatch):
+    calls = []
+
+    async def fake_generate_artifacts(request, usage=None):
+        calls.append(request)
+        usage.add_call("story")
+        await asyncio.sleep(0.05)
+        return {"description": None, "story": request.prompt, "test_cases": None}
+
+    monkeypatch.setattr(app, "_generate_artifacts", fake_generate_artifacts)
+    monkeypatch.setattr(app, "generation_flights", SingleFlight())
+    return calls
+
+def run_concurrently(*requests):
+    async def main():
+        return await asyncio.gather(*(generate_coalesced(request) for request in requests))
+    return asyncio.run(main())
+
+def test_identical_requests_are_coalesced(fake_generation):
+    before = app.generation_stats.snapshot().get("coalesced_requests", 0)
+    results = run_concurrently(
+        StoryRequest(prompt="Login page", chat_id=1),
+        StoryRequest(prompt="  login   PAGE ", chat_id=2),
+    )
+    assert len(fake_generation) == 1
+    assert results[0][0] == results[1][0]
+    assert sorted(usage["calls"] for _, usage in results) == [0, 1]
+    assert app.generation_stats.snapshot()["coalesced_requests"] == before + 1
+
+def test_key_separates_cache_bypass_mode_and_config(fake_generation):
+    run_concurrently(
+        StoryRequest(prompt="Login page", chat_id=1),
+        StoryRequest(prompt="Login page", chat_id=1, use_cache=False),
+        StoryRequest(prompt="Login page", chat_id=1, mode="story"),
+        StoryRequest(prompt="Login page", chat_id=1, llm_config={"story": {"provider": "stub"}}),
+    )
+    assert len(fake_generation) == 4
+
+def test_coalesced_callers_get_independent_dicts(fake_generation):
+    (first, _), (second, _) = run_concurrently(
+        StoryRequest(prompt="Login page", chat_id=1),
+        StoryRequest(prompt="Login page", chat_id=1),
+    )
+    first["story"] = "changed"
+    assert second["story"] == "Login page"
@@ -0,0 +1,41 @@
+from app import split_artifacts
+
+FULL = (
+    "**#### 1. Feature Description ####**\n*(This section is for stakeholders.)*\n\n**Feature:** Login\n\n---\n\n"
+    "**#### 2. User Story & Acceptance Criteria ####**\n*(This section is for the development team.)*\n\nAs a user, I want to log in\n\n"
+    "#### 3. Test Cases ####\n```gherkin\nFeature: Login\n  Scenario: ok\n```\n"
+)
+
+
+def test_splits_the_three_sections():
+    assert split_artifacts(FULL) == {
+        "description": "**Feature:** Login",
+        "story": "As a user, I want to log in",
+        "test_cases": "```gherkin\nFeature: Login\n  Scenario: ok\n```",
+    }
+
+def test_headings_inside_code_fences_are_content():
+    text = FULL.replace("  Scenario: ok\n", "## 2. Retry rules\n  Scenario: ok\n### 1. Lockout\n")
+    parts = split_artifacts(text)
+    assert parts["story"] == "As a user, I want to log in"
+    assert parts["test_cases"] == "```gherkin\nFeature: Login\n## 2. Retry rules\n  Scenario: ok\n### 1. Lockout\n```"
+
+def test_tilde_fences_and_unclosed_fences_hide_headings():
+    tilde = "#### 3. Test Cases\n~~~gherkin\nFeature: x\n#### 1. inside\n~~~"
+    assert split_artifacts(tilde) == {"test_cases": "~~~gherkin\nFeature: x\n#### 1. inside\n~~~"}
+    unclosed = "#### 3. Test Cases\n```gherkin\nFeature: x\n#### 1. inside"
+    assert split_artifacts(unclosed) == {"test_cases": "```gherkin\nFeature: x\n#### 1. inside"}
+
+def test_shorter_fence_does_not_close_a_longer_one():
+    text = "#### 3. Test Cases\n````gherkin\nFeature: x\n```\n#### 2. inside\n````\n#### 2. Story\nbody"
+    parts = split_artifacts(text)
+    assert parts["test_cases"] == "````gherkin\nFeature: x\n```\n#### 2. inside\n````"
+    assert parts["story"] == "body"
+
+def test_missing_and_empty_sections_are_omitted():
+    assert split_artifacts("#### 1. Description\n\n#### 2. Story\nbody") == {"story": "body"}
+    assert split_artifacts("no headings at all") == {}
+    assert split_artifacts(None) == {}
+
+def test_first_copy_of_a_repeated_section_wins():
+    assert split_artifacts("#### 2. Story\nfirst\n#### 2. Story again\nsecond") == {"story": "first"}
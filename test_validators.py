@@ -0,0 +1,65 @@
+from app import SECTION_VALIDATORS
+
+DESCRIPTION = (
+    "**Feature:** Saved searches\n**Summary:** s\n**Problem:** p\n**Solution:** x\n"
+    "**Scope:**\n* Save searches\n* Run a saved search"
+)
+STORY = (
+    "User Story:\nAs a data analyst, I want to save my filters so that I can rerun them.\n\n"
+    "1. GIVEN filters WHEN I click save THEN the search is stored\n"
+    "2. GIVEN a saved search WHEN I open the sidebar THEN it is listed\n"
+    "3. GIVEN a saved search WHEN I delete it THEN it disappears"
+)
+TEST_CASES = (
+    "```gherkin\nFeature: Saved searches\n  Scenario: Save\n    Given filters\n    When I click save\n    Then it is stored\n"
+    "  Scenario Outline: Rename\n    Given <old>\n    When I rename it\n    Then it is <new>\n"
+    "    Examples:\n      | old | new |\n      | a   | b   |\n```"
+)
+
+
+def codes(section, text):
+    return SECTION_VALIDATORS[section](text).codes
+
+def test_valid_samples_pass():
+    for section, text in (("description", DESCRIPTION), ("story", STORY), ("test_cases", TEST_CASES)):
+        result = SECTION_VALIDATORS[section](text)
+        assert result.ok and result.codes == [] and result.reasons == []
+
+def test_empty_output_reports_every_rule_in_order():
+    assert codes("test_cases", "") == [
+        "missing_gherkin_fence", "missing_feature", "missing_scenario", "missing_scenario_outline",
+        "missing_examples", "missing_given", "missing_when", "missing_then",
+    ]
+    assert codes("story", None) == [
+        "missing_user_story_label", "story_phrasing", "too_few_acceptance_criteria", "missing_when", "missing_then",
+    ]
+
+def test_alternative_needles_are_found_when_the_first_is_missing():
+    # " Given " is absent, so the one-pass presence check fails and each rule searches every needle
+    text = TEST_CASES.replace("    Given", "Given").replace("Scenario Outline:", "Scenario Outline :")
+    assert codes("test_cases", text) == ["missing_scenario_outline"]
+
+def test_story_phrasing_is_case_insensitive():
+    assert codes("story", STORY.replace("As a", "AS A").replace("so that I can", "So That I Can")) == []
+
+def test_placeholders_are_rejected():
+    assert codes("story", STORY + "\nThis meets the Objective.") == ["placeholder_text"]
+
+def test_too_few_criteria():
+    text = STORY.replace("3. GIVEN", "3. Once")
+    assert codes("story", text) == ["too_few_acceptance_criteria"]
+
+def test_scope_bullets_are_counted_after_the_scope_label():
+    # The "**Scope:" line itself starts with "*", so one more bullet line is enough
+    assert codes("description", DESCRIPTION.replace("\n* Run a saved search", "")) == []
+    assert codes("description", DESCRIPTION.replace("\n* Save searches\n* Run a saved search", " all")) == ["too_few_scope_bullets"]
+    bullet_before_scope = "**Feature:** f\n* stray\n**Summary:** s\n**Problem:** p\n**Solution:** x\n**Scope:** one"
+    assert codes("description", bullet_before_scope) == ["too_few_scope_bullets"]
+
+def test_examples_rule_needs_a_table():
+    assert codes("test_cases", TEST_CASES.replace("|", "")) == ["missing_examples"]
+
+def test_count_markers_reports_every_marker():
+    counts = SECTION_VALIDATORS["story"].count_markers(STORY)
+    assert set(counts) == set(SECTION_VALIDATORS["story"].markers)
+    assert counts["given"] == 3 and counts["placeholder"] == 0
@@ -0,0 +1,105 @@
+"""
+Token report: input tokens per section call before and after section-scoped prompt assembly,
+the uncached tokens sent when SYSTEM_PROMPT is served from the context cache, plus the usage
+recorded on saved AI messages.
+
+Usage: python token_report.py ["requirement text"]
+
+Counts come from Gemini's count_tokens when GEMINI_API_KEY is set, otherwise they are
+estimated at ~4 characters per token.
+"""
+import json
+import sqlite3
+import sys
+
+from app import (
+    ARTIFACT_SECTIONS,
+    SECTION_FIX_NOTES,
+    SECTION_INSTRUCTIONS,
+    SECTION_TEMPLATES,
+    SYSTEM_PROMPT,
+    cacheable_section_prompt,
+    model,
+    section_prompt,
+)
+
+DEFAULT_REQUIREMENT = "Users should be able to export their monthly invoices as CSV from the billing page."
+
+
+def count_tokens(text):
+    if model is not None:
+        return model.count_tokens(text).total_tokens
+    return len(text) // 4
+
+def before_prompt(section, requirement):
+    # Every section call used to send the whole SYSTEM_PROMPT
+    return (
+        f"{SYSTEM_PROMPT}\n\nNow, apply the process to the user's requirement. {SECTION_INSTRUCTIONS[section]}\n\n"
+        f"User Requirement:\n{requirement}"
+    )
+
+def before_retry(section, requirement, reasons):
+    fix_note = "Your previous output failed these checks: " + reasons + ". " + SECTION_FIX_NOTES[section]
+    return f"{SYSTEM_PROMPT}\n\n{fix_note}\n\nUser Requirement:\n{requirement}"
+
+def after_retry(section, reasons):
+    # Patch retries send the failed checks and the previous output instead of the system prompt
+    fix_note = "Your previous output failed these checks: " + reasons + ". " + SECTION_FIX_NOTES[section]
+    previous = SECTION_TEMPLATES[section]
+    return (
+        f"{fix_note}\nFix only what these checks require, keep everything else unchanged, "
+        f"and return the complete corrected section.\n\nPrevious output:\n{previous}"
+    )
+
+def prompt_report(requirement):
+    print(f"Counting with: {'Gemini count_tokens' if model is not None else '~4 chars/token estimate'}\n")
+    print(f"{'call':<22} {'before':>8} {'after':>8} {'saved':>8} {'uncached':>9}")
+    print("-" * 60)
+    totals = [0, 0, 0]
+    for section in ARTIFACT_SECTIONS:
+        rows = [
+            (f"{section} first", before_prompt(section, requirement), section_prompt(section, requirement),
+             cacheable_section_prompt(section, requirement).suffix),
+            (f"{section} retry", before_retry(section, requirement, "example"), after_retry(section, "example"),
+             after_retry(section, "example")),
+        ]
+        for label, before, after, uncached in rows:
+            before_tokens, after_tokens, uncached_tokens = count_tokens(before), count_tokens(after), count_tokens(uncached)
+            totals[0] += before_tokens
+            totals[1] += after_tokens
+            totals[2] += uncached_tokens
+            saved = 1 - after_tokens / before_tokens
+            print(f"{label:<22} {before_tokens:>8} {after_tokens:>8} {saved:>7.0%} {uncached_tokens:>9}")
+    print("-" * 60)
+    print(f"{'total':<22} {totals[0]:>8} {totals[1]:>8} {1 - totals[1] / totals[0]:>7.0%} {totals[2]:>9}")
+    print("\nuncached: tokens prefilled per call when SYSTEM_PROMPT is held in the context cache")
+
+def stored_usage_report(db_path="storycrafter.db"):
+    conn = sqlite3.connect(db_path)
+    try:
+        rows = conn.execute(
+            "SELECT input_tokens, output_tokens, token_usage FROM chat_messages WHERE input_tokens IS NOT NULL"
+        ).fetchall()
+    except sqlite3.Error as e:
+        print(f"\nNo stored usage available: {e}")
+        return
+    finally:
+        conn.close()
+
+    print(f"\nStored usage on {len(rows)} AI messages")
+    if not rows:
+        return
+    sections = {}
+    for input_tokens, output_tokens, token_usage in rows:
+        for name, bucket in (json.loads(token_usage or "{}").get("sections") or {}).items():
+            total = sections.setdefault(name, {"calls": 0, "input_tokens": 0, "output_tokens": 0})
+            for key in total:
+                total[key] += bucket.get(key, 0)
+    print(f"  average input tokens:  {sum(r[0] for r in rows) / len(rows):.0f}")
+    print(f"  average output tokens: {sum(r[1] or 0 for r in rows) / len(rows):.0f}")
+    for name, total in sorted(sections.items()):
+        print(f"  {name:<12} calls={total['calls']:<5} input={total['input_tokens']:<8} output={total['output_tokens']}")
+
+if __name__ == "__main__":
+    prompt_report(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_REQUIREMENT)
+    stored_usage_report()